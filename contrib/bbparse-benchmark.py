@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+
+def server_pid(lockfile):
+    try:
+        with open(lockfile, "r") as f:
+            contents = f.read().split()
+    except OSError:
+        return None
+    if contents and contents[0].isdigit():
+        return int(contents[0])
+    return None
+
+
+def peak_rss(pid):
+    # VmHWM is the peak resident set size of the process
+    try:
+        with open("/proc/%d/status" % pid, "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run(cmd, lockfile):
+    peak = 0
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            pid = server_pid(lockfile)
+            if pid:
+                rss = peak_rss(pid)
+                if rss:
+                    peak = max(peak, rss)
+            done.wait(0.05)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.monotonic()
+    r = subprocess.run(cmd, stdout=subprocess.DEVNULL)
+    elapsed = time.monotonic() - start
+    done.set()
+    sampler.join()
+    if r.returncode != 0:
+        print("%s exited with %d" % (" ".join(cmd), r.returncode))
+        sys.exit(1)
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake parser benchmark",
+        epilog="""
+        Repeatedly runs 'bitbake -p' from an initialized build directory and
+        reports the parse time and peak memory usage of the bitbake server.
+        """,
+    )
+    parser.add_argument("-n", "--iterations", type=int, default=3,
+                        help="Number of times to run each phase (default: %(default)s)")
+    parser.add_argument("-c", "--cache-dir", default="tmp/cache",
+                        help="Cache directory to remove for a full reparse (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    if not "BUILDDIR" in os.environ:
+        print(
+            "'BUILDDIR' not found in the environment. Did you initialize the build environment?"
+        )
+        return 1
+
+    os.chdir(os.environ["BUILDDIR"])
+    lockfile = os.path.join(os.environ["BUILDDIR"], "bitbake.lock")
+
+    for phase in ("reparse", "cached"):
+        times = []
+        peaks = []
+        for _ in range(args.iterations):
+            if phase == "reparse":
+                shutil.rmtree(args.cache_dir, ignore_errors=True)
+            elapsed, peak = run(["bitbake", "-p"], lockfile)
+            times.append(elapsed)
+            peaks.append(peak)
+        print("%-8s best %.2fs  mean %.2fs  peak server RSS %d kB" % (phase, min(times), sum(times) / len(times), max(peaks)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
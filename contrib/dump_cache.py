@@ -40,19 +40,22 @@ class DumpCache(object):
         parser.add_argument("-s", "--skip",
             help = "skip skipped recipes", action="store_true")
         parser.add_argument("cachefile",
-            help = "specify bb_cache.dat", nargs = 1, action="store", default="")
+            help = "specify bb_cache.dat or one of its numbered files", nargs = 1, action="store", default="")
 
         self.args = parser.parse_args()
 
     def main(self):
         with open(self.args.cachefile[0], "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
+            # Skip the cache version, bitbake version, data class names and
+            # configuration digests
+            for _ in range(4):
+                pickle.load(cachefile)
             while True:
                 try:
-                    key = pickled.load()
-                    val = pickled.load()
+                    key, info_array = pickle.load(cachefile)
                 except Exception:
                     break
+                val = info_array[0]
                 if isinstance(val, CoreRecipeInfo):
                     pn = val.pn
 
@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+
+import bb.codeparser
+import bb.msg
+import bb.parse
+import bb.shellscan
+from bb.pysh import pyshyacc
+
+
+def shell_functions(paths):
+    funcstart = bb.parse.parse_py.BBHandler.__func_start_regexp__
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in ("*.bb", "*.bbappend", "*.bbclass", "*.inc"):
+                files += glob.glob(os.path.join(path, "**", pattern), recursive=True)
+        else:
+            files.append(path)
+
+    funcs = []
+    for fn in sorted(files):
+        body = None
+        with open(fn, "r", errors="replace") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if body is None:
+                    m = funcstart.match(line)
+                    if m and not m.group("py"):
+                        body = []
+                elif line == "}":
+                    funcs.append("\n".join(body))
+                    body = None
+                else:
+                    body.append(line)
+    return funcs
+
+
+def parse(value, scan):
+    parser = bb.codeparser.ShellParser("benchmark", None)
+    try:
+        if scan:
+            parser._parse_shell(value)
+        else:
+            tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
+            parser.process_tokens(tokens)
+    except Exception as e:
+        return type(e)
+    return parser.allexecs, parser.funcdefs
+
+
+def run(funcs, scan, iterations):
+    times = []
+    for _ in range(iterations):
+        start = time.monotonic()
+        results = [parse(func, scan) for func in funcs]
+        times.append(time.monotonic() - start)
+    return min(times), results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bitbake shell scanner benchmark",
+        epilog="""
+        Collects the shell functions of the metadata in the given layers,
+        files or directories and times finding the commands they run with
+        the fast shell scanner, falling back to pysh for what it does not
+        handle, against using pysh alone. The results of both are compared.
+        """,
+    )
+    parser.add_argument("paths", nargs="*",
+                        default=[os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib", "bb", "tests")],
+                        help="Layers, directories or files to collect shell functions from (default: the test metadata)")
+    parser.add_argument("-n", "--iterations", type=int, default=3,
+                        help="Number of times to parse the functions (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    # Error messages from pysh aren't wanted for every unparseable function
+    bb.msg.logger_create("BitBake", output=open(os.devnull, "w"))
+
+    funcs = shell_functions(args.paths)
+    if not funcs:
+        print("No shell functions found")
+        return 1
+    size = sum(len(func) for func in funcs)
+
+    accepted = 0
+    for func in funcs:
+        try:
+            bb.shellscan.scan(func)
+            accepted += 1
+        except bb.shellscan.Unsupported:
+            pass
+    print("%d shell functions, %d bytes, %d (%.1f%%) handled by the scanner" % (len(funcs), size, accepted, accepted * 100.0 / len(funcs)))
+
+    pyshtime, pyshresults = run(funcs, False, args.iterations)
+    scantime, scanresults = run(funcs, True, args.iterations)
+    for name, elapsed in (("pysh", pyshtime), ("scanner", scantime)):
+        print("%-8s %.3fs  %.0f functions/s  %.2f MB/s" % (name, elapsed, len(funcs) / elapsed, size / elapsed / 1e6))
+    print("speedup  %.1fx" % (pyshtime / scantime))
+
+    mismatches = [func for func, a, b in zip(funcs, pyshresults, scanresults) if a != b]
+    if mismatches:
+        print("%d functions give different results, the first is:\n%s" % (len(mismatches), mismatches[0]))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,6 +25,7 @@ import bb
 import bb.msg
 import bb.process
 import bb.progress
+import bb.trace
 from io import StringIO
 from bb import data, event, utils
 
@@ -255,7 +256,7 @@ def exec_func(func, d, dirs = None):
             except OSError:
                 pass
 
-    with bb.utils.fileslocked(lockfiles):
+    with bb.trace.span(func, "function"), bb.utils.fileslocked(lockfiles):
         if ispython:
             exec_func_python(func, d, runfile, cwd=adir)
         else:
@@ -25,10 +25,12 @@ import bb.utils
 from bb import PrefixLoggerAdapter
 import re
 import shutil
+import sqlite3
+import time
 
 logger = logging.getLogger("BitBake.Cache")
 
-__cache_version__ = "156"
+__cache_version__ = "160"
 
 def getCacheFile(path, filename, mc, data_hash):
     mcspec = ''
@@ -86,8 +88,12 @@ class CoreRecipeInfo(RecipeInfoCommon):
         self.file_depends = metadata.getVar('__depends', False)
         self.timestamp = bb.parse.cached_mtime(filename)
         self.variants = self.listvar('__VARIANTS', metadata) + ['']
+        self.deferred_variants = self.listvar('__DEFERRED_VARIANTS', metadata)
         self.appends = self.listvar('__BBAPPEND', metadata)
         self.nocache = self.getvar('BB_DONT_CACHE', metadata)
+        self.parsetime = float(metadata.getVar('__PARSETIME', False) or 0)
+        # Bitmask of the configuration variables read, see ConfigDigests
+        self.configdeps = 0
 
         self.provides  = self.depvar('PROVIDES', metadata)
         self.rprovides = self.depvar('RPROVIDES', metadata)
@@ -275,6 +281,7 @@ class SiggenRecipeInfo(RecipeInfoCommon):
     store = {}
     save_map = {}
     save_count = 1
+    save_id = None
     restore_map = {}
     restore_count = {}
 
@@ -284,6 +291,7 @@ class SiggenRecipeInfo(RecipeInfoCommon):
         # (e.g. writing out the cache again)
         cls.save_map = {}
         cls.save_count = 1
+        cls.save_id = None
         cls.restore_map = {}
 
     @classmethod
@@ -329,7 +337,7 @@ class SiggenRecipeInfo(RecipeInfoCommon):
         ret = {}
         for key in ["siggen_gendeps", "siggen_taskdeps", "siggen_varvals"]:
             ret[key] = self._save(self.__dict__[key])
-        ret['pid'] = os.getpid()
+        ret['pid'] = self.save_id or os.getpid()
         return ret
 
     def __setstate__(self, state):
@@ -378,6 +386,48 @@ def variant2virtual(realfn, variant):
         return "mc:" + elems[1] + ":" + realfn
     return "virtual:" + variant + ":" + realfn
 
+class ConfigDigests(object):
+    """
+    Digests of each variable in a base configuration datastore. With
+    BB_CACHE_VARDEPS, the recipe cache is shared between configurations which
+    only differ in the values of variables (see
+    CookerDataBuilder.get_cache_structure_hash()) so each recipe records which
+    variables it read as a bitmask over the sorted variable names. Each cache
+    file stores the digests of the configuration it was written with and a
+    recipe is out of date if any of the variables it read have changed.
+    """
+    def __init__(self, d):
+        digests = d.get_var_digests()
+        self.names = sorted(digests)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.digests = b"".join(digests[name] for name in self.names)
+        self.size = len(self.digests) // len(self.names) if self.names else 0
+
+    def mask(self, lookups):
+        """Return the bitmask of the configuration variables in lookups"""
+        bits = bytearray((len(self.names) + 7) // 8)
+        for var in lookups:
+            i = self.index.get(var)
+            if i is not None:
+                bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, "little")
+
+    def changed(self, digests):
+        """
+        Return the bitmask of the variables which have changed since the
+        configuration the digests were taken from
+        """
+        if digests == self.digests:
+            return 0
+        if digests is None or len(digests) != len(self.digests):
+            return -1
+        bits = bytearray((len(self.names) + 7) // 8)
+        size = self.size
+        for i in range(len(self.names)):
+            if digests[i * size:(i + 1) * size] != self.digests[i * size:(i + 1) * size]:
+                bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, "little")
+
 #
 # Cooker calls cacheValid on its recipe list, then either calls loadCached
 # from it's main thread or parse from separate processes to generate an up to
@@ -387,6 +437,9 @@ class Cache(object):
     """
     BitBake Cache implementation
     """
+    # Number of cache files after which they're merged back into one
+    max_streams = 64
+
     def __init__(self, databuilder, mc, data_hash, caches_array):
         self.databuilder = databuilder
         self.data = databuilder.data
@@ -405,35 +458,72 @@ class Cache(object):
         self.cacheclean = True
         self.data_hash = data_hash
         self.filelist_regex = re.compile(r'(?:(?<=:True)|(?<=:False))\s+')
+        # Cache files successfully loaded, None if they need rewriting
+        self.streams = None
+        # Open shard files written by the parsing processes
+        self.shards = {}
+        # Number of out of date records in the cache files
+        self.stale = 0
+        # Only parse the base recipes, leaving BBCLASSEXTEND variants to be
+        # parsed when needed, see BB_LAZY_VARIANTS
+        self.defervariants = False
 
         if self.cachedir in [None, '']:
             bb.fatal("Please ensure CACHE is set to the cache directory for BitBake to use")
 
+        self.cachefile = self.getCacheFile("bb_cache.dat")
+
+        self.configdigests = None
+        if bb.utils.to_boolean(self.data.getVar("BB_CACHE_VARDEPS")):
+            self.configdigests = ConfigDigests(databuilder.mcdata[mc])
+
     def getCacheFile(self, cachefile):
         return getCacheFile(self.cachedir, cachefile, self.mc, self.data_hash)
 
+    def streamfiles(self):
+        """
+        Return the files making up the cache, oldest first. This is the main
+        cache file followed by any parser shards adopted since it was written.
+        """
+        streams = []
+        if os.path.exists(self.cachefile):
+            streams.append(self.cachefile)
+        prefix = os.path.basename(self.cachefile) + "-"
+        try:
+            numbers = [int(f[len(prefix):]) for f in os.listdir(self.cachedir)
+                       if f.startswith(prefix) and f[len(prefix):].isdigit()]
+        except FileNotFoundError:
+            numbers = []
+        for n in sorted(numbers):
+            streams.append("%s-%d" % (self.cachefile, n))
+        return streams
+
+    def shardfile(self, name):
+        return "%s.shard-%s" % (self.cachefile, name)
+
+    def write_header(self, f):
+        pickle.dump(__cache_version__, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(bb.__version__, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump([cache_class.__name__ for cache_class in self.caches_array], f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(self.configdigests.digests if self.configdigests else None, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def cacheable(info_array):
+        return (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache
+
     def prepare_cache(self, progress):
         loaded = 0
 
-        self.cachefile = self.getCacheFile("bb_cache.dat")
-
         self.logger.debug("Cache dir: %s", self.cachedir)
         bb.utils.mkdirhier(self.cachedir)
 
-        cache_ok = True
-        if self.caches_array:
-            for cache_class in self.caches_array:
-                cachefile = self.getCacheFile(cache_class.cachefile)
-                cache_exists = os.path.exists(cachefile)
-                self.logger.debug2("Checking if %s exists: %r", cachefile, cache_exists)
-                cache_ok = cache_ok and cache_exists
-                cache_class.init_cacheData(self)
-        if cache_ok:
+        for cache_class in self.caches_array:
+            cache_class.init_cacheData(self)
+        if self.streamfiles():
             loaded = self.load_cachefile(progress)
-        elif os.path.isfile(self.cachefile):
-            self.logger.info("Out of date cache found, rebuilding...")
         else:
             self.logger.debug("Cache file %s not found, building..." % self.cachefile)
+            self.streams = []
 
         # We don't use the symlink, its just for debugging convinience
         if self.mc:
@@ -452,8 +542,7 @@ class Cache(object):
 
     def cachesize(self):
         cachesize = 0
-        for cache_class in self.caches_array:
-            cachefile = self.getCacheFile(cache_class.cachefile)
+        for cachefile in self.streamfiles():
             try:
                 with open(cachefile, "rb") as cachefile:
                     cachesize += os.fstat(cachefile.fileno()).st_size
@@ -464,59 +553,114 @@ class Cache(object):
 
     def load_cachefile(self, progress):
         previous_progress = 0
+        streams = self.streamfiles()
+        classnames = [cache_class.__name__ for cache_class in self.caches_array]
 
-        for cache_class in self.caches_array:
-            cachefile = self.getCacheFile(cache_class.cachefile)
-            self.logger.debug('Loading cache file: %s' % cachefile)
-            with open(cachefile, "rb") as cachefile:
-                pickled = pickle.Unpickler(cachefile)
+        for streamfile in streams:
+            self.logger.debug('Loading cache file: %s' % streamfile)
+            # Each file is a separate stream as far as the siggen data is concerned
+            SiggenRecipeInfo.reset()
+            with open(streamfile, "rb") as cachefile:
                 # Check cache version information
                 try:
-                    cache_ver = pickled.load()
-                    bitbake_ver = pickled.load()
+                    cache_ver = pickle.load(cachefile)
+                    bitbake_ver = pickle.load(cachefile)
+                    stored_classes = pickle.load(cachefile)
+                    digests = pickle.load(cachefile)
                 except Exception:
                     self.logger.info('Invalid cache, rebuilding...')
+                    self.depends_cache = {}
                     return 0
 
                 if cache_ver != __cache_version__:
                     self.logger.info('Cache version mismatch, rebuilding...')
+                    self.depends_cache = {}
                     return 0
                 elif bitbake_ver != bb.__version__:
                     self.logger.info('Bitbake version mismatch, rebuilding...')
+                    self.depends_cache = {}
+                    return 0
+                elif not set(classnames).issubset(stored_classes):
+                    self.logger.info('Cache data classes changed, rebuilding...')
+                    self.depends_cache = {}
                     return 0
 
+                indexes = None
+                if stored_classes != classnames:
+                    indexes = [stored_classes.index(name) for name in classnames]
+
+                # Configuration variables changed since the file was written
+                changed = 0
+                if self.configdigests:
+                    changed = self.configdigests.changed(digests)
+
                 # Load the rest of the cache file
-                current_progress = 0
                 while cachefile:
                     try:
-                        key = pickled.load()
-                        value = pickled.load()
+                        key, info_array = pickle.load(cachefile)
                     except Exception:
                         break
                     if not isinstance(key, str):
                         bb.warn("%s from extras cache is not a string?" % key)
                         break
-                    if not isinstance(value, RecipeInfoCommon):
-                        bb.warn("%s from extras cache is not a RecipeInfoCommon class?" % value)
+                    if not all(isinstance(info, RecipeInfoCommon) for info in info_array):
+                        bb.warn("%s from extras cache is not a RecipeInfoCommon class?" % info_array)
                         break
 
+                    if indexes:
+                        info_array = [info_array[i] for i in indexes]
+
+                    # Skip records for recipes which read changed variables,
+                    # an earlier record may still match the configuration
+                    if info_array[0].configdeps & changed:
+                        self.stale += 1
+                        progress(cachefile.tell() + previous_progress)
+                        continue
+
+                    # Records in later files replace those in earlier ones
                     if key in self.depends_cache:
-                        self.depends_cache[key].append(value)
+                        self.stale += 1
+                        del self.depends_cache[key]
+                    if self.cacheable(info_array):
+                        self.depends_cache[key] = info_array
                     else:
-                        self.depends_cache[key] = [value]
+                        self.stale += 1
                     # only fire events on even percentage boundaries
-                    current_progress = cachefile.tell() + previous_progress
                     progress(cachefile.tell() + previous_progress)
 
-                previous_progress += current_progress
+                previous_progress += cachefile.tell()
 
+        self.streams = streams
         return len(self.depends_cache)
 
-    def parse(self, filename, appends, layername):
-        """Parse the specified filename, returning the recipe information"""
+    def parse(self, filename, appends, layername, variants=None):
+        """
+        Parse the specified filename, returning the recipe information.
+        A list of variants returns only the information for those variants.
+        """
         self.logger.debug("Parsing %s", filename)
+        if variants is None and self.defervariants:
+            variants = []
         infos = []
-        datastores = self.databuilder.parseRecipeVariants(filename, appends, mc=self.mc, layername=layername)
+        if bb.parse.parse_profile:
+            bb.parse.parse_profile.start_recipe(realfn2virtual(filename, "", self.mc))
+        if self.configdigests:
+            # Copies of the configuration made while parsing inherit the tracking
+            lookups = set()
+            cfgdata = self.databuilder.mcdata[self.mc]
+            cfgdata.enableLookupTracking(lookups)
+        start = time.monotonic()
+        try:
+            datastores = self.databuilder.parseRecipeVariants(filename, appends, mc=self.mc, layername=layername, variants=variants)
+        finally:
+            if self.configdigests:
+                cfgdata.disableLookupTracking()
+        if variants:
+            datastores = dict((v, d) for v, d in datastores.items() if v in variants)
+        parsetime = time.monotonic() - start
+        if bb.parse.parse_profile:
+            bb.parse.parse_profile.add_recipe("total", parsetime)
+        deferred = variants == []
         depends = []
         variants = []
         # Process the "real" fn last so we can store variants list
@@ -530,12 +674,21 @@ class Cache(object):
                 data.setVar("__depends", depends)
             if virtualfn == filename:
                 data.setVar("__VARIANTS", " ".join(variants))
+                data.setVar("__PARSETIME", parsetime)
+                if deferred:
+                    data.setVar("__DEFERRED_VARIANTS", data.getVar("BBCLASSEXTEND") or "")
             info_array = []
             for cache_class in self.caches_array:
                 info = cache_class(filename, data)
                 info_array.append(info)
             infos.append((virtualfn, info_array))
 
+        if self.configdigests:
+            # Only now has everything been read from the datastores
+            configdeps = self.configdigests.mask(lookups)
+            for _, info_array in infos:
+                info_array[0].configdeps = configdeps
+
         return infos
 
     def loadCached(self, filename, appends):
@@ -549,6 +702,11 @@ class Cache(object):
         for variant in info_array[0].variants:
             virtualfn = variant2virtual(filename, variant)
             infos.append((virtualfn, self.depends_cache[virtualfn]))
+        # Deferred variants are only cached once they've been needed
+        for variant in info_array[0].deferred_variants:
+            virtualfn = variant2virtual(filename, variant)
+            if virtualfn in self.clean:
+                infos.append((virtualfn, self.depends_cache[virtualfn]))
 
         return infos
 
@@ -642,9 +800,31 @@ class Cache(object):
                 self.logger.debug2("Extra caches missing for %s?" % virtualfn)
                 invalid = True
 
+        # Deferred variants parsed since are checked on their own, a recipe
+        # parsed without them is only valid if they can still be deferred
+        for cls in info_array[0].deferred_variants:
+            virtualfn = variant2virtual(fn, cls)
+            if virtualfn not in self.depends_cache:
+                if not self.defervariants:
+                    self.logger.debug2("%s is not cached", virtualfn)
+                    invalid = True
+                continue
+            variant_info = self.depends_cache[virtualfn]
+            if (variant_info[0].timestamp != mtime or
+                    tuple(variant_info[0].appends) != tuple(appends) or
+                    len(variant_info) != len(self.caches_array) or
+                    any(bb.parse.cached_mtime_noerror(f) != old_mtime
+                        for f, old_mtime in variant_info[0].file_depends or [])):
+                self.logger.debug2("%s changed", virtualfn)
+                self.remove(virtualfn)
+                if not self.defervariants:
+                    invalid = True
+                continue
+            self.clean.add(virtualfn)
+
         # If any one of the variants is not present, mark as invalid for all
         if invalid:
-            for cls in info_array[0].variants:
+            for cls in info_array[0].variants + info_array[0].deferred_variants:
                 virtualfn = variant2virtual(fn, cls)
                 if virtualfn in self.clean:
                     self.logger.debug2("Removing %s from cache", virtualfn)
@@ -665,37 +845,102 @@ class Cache(object):
         if fn in self.depends_cache:
             self.logger.debug("Removing %s from cache", fn)
             del self.depends_cache[fn]
+            self.stale += 1
         if fn in self.clean:
             self.logger.debug("Marking %s as unclean", fn)
             self.clean.remove(fn)
 
+    def load_shard(self, shardfile, records):
+        """
+        Read back the recipe information a parsing process wrote into its
+        shard, given the (virtualfn, offset, length) of each record
+        """
+        if shardfile not in self.shards:
+            self.shards[shardfile] = open(shardfile, "rb")
+        fd = self.shards[shardfile].fileno()
+
+        infos = []
+        for virtualfn, offset, length in records:
+            _, info_array = pickle.loads(os.pread(fd, length, offset))
+            if not self.cacheable(info_array):
+                self.stale += 1
+            infos.append((virtualfn, info_array))
+        return infos
+
     def sync(self):
         """
         Save the cache
         Called from the parser when complete (or exiting)
         """
+        for f in self.shards.values():
+            f.close()
+
         if self.cacheclean:
             self.logger.debug2("Cache is clean, not saving.")
-            return
-
-        for cache_class in self.caches_array:
-            cache_class_name = cache_class.__name__
-            cachefile = self.getCacheFile(cache_class.cachefile)
-            self.logger.debug2("Writing %s", cachefile)
-            with open(cachefile, "wb") as f:
-                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
-                p.dump(__cache_version__)
-                p.dump(bb.__version__)
-
-                for key, info_array in self.depends_cache.items():
-                    for info in info_array:
-                        if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
-                            p.dump(key)
-                            p.dump(info)
+        else:
+            with bb.utils.fileslocked([self.cachefile + ".lock"]):
+                streams = self.streamfiles()
+                if (not self.shards or self.streams != streams or
+                        self.stale * 4 > len(self.depends_cache) or
+                        len(streams) + len(self.shards) > self.max_streams):
+                    self.write_cachefile(streams)
+                else:
+                    # The shards are already in the cache file format so can
+                    # be added to the cache as they are
+                    n = 0
+                    if streams and streams[-1] != self.cachefile:
+                        n = int(streams[-1].rsplit("-", 1)[1])
+                    for shardfile in self.shards:
+                        n += 1
+                        self.logger.debug2("Adding %s to the cache", shardfile)
+                        os.rename(shardfile, "%s-%d" % (self.cachefile, n))
+
+        for shardfile in self.shards:
+            bb.utils.remove(shardfile)
+        self.shards = {}
 
         del self.depends_cache
         SiggenRecipeInfo.reset()
 
+    def append_infos(self, infos):
+        """
+        Add recipe information parsed after the cache was saved, such as
+        deferred variants, to the end of the cache
+        """
+        infos = [(virtualfn, info_array) for virtualfn, info_array in infos if self.cacheable(info_array)]
+        if not infos:
+            return
+
+        shard = CacheShard(self)
+        try:
+            shard.write(infos)
+        finally:
+            shard.f.close()
+        with bb.utils.fileslocked([self.cachefile + ".lock"]):
+            streams = self.streamfiles()
+            n = 0
+            if streams and streams[-1] != self.cachefile:
+                n = int(streams[-1].rsplit("-", 1)[1])
+            self.logger.debug2("Adding %s to the cache", shard.filename)
+            os.rename(shard.filename, "%s-%d" % (self.cachefile, n + 1))
+
+    def write_cachefile(self, streams):
+        """
+        Write all of the cache data out into a new main cache file, replacing
+        the existing cache files
+        """
+        self.logger.debug2("Writing %s", self.cachefile)
+        SiggenRecipeInfo.reset()
+        with open(self.cachefile + ".new", "wb") as f:
+            self.write_header(f)
+            for key, info_array in self.depends_cache.items():
+                pickle.dump((key, info_array), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self.cachefile + ".new", self.cachefile)
+
+        for streamfile in streams:
+            if streamfile != self.cachefile:
+                bb.utils.remove(streamfile)
+
     @staticmethod
     def mtime(cachefile):
         return bb.parse.cached_mtime_noerror(cachefile)
@@ -717,11 +962,61 @@ class Cache(object):
             if watcher:
                 watcher(info_array[0].file_depends)
 
-        if (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache:
+        if self.cacheable(info_array):
             if parsed:
                 self.cacheclean = False
             self.depends_cache[filename] = info_array
 
+class CacheShard(object):
+    """
+    Append only file of cache records written by a parsing process. The records
+    are in the final cache file format so the main process can read them back
+    by offset and the file can be added to the cache without serialising the
+    recipe information a second time.
+    """
+    def __init__(self, cache, generation=0):
+        name = "%d.%d" % (os.getpid(), generation)
+        self.filename = cache.shardfile(name)
+        # Siggen data is deduplicated per shard so each one can be read alone
+        self.save_id = "%s:%s" % (name, cache.mc)
+        self.save_map = {}
+        self.save_count = 1
+        self.f = open(self.filename, "wb")
+        cache.write_header(self.f)
+
+    def write(self, infos):
+        """
+        Write the parsed recipe information, returning the shard filename and
+        the (virtualfn, offset, length) of each record
+        """
+        records = []
+        start = self.f.tell()
+        SiggenRecipeInfo.save_map = self.save_map
+        SiggenRecipeInfo.save_count = self.save_count
+        SiggenRecipeInfo.save_id = self.save_id
+        try:
+            for virtualfn, info_array in infos:
+                offset = self.f.tell()
+                pickle.dump((virtualfn, info_array), self.f, pickle.HIGHEST_PROTOCOL)
+                records.append((virtualfn, offset, self.f.tell() - offset))
+        except:
+            # Don't leave a partial record or references to it in the shard
+            self.f.seek(start)
+            self.f.truncate()
+            for fs, mapnum in list(self.save_map.items()):
+                if mapnum >= self.save_count:
+                    del self.save_map[fs]
+            raise
+        else:
+            self.save_count = SiggenRecipeInfo.save_count
+        finally:
+            SiggenRecipeInfo.reset()
+        self.f.flush()
+        return self.filename, records
+
+    def close(self):
+        self.f.close()
+
 class MulticonfigCache(Mapping):
     def __init__(self, databuilder, data_hash, caches_array):
         def progress(p):
@@ -805,18 +1100,128 @@ class CacheData(object):
         for info in info_array:
             info.add_cacheData(self, fn)
 
+class MultiProcessCacheTable(Mapping):
+    """
+    One table of a MultiProcessCache database. Entries are looked up lazily
+    and remembered locally, so a process only ever loads what it uses.
+    """
+
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.table = "cache%d" % index
+        self.entries = {}
+        self.missing = set()
+        # Keys read whose last use should be refreshed in the database
+        self.touched = set()
+
+    def lookup(self, key):
+        try:
+            row = self.cache.connection().execute("SELECT value, used FROM %s WHERE key = ?" % self.table, (key,)).fetchone()
+        except sqlite3.DatabaseError as e:
+            self.cache.recreate(e)
+            row = None
+        if row is None:
+            self.missing.add(key)
+            raise KeyError(key)
+        value = pickle.loads(row[0])
+        self.entries[key] = value
+        if row[1] < self.cache.today:
+            self.touched.add(key)
+        return value
+
+    def __getitem__(self, key):
+        try:
+            return self.entries[key]
+        except KeyError:
+            if key in self.missing:
+                raise
+        return self.lookup(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.missing.discard(key)
+
+    def update(self, entries):
+        self.entries.update(entries)
+        self.missing.difference_update(entries)
+
+    def load_all(self):
+        try:
+            rows = self.cache.connection().execute("SELECT key, value FROM %s" % self.table).fetchall()
+        except sqlite3.DatabaseError as e:
+            self.cache.recreate(e)
+            rows = []
+        for key, value in rows:
+            if key not in self.entries:
+                self.entries[key] = pickle.loads(value)
+        self.missing.clear()
+
+    def __iter__(self):
+        self.load_all()
+        return iter(list(self.entries))
+
+    def __len__(self):
+        self.load_all()
+        return len(self.entries)
+
+    def reset(self):
+        self.entries = {}
+        self.missing = set()
+        self.touched = set()
+
 class MultiProcessCache(object):
     """
     BitBake multi-process cache implementation
 
     Used by the codeparser & file checksum caches
+
+    Entries are kept in an SQLite database in WAL mode so any number of
+    processes can look entries up lazily and add new ones concurrently,
+    without a merge step. Entries not used for CACHE_MAX_AGE days are
+    dropped and each table is bounded to the CACHE_MAX_ENTRIES most recently
+    used entries.
     """
 
+    CACHE_MAX_AGE = 30
+    CACHE_MAX_ENTRIES = None
+
     def __init__(self):
         self.cachefile = None
+        self.db = None
+        self.dbpid = None
+        self.dbinode = None
         self.cachedata = self.create_cachedata()
         self.cachedata_extras = self.create_cachedata()
 
+    @property
+    def today(self):
+        return int(time.time() // 86400)
+
+    # Connections inherited over fork() must neither be used nor closed by
+    # the child, keep them referenced
+    inherited_connections = []
+
+    def connection(self):
+        if self.dbpid != os.getpid():
+            if self.db is not None:
+                MultiProcessCache.inherited_connections.append(self.db)
+            self.db = sqlite3.connect(self.cachefile, timeout=600, isolation_level=None, check_same_thread=False)
+            self.dbpid = os.getpid()
+            try:
+                self.dbinode = os.stat(self.cachefile).st_ino
+            except OSError:
+                self.dbinode = None
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = OFF")
+        return self.db
+
     def init_cache(self, cachedir, cache_file_name=None):
         if not cachedir:
             return
@@ -826,22 +1231,56 @@ class MultiProcessCache(object):
                                       cache_file_name or self.__class__.cache_file_name)
         logger.debug("Using cache in '%s'", self.cachefile)
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        # Caches used to be pickled dictionaries merged at the end of each
+        # parse, remove any left behind by older versions
+        legacy = os.path.splitext(self.cachefile)[0] + ".dat"
+        if legacy != self.cachefile and os.path.exists(legacy):
+            bb.utils.remove(legacy)
+            bb.utils.remove(legacy + "-*")
 
+        self.cachedata = [MultiProcessCacheTable(self, i) for i in range(len(self.create_cachedata()))]
         try:
-            with open(self.cachefile, "rb") as f:
-                p = pickle.Unpickler(f)
-                data, version = p.load()
-        except:
-            bb.utils.unlockfile(glf)
-            return
+            self.init_database()
+        except sqlite3.DatabaseError as e:
+            self.recreate(e)
 
-        bb.utils.unlockfile(glf)
-
-        if version != self.__class__.CACHE_VERSION:
-            return
+    def recreate(self, e):
+        """
+        Replace a damaged database with an empty one. Entries already read
+        stay in use, anything else is a cache miss.
+        """
+        logger.debug("Recreating cache %s: %s", self.cachefile, e)
+        inode = self.dbinode
+        if self.db is not None and self.dbpid == os.getpid():
+            self.db.close()
+            self.db = self.dbpid = None
+        # Another process may have replaced the database already
+        try:
+            if os.stat(self.cachefile).st_ino == inode:
+                bb.utils.remove(self.cachefile)
+                bb.utils.remove(self.cachefile + "-*")
+        except OSError:
+            pass
+        self.init_database()
 
-        self.cachedata = data
+    def init_database(self):
+        tables = len(self.cachedata)
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS config (name TEXT PRIMARY KEY NOT NULL, value TEXT)")
+            row = db.execute("SELECT value FROM config WHERE name = 'version'").fetchone()
+            version = str(self.__class__.CACHE_VERSION)
+            for i in range(tables):
+                db.execute("CREATE TABLE IF NOT EXISTS cache%d (key TEXT PRIMARY KEY NOT NULL, value BLOB, used INTEGER)" % i)
+                db.execute("CREATE INDEX IF NOT EXISTS cache%d_used ON cache%d (used)" % (i, i))
+                if row is None or row[0] != version:
+                    db.execute("DELETE FROM cache%d" % i)
+            db.execute("INSERT OR REPLACE INTO config (name, value) VALUES ('version', ?)", (version,))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
 
     def create_cachedata(self):
         data = [{}]
@@ -851,80 +1290,82 @@ class MultiProcessCache(object):
         if not self.cachefile:
             bb.fatal("Can't clear invalid cachefile")
 
-        self.cachedata = self.create_cachedata()
         self.cachedata_extras = self.create_cachedata()
-        with bb.utils.fileslocked([self.cachefile + ".lock"]):
-            bb.utils.remove(self.cachefile)
-            bb.utils.remove(self.cachefile + "-*")
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        for table in self.cachedata:
+            table.reset()
+            db.execute("DELETE FROM %s" % table.table)
+        db.execute("COMMIT")
 
     def save_extras(self):
         if not self.cachefile:
             return
 
-        have_data = any(self.cachedata_extras)
+        have_data = any(self.cachedata_extras) or any(table.touched for table in self.cachedata)
         if not have_data:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
-
-        i = os.getpid()
-        lf = None
-        while not lf:
-            lf = bb.utils.lockfile(self.cachefile + ".lock." + str(i), retry=False)
-            if not lf or os.path.exists(self.cachefile + "-" + str(i)):
-                if lf:
-                    bb.utils.unlockfile(lf)
-                    lf = None
-                i = i + 1
-                continue
-
-            with open(self.cachefile + "-" + str(i), "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([self.cachedata_extras, self.__class__.CACHE_VERSION])
-
-        bb.utils.unlockfile(lf)
-        bb.utils.unlockfile(glf)
+        try:
+            self.write_extras()
+        except sqlite3.DatabaseError as e:
+            # The new entries are still good, write them to a new database
+            self.recreate(e)
+            self.write_extras()
+        for table in self.cachedata:
+            table.touched.clear()
+
+    def write_extras(self):
+        today = self.today
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for table, extras in zip(self.cachedata, self.cachedata_extras):
+                db.executemany("INSERT OR REPLACE INTO %s (key, value, used) VALUES (?, ?, ?)" % table.table,
+                               ((key, pickle.dumps(value, -1), today) for key, value in extras.items()))
+                db.executemany("UPDATE %s SET used = ? WHERE key = ?" % table.table,
+                               ((today, key) for key in table.touched))
+            db.execute("COMMIT")
+        except:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
 
-    def merge_data(self, source, dest):
-        for j in range(0,len(dest)):
-            for h in source[j]:
-                if h not in dest[j]:
-                    dest[j][h] = source[j][h]
+    def flush_extras(self):
+        """
+        Save the extras and then fold them into the local data so they aren't
+        saved again. Used by processes which outlive a single parse.
+        """
+        self.save_extras()
+        for data, extras in zip(self.cachedata, self.cachedata_extras):
+            data.update(extras)
+            extras.clear()
 
     def save_merge(self):
+        """
+        Entries are shared as soon as save_extras() has been called, all that
+        is left for the main process is to expire old entries.
+        """
         if not self.cachefile:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock")
-
-        data = self.cachedata
-
-        have_data = False
-
-        for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
-            f = os.path.join(os.path.dirname(self.cachefile), f)
-            try:
-                with open(f, "rb") as fd:
-                    p = pickle.Unpickler(fd)
-                    extradata, version = p.load()
-            except (IOError, EOFError):
-                os.unlink(f)
-                continue
-
-            if version != self.__class__.CACHE_VERSION:
-                os.unlink(f)
-                continue
-
-            have_data = True
-            self.merge_data(extradata, data)
-            os.unlink(f)
-
-        if have_data:
-            with open(self.cachefile, "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([data, self.__class__.CACHE_VERSION])
-
-        bb.utils.unlockfile(glf)
+        maxage = self.__class__.CACHE_MAX_AGE
+        maxentries = self.__class__.CACHE_MAX_ENTRIES
+        db = self.connection()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for table in self.cachedata:
+                if maxage is not None:
+                    db.execute("DELETE FROM %s WHERE used < ?" % table.table, (self.today - maxage,))
+                if maxentries is not None:
+                    count = db.execute("SELECT COUNT(*) FROM %s" % table.table).fetchone()[0]
+                    if count > maxentries:
+                        db.execute("DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY used LIMIT ?)" % (table.table, table.table),
+                                   (count - maxentries,))
+            db.execute("COMMIT")
+        except sqlite3.DatabaseError as e:
+            # Nothing is left to expire once the database is recreated
+            self.recreate(e)
 
 
 class SimpleCache(object):
@@ -8,7 +8,6 @@
 import glob
 import operator
 import os
-import stat
 import bb.utils
 import logging
 import re
@@ -18,75 +17,124 @@ logger = logging.getLogger("BitBake.Cache")
 
 filelist_regex = re.compile(r'(?:(?<=:True)|(?<=:False))\s+')
 
-# mtime cache (non-persistent)
-# based upon the assumption that files do not change during bitbake run
-class FileMtimeCache(object):
-    cache = {}
-
-    def cached_mtime(self, f):
-        if f not in self.cache:
-            self.cache[f] = os.stat(f)[stat.ST_MTIME]
-        return self.cache[f]
-
-    def cached_mtime_noerror(self, f):
-        if f not in self.cache:
-            try:
-                self.cache[f] = os.stat(f)[stat.ST_MTIME]
-            except OSError:
-                return 0
-        return self.cache[f]
-
-    def update_mtime(self, f):
-        self.cache[f] = os.stat(f)[stat.ST_MTIME]
-        return self.cache[f]
-
-    def clear(self):
-        self.cache.clear()
-
-# Checksum + mtime cache (persistent)
+# Checksum + stat cache (persistent)
 class FileChecksumCache(MultiProcessCache):
-    cache_file_name = "local_file_checksum_cache.dat"
-    CACHE_VERSION = 1
+    cache_file_name = "local_file_checksum_cache.sqlite3"
+    CACHE_VERSION = 2
+    # Number of threads used to checksum files which aren't in the cache
+    CHECKSUM_THREADS = 8
 
     def __init__(self):
-        self.mtime_cache = FileMtimeCache()
+        # Non-persistent, based upon the assumption that files do not change
+        # during the bitbake run
+        self.stat_cache = {}
         MultiProcessCache.__init__(self)
 
-    def get_checksum(self, f):
-        f = os.path.normpath(f)
-        entry = self.cachedata[0].get(f)
-        cmtime = self.mtime_cache.cached_mtime(f)
+    def get_stat(self, f):
+        """
+        Return the (mtime, size, inode) of f, which a cached checksum of f
+        must match to be reused
+        """
+        if f not in self.stat_cache:
+            st = os.stat(f)
+            self.stat_cache[f] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return self.stat_cache[f]
+
+    def get_cached_checksum(self, f, fstat):
+        entry = self.cachedata_extras[0].get(f) or self.cachedata[0].get(f)
         if entry:
-            (mtime, hashval) = entry
-            if cmtime == mtime:
-                return hashval
-            else:
-                bb.debug(2, "file %s changed mtime, recompute checksum" % f)
+            if entry[:3] == fstat:
+                return entry[3]
+            bb.debug(2, "file %s changed, recompute checksum" % f)
+        return None
 
-        hashval = bb.utils.md5_file(f)
-        self.cachedata_extras[0][f] = (cmtime, hashval)
+    def get_checksum(self, f):
+        f = os.path.normpath(f)
+        fstat = self.get_stat(f)
+        hashval = self.get_cached_checksum(f, fstat)
+        if hashval is None:
+            hashval = bb.utils.md5_file(f)
+            self.cachedata_extras[0][f] = fstat + (hashval,)
         return hashval
 
-    def merge_data(self, source, dest):
-        for h in source[0]:
-            if h in dest:
-                (smtime, _) = source[0][h]
-                (dmtime, _) = dest[0][h]
-                if smtime > dmtime:
-                    dest[0][h] = source[0][h]
-            else:
-                dest[0][h] = source[0][h]
-
     def get_checksums(self, filelist, pn, localdirsexclude):
-        """Get checksums for a list of files"""
+        """
+        Get checksums for a list of files
+
+        The files are gathered and stat()ed first, and the ones which aren't
+        in the cache are then checksummed in parallel.
+        """
+        return self.get_checksums_multi([(filelist, pn)], localdirsexclude)[0]
+
+    def get_checksums_multi(self, filelists, localdirsexclude):
+        """
+        Get checksums for several lists of files, given as (filelist, pn)
+        pairs, returning a list of the checksums of each
+
+        The files of all the lists are gathered first so the ones which aren't
+        in the cache are checksummed by a single pool of threads. The pool
+        threads only read the files, the caches are only accessed by the
+        calling thread.
+        """
+        gathered = [self.gather_files(filelist, pn, localdirsexclude) for filelist, pn in filelists]
+
+        hashvals = {}
+        missing = {}
+        for files in gathered:
+            for f, fstat in files:
+                normf = os.path.normpath(f)
+                if normf in hashvals or normf in missing:
+                    continue
+                hashval = self.get_cached_checksum(normf, fstat)
+                if hashval is None:
+                    missing[normf] = fstat
+                else:
+                    hashvals[normf] = hashval
 
         def checksum_file(f):
             try:
-                checksum = self.get_checksum(f)
+                return bb.utils.md5_file(f)
+            except OSError as e:
+                return e
+
+        if len(missing) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(missing), self.CHECKSUM_THREADS)) as executor:
+                results = list(executor.map(checksum_file, missing))
+        else:
+            results = [checksum_file(f) for f in missing]
+
+        for (f, fstat), hashval in zip(missing.items(), results):
+            hashvals[f] = hashval
+            if not isinstance(hashval, OSError):
+                self.cachedata_extras[0][f] = fstat + (hashval,)
+
+        allchecksums = []
+        for (_, pn), files in zip(filelists, gathered):
+            checksums = []
+            for f, _ in files:
+                checksum = hashvals[os.path.normpath(f)]
+                if isinstance(checksum, OSError):
+                    bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), checksum))
+                    continue
+                checksums.append((f, checksum))
+            checksums.sort(key=operator.itemgetter(1))
+            allchecksums.append(checksums)
+        return allchecksums
+
+    def gather_files(self, filelist, pn, localdirsexclude):
+        """
+        Return the files named by filelist, expanding globs and directories,
+        along with their stat information
+        """
+
+        def add_file(f):
+            try:
+                fstat = self.get_stat(os.path.normpath(f))
             except OSError as e:
                 bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
-                return None
-            return checksum
+                return
+            files.append((f, fstat))
 
         #
         # Changing the format of file-checksums is problematic as both OE and Bitbake have
@@ -96,22 +144,17 @@ class FileChecksumCache(MultiProcessCache):
         # the path. The filesystem handles it but it gives us a marker to know which subsection
         # of the path to cache.
         #
-        def checksum_dir(pth):
+        def add_dir(pth):
             # Handle directories recursively
             if pth == "/":
                 bb.fatal("Refusing to checksum /")
             pth = pth.rstrip("/")
-            dirchecksums = []
-            for root, dirs, files in os.walk(pth, topdown=True):
+            for root, dirs, dirfiles in os.walk(pth, topdown=True):
                 [dirs.remove(d) for d in list(dirs) if d in localdirsexclude]
-                for name in files:
-                    fullpth = os.path.join(root, name).replace(pth, os.path.join(pth, "."))
-                    checksum = checksum_file(fullpth)
-                    if checksum:
-                        dirchecksums.append((fullpth, checksum))
-            return dirchecksums
-
-        checksums = []
+                for name in dirfiles:
+                    add_file(os.path.join(root, name).replace(pth, os.path.join(pth, ".")))
+
+        files = []
         for pth in filelist_regex.split(filelist):
             if not pth:
                 continue
@@ -127,31 +170,28 @@ class FileChecksumCache(MultiProcessCache):
                 for f in glob.glob(pth):
                     if os.path.isdir(f):
                         if not os.path.islink(f):
-                            checksums.extend(checksum_dir(f))
+                            add_dir(f)
                     else:
-                        checksum = checksum_file(f)
-                        if checksum:
-                            checksums.append((f, checksum))
+                        add_file(f)
             elif os.path.isdir(pth):
                 if not os.path.islink(pth):
-                    checksums.extend(checksum_dir(pth))
+                    add_dir(pth)
             else:
-                checksum = checksum_file(pth)
-                if checksum:
-                    checksums.append((pth, checksum))
+                add_file(pth)
 
-        checksums.sort(key=operator.itemgetter(1))
-        return checksums
+        return files
 
 class RevisionsCache(MultiProcessCache):
-    cache_file_name = "local_srcrevisions.dat"
+    cache_file_name = "local_srcrevisions.sqlite3"
+    # Revisions are only dropped according to BB_SRCREV_POLICY
+    CACHE_MAX_AGE = None
     CACHE_VERSION = 1
 
     def __init__(self):
         MultiProcessCache.__init__(self)
 
     def get_revs(self):
-        return self.cachedata[0]
+        return dict(self.cachedata[0])
 
     def get_rev(self, k):
         if k in self.cachedata_extras[0]:
@@ -163,7 +203,3 @@ class RevisionsCache(MultiProcessCache):
     def set_rev(self, k, v):
         self.cachedata[0][k] = v
         self.cachedata_extras[0][k] = v
-
-    def merge_data(self, source, dest):
-        for h in source[0]:
-            dest[0][h] = source[0][h]
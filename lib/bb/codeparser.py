@@ -32,6 +32,7 @@ import bb.utils, bb.data
 import hashlib
 from itertools import chain
 from bb.pysh import pyshyacc, pyshlex
+from bb import shellscan
 from bb.cache import MultiProcessCache
 
 logger = logging.getLogger('BitBake.CodeParser')
@@ -166,12 +167,13 @@ class shellCacheLine(object):
         return str(self.execs)
 
 class CodeParserCache(MultiProcessCache):
-    cache_file_name = "bb_codeparser.dat"
+    cache_file_name = "bb_codeparser.sqlite3"
     # NOTE: you must increment this if you change how the parsers gather information,
     # so that an existing cache gets invalidated. Additionally you'll need
     # to increment __cache_version__ in cache.py in order to ensure that old
     # recipe caches don't trigger "Taskhash mismatch" errors.
     CACHE_VERSION = 14
+    CACHE_MAX_ENTRIES = 500000
 
     def __init__(self):
         MultiProcessCache.__init__(self)
@@ -203,7 +205,7 @@ class CodeParserCache(MultiProcessCache):
 
     def init_cache(self, cachedir):
         # Check if we already have the caches
-        if self.pythoncache:
+        if self.cachefile:
             return
 
         MultiProcessCache.init_cache(self, cachedir)
@@ -224,6 +226,9 @@ def parser_cache_init(cachedir):
 def parser_cache_save():
     codeparsercache.save_extras()
 
+def parser_cache_flush():
+    codeparsercache.flush_extras()
+
 def parser_cache_savemerge():
     codeparsercache.save_merge()
 
@@ -439,6 +444,18 @@ class ShellParser():
         return self.execs
 
     def _parse_shell(self, value):
+        # Most shell code is handled by the fast scanner, anything else goes
+        # through the full pysh parser
+        try:
+            funcdefs, groups = shellscan.scan(value)
+        except shellscan.Unsupported:
+            pass
+        else:
+            self.funcdefs.update(funcdefs)
+            for words in groups:
+                self.process_words(words)
+            return
+
         try:
             tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
         except Exception:
@@ -518,6 +535,13 @@ class ShellParser():
 
         words = list(words)
         for word in words:
+            # Only command substitutions are of interest, skip the (costly)
+            # word tree for anything else. Words make_wordtree() may reject
+            # (a trailing '$' or an unterminated '${' left by a line
+            # continuation) still go through it.
+            value = word[1]
+            if "`" not in value and "$(" not in value and "${" not in value and not value.endswith("$"):
+                continue
             wtree = pyshlex.make_wordtree(word[1])
             for part in wtree:
                 if not isinstance(part, list):
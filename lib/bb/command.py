@@ -88,6 +88,9 @@ class Command:
             try:
                 if getattr(command_method, 'needconfig', True):
                     self.cooker.updateCacheSync()
+                # Recipe variants can't be parsed underneath a running command
+                if getattr(command_method, 'needvariants', False) and not process_server.get_async_cmd():
+                    self.cooker.parseDeferredVariants()
                 result = command_method(self, commandline)
             except CommandError as exc:
                 return None, exc.args[0]
@@ -123,6 +126,9 @@ class Command:
                     self.cooker.updateCache()
                     return True
                 else:
+                    # Only some commands parse the recipe variants they need
+                    if needcache and not getattr(commandmethod, "lazyvariants", False):
+                        self.cooker.parseDeferredVariants()
                     commandmethod(self.cmds_async, self, options)
                     return False
             else:
@@ -320,6 +326,7 @@ class CommandsSync:
             mc = ''
         return list(command.cooker.recipecaches[mc].pkg_pn.items())
     getRecipes.readonly = True
+    getRecipes.needvariants = True
 
     def getRecipeDepends(self, command, params):
         try:
@@ -328,6 +335,7 @@ class CommandsSync:
             mc = ''
         return list(command.cooker.recipecaches[mc].deps.items())
     getRecipeDepends.readonly = True
+    getRecipeDepends.needvariants = True
 
     def getRecipeVersions(self, command, params):
         try:
@@ -336,6 +344,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].pkg_pepvpr
     getRecipeVersions.readonly = True
+    getRecipeVersions.needvariants = True
 
     def getRecipeProvides(self, command, params):
         try:
@@ -344,6 +353,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].fn_provides
     getRecipeProvides.readonly = True
+    getRecipeProvides.needvariants = True
 
     def getRecipePackages(self, command, params):
         try:
@@ -352,6 +362,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].packages
     getRecipePackages.readonly = True
+    getRecipePackages.needvariants = True
 
     def getRecipePackagesDynamic(self, command, params):
         try:
@@ -360,6 +371,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].packages_dynamic
     getRecipePackagesDynamic.readonly = True
+    getRecipePackagesDynamic.needvariants = True
 
     def getRProviders(self, command, params):
         try:
@@ -368,6 +380,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].rproviders
     getRProviders.readonly = True
+    getRProviders.needvariants = True
 
     def getRuntimeDepends(self, command, params):
         ret = []
@@ -382,6 +395,7 @@ class CommandsSync:
             ret.append((key, value))
         return ret
     getRuntimeDepends.readonly = True
+    getRuntimeDepends.needvariants = True
 
     def getRuntimeRecommends(self, command, params):
         ret = []
@@ -396,6 +410,7 @@ class CommandsSync:
             ret.append((key, value))
         return ret
     getRuntimeRecommends.readonly = True
+    getRuntimeRecommends.needvariants = True
 
     def getRecipeInherits(self, command, params):
         try:
@@ -404,6 +419,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].inherits
     getRecipeInherits.readonly = True
+    getRecipeInherits.needvariants = True
 
     def getBbFilePriority(self, command, params):
         try:
@@ -412,6 +428,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].bbfile_priority
     getBbFilePriority.readonly = True
+    getBbFilePriority.needvariants = True
 
     def getDefaultPreference(self, command, params):
         try:
@@ -420,6 +437,7 @@ class CommandsSync:
             mc = ''
         return command.cooker.recipecaches[mc].pkg_dp
     getDefaultPreference.readonly = True
+    getDefaultPreference.needvariants = True
 
 
     def getSkippedRecipes(self, command, params):
@@ -447,6 +465,7 @@ class CommandsSync:
         skipdict = OrderedDict(sorted(command.cooker.skiplist_by_mc[mc].items(), key=sortkey))
         return list(skipdict.items())
     getSkippedRecipes.readonly = True
+    getSkippedRecipes.needvariants = True
 
     def getOverlayedRecipes(self, command, params):
         try:
@@ -480,11 +499,13 @@ class CommandsSync:
             mc = ''
         return command.cooker.findProviders(mc)
     findProviders.readonly = True
+    findProviders.needvariants = True
 
     def findBestProvider(self, command, params):
         (mc, pn) = bb.runqueue.split_mc(params[0])
         return command.cooker.findBestProvider(pn, mc)
     findBestProvider.readonly = True
+    findBestProvider.needvariants = True
 
     def allProviders(self, command, params):
         try:
@@ -493,6 +514,7 @@ class CommandsSync:
             mc = ''
         return list(bb.providers.allProviders(command.cooker.recipecaches[mc]).items())
     allProviders.readonly = True
+    allProviders.needvariants = True
 
     def getRuntimeProviders(self, command, params):
         rprovide = params[0]
@@ -509,6 +531,7 @@ class CommandsSync:
             best = None
         return all_p, best
     getRuntimeProviders.readonly = True
+    getRuntimeProviders.needvariants = True
 
     def dataStoreConnectorCmd(self, command, params):
         dsindex = params[0]
@@ -638,6 +661,7 @@ class CommandsAsync:
 
         command.cooker.buildTargets(pkgs_to_build, task)
     buildTargets.needcache = True
+    buildTargets.lazyvariants = True
 
     def generateDepTreeEvent(self, command, params):
         """
@@ -649,6 +673,7 @@ class CommandsAsync:
         command.cooker.generateDepTreeEvent(pkgs_to_build, task)
         command.finishAsyncCommand()
     generateDepTreeEvent.needcache = True
+    generateDepTreeEvent.lazyvariants = True
 
     def generateDotGraph(self, command, params):
         """
@@ -660,6 +685,7 @@ class CommandsAsync:
         command.cooker.generateDotGraphFiles(pkgs_to_build, task)
         command.finishAsyncCommand()
     generateDotGraph.needcache = True
+    generateDotGraph.lazyvariants = True
 
     def generateTargetsTree(self, command, params):
         """
@@ -801,11 +827,29 @@ class CommandsAsync:
         taskname = params[1]
         sigs = params[2]
         bb.siggen.check_siggen_version(bb.siggen)
-        res = bb.siggen.find_siginfo(pn, taskname, sigs, command.cooker.databuilder.mcdata[mc])
+        res = bb.siggen.find_siginfo_indexed(pn, taskname, sigs, command.cooker.databuilder.mcdata[mc])
         bb.event.fire(bb.event.FindSigInfoResult(res), command.cooker.databuilder.mcdata[mc])
         command.finishAsyncCommand()
     findSigInfo.needcache = False
 
+    def rebuildSigIndex(self, command, params):
+        """
+        Rebuild the signature index from the signature files the signature
+        generator finds for every task of every recipe
+        """
+        bb.siggen.check_siggen_version(bb.siggen)
+        for mc in command.cooker.recipecaches:
+            d = command.cooker.databuilder.mcdata[mc]
+            index = bb.siggen.SigIndex.from_data(d)
+            index.clear(mc)
+            recipecache = command.cooker.recipecaches[mc]
+            for fn in recipecache.pkg_fn:
+                pn = recipecache.pkg_fn[fn]
+                for taskname in recipecache.task_deps[fn]['tasks']:
+                    bb.siggen.find_siginfo_indexed(pn, taskname, None, d, index)
+        command.finishAsyncCommand()
+    rebuildSigIndex.needcache = True
+
     def getTaskSignatures(self, command, params):
         res = command.cooker.getTaskSignatures(params[0], params[1])
         bb.event.fire(bb.event.GetTaskSignatureResult(res), command.cooker.data)
@@ -0,0 +1,124 @@
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Helper library to implement streaming compression and decompression using a
+# Python module in the current process
+#
+# This library should not be used directly by end users; a wrapper library for
+# the specific compression format should be created
+
+import builtins
+import io
+
+from bb.compress._pipecompress import CompressionError
+
+
+class ModuleFile(io.RawIOBase):
+    """
+    Class that implements generically (de)compressing through a Python module
+
+    It is a drop in replacement for PipeFile which avoids spawning a process
+    for every file. Derived classes should add the functions
+    open_compress(fileobj) and open_decompress(fileobj) that return a writable
+    or readable binary stream wrapping fileobj, and set "errors" to the
+    exceptions the module raises for corrupt data, e.g.:
+
+        class FooFile(ModuleFile):
+            errors = (foo.FooError,)
+
+            def open_decompress(self, fileobj):
+                return foo.FooFile(fileobj, "rb")
+
+            def open_compress(self, fileobj):
+                return foo.FooFile(fileobj, "wb")
+
+    Unlike PipeFile, the stderr argument is accepted but has no effect since
+    there is no process to redirect.
+    """
+
+    READ = 0
+    WRITE = 1
+
+    errors = ()
+
+    def __init__(self, filename=None, mode="rb", *, stderr=None, fileobj=None):
+        if "t" in mode or "U" in mode:
+            raise ValueError("Invalid mode: {!r}".format(mode))
+
+        if not "b" in mode:
+            mode += "b"
+
+        if mode.startswith("r"):
+            self.mode = self.READ
+        elif mode.startswith("w"):
+            self.mode = self.WRITE
+        else:
+            raise ValueError("Invalid mode %r" % mode)
+
+        if fileobj is not None:
+            self.fileobj = fileobj
+        else:
+            self.fileobj = builtins.open(filename, mode or "rb")
+
+        if self.mode == self.READ:
+            self.stream = self.open_decompress(self.fileobj)
+        else:
+            self.stream = self.open_compress(self.fileobj)
+
+        self.__closed = False
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.stream.close()
+        except self.errors as e:
+            raise CompressionError(str(e)) from e
+        finally:
+            self.fileobj.close()
+            self.__closed = True
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def readable(self):
+        return self.mode == self.READ
+
+    def writable(self):
+        return self.mode == self.WRITE
+
+    def readinto(self, b):
+        if self.mode != self.READ:
+            import errno
+
+            raise OSError(
+                errno.EBADF, "read() on write-only %s object" % self.__class__.__name__
+            )
+        try:
+            return self.stream.readinto(b)
+        except self.errors as e:
+            raise CompressionError(str(e)) from e
+
+    def write(self, data):
+        if self.mode != self.WRITE:
+            import errno
+
+            raise OSError(
+                errno.EBADF, "write() on read-only %s object" % self.__class__.__name__
+            )
+        data = memoryview(data)
+        self.stream.write(data)
+        return data.nbytes
@@ -135,9 +135,10 @@ class PipeFile(io.RawIOBase):
             return
 
         returncode = self.p.wait()
+        # Only report the failure once, so close() still closes the file
+        self.p = None
         if returncode:
             raise CompressionError("Process died with %d" % returncode)
-        self.p = None
 
     def close(self):
         if self.closed:
@@ -4,10 +4,18 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import bb.compress._modulecompress
 import bb.compress._pipecompress
 
+try:
+    import lz4.frame as _lz4frame
+except ImportError:
+    _lz4frame = None
+
 
 def open(*args, **kwargs):
+    if _lz4frame is not None:
+        return bb.compress._pipecompress.open_wrap(LZ4ModuleFile, *args, **kwargs)
     return bb.compress._pipecompress.open_wrap(LZ4File, *args, **kwargs)
 
 
@@ -17,3 +25,16 @@ class LZ4File(bb.compress._pipecompress.PipeFile):
 
     def get_decompress(self):
         return ["lz4", "-d", "-c"]
+
+
+class LZ4ModuleFile(bb.compress._modulecompress.ModuleFile):
+    """
+    In process replacement for LZ4File, using the lz4 module
+    """
+    errors = (RuntimeError, EOFError)
+
+    def open_compress(self, fileobj):
+        return _lz4frame.LZ4FrameFile(fileobj, "wb")
+
+    def open_decompress(self, fileobj):
+        return _lz4frame.LZ4FrameFile(fileobj, "rb")
@@ -4,11 +4,26 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import bb.compress._modulecompress
 import bb.compress._pipecompress
+import io
 import shutil
 
+try:
+    # Python 3.14+
+    from compression import zstd as _zstd
+except ImportError:
+    _zstd = None
+
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
 
 def open(*args, **kwargs):
+    if _zstd is not None or _zstandard is not None:
+        return bb.compress._pipecompress.open_wrap(ZstdModuleFile, *args, **kwargs)
     return bb.compress._pipecompress.open_wrap(ZstdFile, *args, **kwargs)
 
 
@@ -28,3 +43,76 @@ class ZstdFile(bb.compress._pipecompress.PipeFile):
 
     def get_decompress(self):
         return self._get_zstd() + ["-d", "-c"]
+
+
+class ZstdModuleFile(bb.compress._modulecompress.ModuleFile):
+    """
+    In process replacement for ZstdFile, using the standard library
+    compression.zstd module if available and the zstandard module otherwise
+    """
+    if _zstd is not None:
+        errors = (_zstd.ZstdError, EOFError)
+    elif _zstandard is not None:
+        errors = (_zstandard.ZstdError, EOFError)
+
+    def __init__(self, *args, num_threads=1, compresslevel=3, **kwargs):
+        self.num_threads = num_threads
+        self.compresslevel = compresslevel
+        super().__init__(*args, **kwargs)
+
+    def open_compress(self, fileobj):
+        if _zstd is not None:
+            options = {_zstd.CompressionParameter.compression_level: self.compresslevel}
+            if self.num_threads > 1:
+                options[_zstd.CompressionParameter.nb_workers] = self.num_threads
+            return _zstd.ZstdFile(fileobj, "wb", options=options)
+
+        threads = self.num_threads if self.num_threads > 1 else 0
+        cctx = _zstandard.ZstdCompressor(level=self.compresslevel, threads=threads)
+        return cctx.stream_writer(fileobj, closefd=False)
+
+    def open_decompress(self, fileobj):
+        if _zstd is not None:
+            return _zstd.ZstdFile(fileobj, "rb")
+
+        return ZstandardReader(fileobj)
+
+
+class ZstandardReader(io.RawIOBase):
+    """
+    Decompresses a stream of zstd frames with the zstandard module. Unlike
+    its stream_reader(), a stream ending in the middle of a frame raises
+    EOFError rather than returning the data decompressed so far.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.dctx = _zstandard.ZstdDecompressor()
+        self.dobj = None
+        self.buffer = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def decompress(self, data):
+        while data:
+            if self.dobj is None or self.dobj.eof:
+                self.dobj = self.dctx.decompressobj()
+            self.buffer += self.dobj.decompress(data)
+            data = self.dobj.unused_data if self.dobj.eof else b""
+
+    def readinto(self, b):
+        while self.offset == len(self.buffer):
+            self.buffer = b""
+            self.offset = 0
+            data = self.fileobj.read(io.DEFAULT_BUFFER_SIZE * 16)
+            if not data:
+                if self.dobj is not None and not self.dobj.eof:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                return 0
+            self.decompress(data)
+
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
@@ -10,6 +10,8 @@
 #
 import enum
 import sys, os, glob, os.path, re, time
+import fnmatch
+import concurrent.futures
 import itertools
 import logging
 from bb import multiprocessing
@@ -17,7 +19,7 @@ import threading
 from io import StringIO, UnsupportedOperation
 from contextlib import closing
 from collections import defaultdict, namedtuple
-import bb, bb.command
+import bb, bb.command, bb.trace
 from bb import utils, data, parse, event, cache, providers, taskdata, runqueue, build
 import queue
 import signal
@@ -141,6 +143,9 @@ class BBCooker:
         self.eventlog = None
         # The skiplists, one per multiconfig
         self.skiplist_by_mc = defaultdict(dict)
+        # BBCLASSEXTEND variants left unparsed, one dict per multiconfig of
+        # filename to (variants, names of the base recipe)
+        self.deferredvariants = defaultdict(dict)
         self.featureset = CookerFeatures()
         if featureSet:
             for f in featureSet:
@@ -189,6 +194,9 @@ class BBCooker:
         self.state = State.INITIAL
 
         self.parser = None
+        self.parserpool = None
+        # Spans merged from the processes of this client's commands, see bb.trace
+        self.trace_events = []
 
         signal.signal(signal.SIGTERM, self.sigterm_exception)
         # Let SIGHUP exit as SIGTERM
@@ -417,6 +425,8 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
                     self._parsecache_set(False)
                     clean = False
                     bb.parse.BBHandler.cached_statements = {}
+                    if self.parserpool:
+                        self.parserpool.clear_statements = True
                     break
 
         # If writes were made to any of the data stores, we need to recalculate the data
@@ -427,6 +437,8 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
     def parseConfiguration(self):
         self.updateCacheSync()
 
+        bb.trace.enable(self.data.getVar("BB_TRACE"), "bitbake-server")
+
         # Change nice level if we're asked to
         nice = self.data.getVar("BB_NICE_LEVEL")
         if nice:
@@ -619,6 +631,189 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
             self.disableDataTracking()
             self.reset()
 
+    def can_defer_variants(self):
+        """
+        Whether BBCLASSEXTEND variants can be left unparsed until the targets
+        of the current command show they're needed, see BB_LAZY_VARIANTS
+        """
+        if not bb.utils.to_boolean(self.data.getVar("BB_LAZY_VARIANTS")):
+            return False
+        cmd = self.process_server.get_async_cmd() if self.process_server else None
+        if not cmd:
+            return False
+        (command, options) = cmd
+        if not getattr(getattr(bb.command.CommandsAsync, command, None), "lazyvariants", False):
+            return False
+        # World and universe builds need every recipe
+        targets = options[0]
+        return "world" not in targets and "universe" not in targets
+
+    def parseDeferredVariants(self, wanted=None):
+        """
+        Parse the BBCLASSEXTEND variants left unparsed, either all of them or
+        those in wanted, a dict per multiconfig of filename to variants.
+        The results are added to the recipe caches and the cache files.
+        """
+        if not any(self.deferredvariants.values()):
+            return
+
+        # The cache files have to have been written
+        self.parser.final_cleanup()
+
+        count = 0
+        for mc in self.multiconfigs:
+            deferred = self.deferredvariants[mc]
+            cache = self.parser.bb_caches[mc]
+            for filename, (variants, names) in list(deferred.items()):
+                if wanted is not None:
+                    toparse = [v for v in variants if v in wanted.get(mc, {}).get(filename, ())]
+                else:
+                    toparse = variants
+                if not toparse:
+                    continue
+
+                appends = self.collections[mc].get_file_appends(filename)
+                priority, _, layername = self.collections[mc].calc_bbfile_priority(filename)
+                try:
+                    infos = cache.parse(filename, appends, layername, toparse)
+                except bb.BBHandledException:
+                    raise
+                except Exception:
+                    logger.error("Unable to parse %s", filename, exc_info=sys.exc_info())
+                    raise bb.BBHandledException()
+                finally:
+                    bb.parse.siggen.postparsing_clean_cache()
+
+                # The cache's own records were discarded when it was saved
+                for virtualfn, info_array in infos:
+                    if info_array[0].skipped:
+                        self.skiplist_by_mc[mc][virtualfn] = SkippedPackage(info_array[0])
+                        continue
+                    _, cls, _ = bb.cache.virtualfn2realfn(virtualfn)
+                    mcfn = bb.cache.realfn2virtual(filename, cls, mc)
+                    self.recipecaches[mc].add_from_recipeinfo(mcfn, info_array)
+                    self.recipecaches[mc].bbfile_priority[mcfn] = priority
+                    self.add_filewatch(info_array[0].file_depends)
+                cache.append_infos(infos)
+                count += len(infos)
+
+                variants = [v for v in variants if v not in toparse]
+                if variants:
+                    deferred[filename] = (variants, names)
+                else:
+                    del deferred[filename]
+
+        if count:
+            parselog.verbnote("Parsed %d deferred recipe variants" % count)
+
+    def parseNeededVariants(self, targets):
+        """
+        Parse the deferred BBCLASSEXTEND variants the targets may need. The
+        dependencies of everything which could provide the targets are
+        followed and matched against the usual names of variants (foo-native,
+        nativesdk-foo, lib32-foo). Should a dependency be left without any
+        provider, every deferred variant is parsed.
+        """
+        if not any(self.deferredvariants.values()):
+            return
+
+        index = defaultdict(set)
+        for mc in self.multiconfigs:
+            for filename, (variants, names) in self.deferredvariants[mc].items():
+                for variant in variants:
+                    ext = variant.split(":")[-1]
+                    for name in names:
+                        prefix = ""
+                        if name.startswith("virtual/"):
+                            prefix, name = "virtual/", name[8:]
+                        for vname in ("%s-%s" % (name, ext), "%s-%s" % (ext, name)):
+                            index[(mc, prefix + vname)].add((filename, variant))
+
+        queue = []
+        seen = set()
+        seenfns = set()
+        missing = set()
+        requested = set()
+        wanted = defaultdict(lambda: defaultdict(set))
+
+        def add_fn(mc, fn):
+            if (mc, fn) in seenfns:
+                return
+            seenfns.add((mc, fn))
+            dataCache = self.recipecaches[mc]
+            for dep in dataCache.deps.get(fn, []):
+                queue.append((mc, dep, True))
+            for pkgdeps in dataCache.rundeps.get(fn, {}).values():
+                for dep in pkgdeps:
+                    queue.append((mc, dep, True))
+            for pkgdeps in dataCache.runrecs.get(fn, {}).values():
+                for dep in pkgdeps:
+                    queue.append((mc, dep, False))
+            task_deps = dataCache.task_deps.get(fn, {})
+            for flag in ('depends', 'rdepends'):
+                for deps in task_deps.get(flag, {}).values():
+                    for dep in deps.split():
+                        queue.append((mc, dep.split(":")[0], True))
+            for deps in task_deps.get('mcdepends', {}).values():
+                for dep in deps.split():
+                    parts = dep.split(":")
+                    if len(parts) == 5 and parts[2] in self.recipecaches:
+                        queue.append((parts[2], parts[3], True))
+
+        def providers(mc, name):
+            dataCache = self.recipecaches[mc]
+            return dataCache.providers.get(name, []) + bb.providers.getRuntimeProviders(dataCache, name)
+
+        for target in targets:
+            mc = ""
+            if target.startswith("mc:") and target.count(":") >= 2:
+                _, mc, target = target.split(":", 2)
+            if mc in self.recipecaches:
+                queue.append((mc, target.split(":do_")[0], True))
+
+        while queue:
+            while queue:
+                mc, name, hard = queue.pop()
+                if (mc, name) in seen:
+                    if hard and (mc, name, False) in missing:
+                        missing.add((mc, name, True))
+                    continue
+                seen.add((mc, name))
+
+                found = providers(mc, name)
+                for fn in found:
+                    add_fn(mc, fn)
+                for filename, variant in index.get((mc, name), ()):
+                    if (mc, filename, variant) not in requested:
+                        requested.add((mc, filename, variant))
+                        wanted[mc][filename].add(variant)
+                if not found and (mc, name) not in index:
+                    missing.add((mc, name, hard))
+
+            if wanted:
+                self.parseDeferredVariants(wanted)
+                for mc in wanted:
+                    for filename, variants in wanted[mc].items():
+                        for variant in variants:
+                            fn = bb.cache.realfn2virtual(filename, variant, mc)
+                            if fn in self.recipecaches[mc].pkg_fn:
+                                add_fn(mc, fn)
+                wanted.clear()
+
+        skipped = defaultdict(set)
+        for mc in self.multiconfigs:
+            for skip in self.skiplist_by_mc[mc].values():
+                skipped[mc].update([skip.pn] + (skip.provides or []) + (skip.rprovides or []))
+
+        for mc, name, hard in missing:
+            if not hard or name in skipped[mc] or providers(mc, name):
+                continue
+            if bb.taskdata.re_match_strings(name, self.recipecaches[mc].ignored_dependencies):
+                continue
+            parselog.debug("No provider for %s found amongst the parsed recipes, parsing all recipe variants" % name)
+            self.parseDeferredVariants()
+            return
+
     def buildTaskData(self, pkgs_to_build, task, halt, allowincomplete=False):
         """
         Prepare a runqueue and taskdata object for iteration over pkgs_to_build
@@ -662,6 +857,7 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
             fulltargetlist.append(defaulttask_implicit)
 
         bb.debug(1,"Target list: %s" % (str(fulltargetlist)))
+        self.parseNeededVariants(fulltargetlist)
         taskdata = {}
         localdata = {}
 
@@ -1310,10 +1506,10 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
         file associated with a recipe might have been modified by the user).
         """
         build.reset_cache()
-        bb.fetch._checksum_cache.mtime_cache.clear()
+        bb.fetch._checksum_cache.stat_cache.clear()
         siggen_cache = getattr(bb.parse.siggen, 'checksum_cache', None)
         if siggen_cache:
-            bb.parse.siggen.checksum_cache.mtime_cache.clear()
+            bb.parse.siggen.checksum_cache.stat_cache.clear()
 
     def matchFiles(self, bf, mc=''):
         """
@@ -1387,7 +1583,7 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
         self.buildSetVars()
         self.reset_mtime_caches()
 
-        bb_caches = bb.cache.MulticonfigCache(self.databuilder, self.databuilder.data_hash, self.caches_array)
+        bb_caches = bb.cache.MulticonfigCache(self.databuilder, self.databuilder.cache_hash, self.caches_array)
 
         layername = self.collections[mc].calc_bbfile_priority(fn)[2]
         infos = bb_caches[mc].parse(fn, self.collections[mc].get_file_appends(fn), layername)
@@ -1468,6 +1664,7 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
                 return bb.server.process.idleFinish(str(exc))
 
             if not retval:
+                self.write_trace()
                 if fireevents:
                     bb.event.fire(bb.event.BuildCompleted(len(rq.rqdata.runtaskentries), buildname, item, failures, interrupted), self.databuilder.mcdata[mc])
                     bb.event.disable_heartbeat()
@@ -1540,6 +1737,7 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
                 return bb.server.process.idleFinish(str(exc))
 
             if not retval:
+                self.write_trace()
                 try:
                     for mc in self.multiconfigs:
                         bb.event.fire(bb.event.BuildCompleted(len(rq.rqdata.runtaskentries), buildname, targets, failures, interrupted), self.databuilder.mcdata[mc])
@@ -1689,8 +1887,11 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
             self.state = State.RUNNING
 
             # Send an event listing all stamps reachable after parsing
-            # which the metadata may use to clean up stale data
+            # which the metadata may use to clean up stale data. The stamps
+            # of any deferred variants aren't known so nothing is sent.
             for mc in self.multiconfigs:
+                if self.deferredvariants[mc]:
+                    continue
                 event = bb.event.ReachableStamps(self.recipecaches[mc].stamp)
                 bb.event.fire(event, self.databuilder.mcdata[mc])
             return None
@@ -1713,6 +1914,9 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
                 pkgs_to_build.remove(pkg)
                 pkgs_to_build.append(pkg.replace("multiconfig:", "mc:"))
 
+        if 'world' in pkgs_to_build or 'universe' in pkgs_to_build:
+            self.parseDeferredVariants()
+
         if 'world' in pkgs_to_build:
             pkgs_to_build.remove('world')
             for mc in self.multiconfigs:
@@ -1768,6 +1972,10 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
             self.parser.shutdown(clean=False)
             self.parser.final_cleanup()
 
+        if force and self.parserpool:
+            self.parserpool.shutdown()
+            self.parserpool = None
+
     def finishcommand(self):
         if hasattr(self.parser, 'shutdown'):
             self.parser.shutdown(clean=False)
@@ -1782,9 +1990,20 @@ You can also remove the BB_HASHSERVE_UPSTREAM setting, but this may result in si
         self.initConfigurationData()
         self.handlePRServ()
 
+    def write_trace(self):
+        """
+        Merge the spans recorded since the last call into the BB_TRACE file,
+        which covers all the commands of the current client
+        """
+        if bb.trace.tracer:
+            self.trace_events.extend(bb.trace.collect())
+            bb.trace.write(self.trace_events)
+
     def clientComplete(self):
         """Called when the client is done using the server"""
         self.finishcommand()
+        self.write_trace()
+        self.trace_events = []
         self.extraconfigdata = {}
         self.command.reset()
         if hasattr(self, "data"):
@@ -1803,6 +2022,108 @@ class CookerExit(bb.event.Event):
         bb.event.Event.__init__(self)
 
 
+class DirectoryListings(object):
+    """
+    Expands BBFILES entries using directory listings which are kept between
+    runs, validated against the same directory mtimes the cooker watches for
+    changes. Each expansion also returns the directories it searched.
+    """
+
+    def __init__(self, config):
+        self.cache = bb.cache.SimpleCache("1")
+        self.listings = self.cache.init_cache(config, "bb_dirlistings.dat", {})
+        self.used = set()
+        self.changed = False
+
+    def listdir(self, path):
+        """
+        Return a list of (name, isdir, islink) for the entries in the
+        directory path, or None if it isn't a directory
+        """
+        path = os.path.abspath(path)
+        self.used.add(path)
+        mtime = bb.parse.cached_mtime_noerror(path)
+        if not mtime:
+            return None
+        cached = self.listings.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        entries = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        isdir = entry.is_dir()
+                    except OSError:
+                        isdir = False
+                    entries.append((entry.name, isdir, entry.is_symlink()))
+        except OSError:
+            return None
+        # A directory changed again within the resolution of its timestamp
+        # wouldn't be noticed, so recently modified directories aren't kept
+        if time.time_ns() - mtime[0] > 2000000000:
+            self.listings[path] = (mtime, entries)
+            self.changed = True
+        return entries
+
+    def glob(self, pattern, searched, dironly=False):
+        """
+        Return the paths matching pattern in the same way as glob.glob()
+        """
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            if (dironly and os.path.isdir(pattern)) or (not dironly and os.path.lexists(pattern)):
+                return [pattern]
+            return []
+
+        if dirname != pattern and glob.has_magic(dirname):
+            dirs = self.glob(dirname, searched, True)
+        else:
+            dirs = [dirname]
+
+        results = []
+        for d in dirs:
+            if not glob.has_magic(basename):
+                path = os.path.join(d, basename)
+                if (dironly and os.path.isdir(path)) or (not dironly and os.path.lexists(path)):
+                    results.append(path)
+                continue
+            searched.append(d or os.curdir)
+            entries = self.listdir(d or os.curdir) or []
+            names = [name for name, isdir, _ in entries if isdir or not dironly]
+            if not basename.startswith("."):
+                names = [name for name in names if not name.startswith(".")]
+            results.extend(os.path.join(d, name) for name in fnmatch.filter(names, basename))
+        return results
+
+    def walk(self, path, searched):
+        """
+        Return the .bb and .bbappend files under path in the same order as
+        a search using os.walk()
+        """
+        searched.append(path)
+        found = []
+        subdirs = []
+        for name, isdir, islink in self.listdir(path) or []:
+            if isdir:
+                if not islink and name not in ('SCCS', 'CVS', '.svn'):
+                    subdirs.append(name)
+            elif name.endswith(('.bb', '.bbappend')):
+                found.append(os.path.join(path, name))
+        for name in subdirs:
+            found += self.walk(os.path.join(path, name), searched)
+        return found
+
+    def save(self):
+        if not self.changed:
+            return
+        # Drop the listings of directories which no longer exist
+        for path in list(self.listings):
+            if path not in self.used and not os.path.isdir(path):
+                del self.listings[path]
+        self.cache.save(self.listings)
+
 class CookerCollectFiles(object):
     def __init__(self, priorities, mc=''):
         self.mc = mc
@@ -1828,16 +2149,23 @@ class CookerCollectFiles(object):
                 bbfiles.append(os.path.abspath(os.path.join(path, f)))
         return bbfiles
 
-    def find_bbfiles(self, path):
+    def find_bbfiles(self, path, listings, searched):
         """Find all the .bb and .bbappend files in a directory"""
-        found = []
-        for dir, dirs, files in os.walk(path):
-            for ignored in ('SCCS', 'CVS', '.svn'):
-                if ignored in dirs:
-                    dirs.remove(ignored)
-            found += [os.path.join(dir, f) for f in files if (f.endswith(('.bb', '.bbappend')))]
+        return listings.walk(path, searched)
 
-        return found
+    def expand_bbfiles(self, f, listings):
+        """
+        Return the files matched by the BBFILES entry f and the directories
+        searched for them
+        """
+        searched = []
+        if os.path.isdir(f):
+            return self.find_bbfiles(f, listings, searched), searched
+        globbed = listings.glob(f, searched)
+        if not globbed and os.path.exists(f):
+            globbed = [f]
+        # glob gives files in order on disk. Sort to be deterministic.
+        return sorted(globbed), searched
 
     def collect_bbfiles(self, config, eventdata):
         """Collect all available .bb build files"""
@@ -1858,46 +2186,24 @@ class CookerCollectFiles(object):
             collectlog.error("no recipe files to build, check your BBPATH and BBFILES?")
             bb.event.fire(CookerExit(), eventdata)
 
-        # We need to track where we look so that we can know when the cache is invalid. There
-        # is no nice way to do this, this is horrid. We intercept the os.listdir() and os.scandir()
-        # calls while we run glob().
-        origlistdir = os.listdir
-        if hasattr(os, 'scandir'):
-            origscandir = os.scandir
-        searchdirs = []
-
-        def ourlistdir(d):
-            searchdirs.append(d)
-            return origlistdir(d)
+        # We need to track where we look so that we can know when the cache is invalid.
+        # The entries are expanded in parallel as the time is spent waiting on the
+        # filesystem, particularly for layers on network storage.
+        listings = DirectoryListings(config)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(files), 8) or 1) as executor:
+            expanded = list(executor.map(lambda f: self.expand_bbfiles(f, listings), files))
+        listings.save()
 
-        def ourscandir(d):
-            searchdirs.append(d)
-            return origscandir(d)
-
-        os.listdir = ourlistdir
-        if hasattr(os, 'scandir'):
-            os.scandir = ourscandir
-        try:
-            # Can't use set here as order is important
-            newfiles = []
-            for f in files:
-                if os.path.isdir(f):
-                    dirfiles = self.find_bbfiles(f)
-                    for g in dirfiles:
-                        if g not in newfiles:
-                            newfiles.append(g)
-                else:
-                    globbed = glob.glob(f)
-                    if not globbed and os.path.exists(f):
-                        globbed = [f]
-                    # glob gives files in order on disk. Sort to be deterministic.
-                    for g in sorted(globbed):
-                        if g not in newfiles:
-                            newfiles.append(g)
-        finally:
-            os.listdir = origlistdir
-            if hasattr(os, 'scandir'):
-                os.scandir = origscandir
+        # Can't use set here as order is important
+        newfiles = []
+        seen = set()
+        searchdirs = []
+        for found, searched in expanded:
+            for g in found:
+                if g not in seen:
+                    seen.add(g)
+                    newfiles.append(g)
+            searchdirs.extend(searched)
 
         bbmask = config.getVar('BBMASK')
 
@@ -2040,8 +2346,19 @@ class ParsingFailure(Exception):
         Exception.__init__(self, realexception, recipe)
 
 class Parser(multiprocessing.Process):
-    def __init__(self, jobs, next_job_id, results, quit, profile):
+    # Upper bound on the number of jobs claimed in one go
+    max_chunk = 16
+    # Shards are written per generation so a new set is used for each parse
+    generation = 0
+    # Record a ParseProfile, set from BB_PARSE_PROFILE
+    parseprofile = False
+
+    def __init__(self, jobs, costs, num_processes, next_job_id, results, quit, profile):
         self.jobs = jobs
+        self.costs = costs
+        # Estimated cost of all the jobs from a given index to the end of the list
+        self.remaining = list(itertools.accumulate(reversed(costs)))[::-1]
+        self.num_processes = num_processes
         self.next_job_id = next_job_id
         self.results = results
         self.quit = quit
@@ -2053,6 +2370,7 @@ class Parser(multiprocessing.Process):
         self.signal_received = []
         self.signal_threadlock = threading.Lock()
         self.exit = False
+        self.shards = {}
 
     def catch_sig(self, signum, frame):
         if self.queue_signals:
@@ -2083,40 +2401,86 @@ class Parser(multiprocessing.Process):
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
         signal.signal(signal.SIGINT, self.catch_sig)
         bb.utils.set_process_name(multiprocessing.current_process().name)
+        bb.trace.rename(multiprocessing.current_process().name)
         multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
+        if self.parseprofile:
+            bb.parse.parse_profile = bb.parse.ParseProfile()
+
+        try:
+            self.parse_jobs()
+        finally:
+            for shard in self.shards.values():
+                shard.close()
+            self.results.close()
+            self.results.join_thread()
 
+    def parse_jobs(self):
         pending = []
+        chunk = []
         havejobs = True
-        try:
-            while (havejobs or pending) and not self.exit:
-                if self.quit.is_set():
-                    break
+        while (havejobs or chunk or pending) and not self.exit:
+            if self.quit.is_set():
+                break
 
-                job = None
-                if havejobs:
-                    with self.next_job_id.get_lock():
-                        if self.next_job_id.value < len(self.jobs):
-                            job = self.jobs[self.next_job_id.value]
-                            self.next_job_id.value += 1
-                        else:
-                            havejobs = False
+            job = None
+            if havejobs and not chunk:
+                chunk = self.claim_jobs()
+                if not chunk:
+                    havejobs = False
 
-                if job:
-                    result = self.parse(*job)
-                    # Clear the siggen cache after parsing to control memory usage, its huge
-                    bb.parse.siggen.postparsing_clean_cache()
-                    pending.append(result)
+            if chunk:
+                job = self.jobs[chunk.pop(0)]
 
-                if pending:
-                    try:
-                        result = pending.pop()
-                        self.results.put(result, timeout=0.05)
-                    except queue.Full:
-                        pending.append(result)
-        finally:
-            self.results.close()
-            self.results.join_thread()
+            if job:
+                result = self.parse(*job)
+                # Clear the siggen cache after parsing to control memory usage, its huge
+                bb.parse.siggen.postparsing_clean_cache()
+                pending.append(result)
+
+            # Results must be sent in the order they were written to the shards
+            if pending:
+                try:
+                    result = pending.pop(0)
+                    self.results.put(result, timeout=0.05)
+                except queue.Full:
+                    pending.insert(0, result)
+
+        statementcache = bb.parse.statementcache
+        parselog.debug("Statement cache: %d hits, %d misses" % (statementcache.hits, statementcache.misses))
+        dependencycache = bb.data.dependency_cache
+        parselog.debug("Dependency cache: %d hits, %d misses" % (dependencycache.hits, dependencycache.misses))
+
+        # The cooker merges the profiles of all the parsers into its report
+        if bb.parse.parse_profile:
+            bb.parse.parse_profile.statementcache = [statementcache.hits, statementcache.misses]
+            bb.parse.parse_profile.dependencycache = [dependencycache.hits, dependencycache.misses]
+            bb.parse.parse_profile.save("parse-profile-%s.json" % multiprocessing.current_process().name)
+            bb.parse.parse_profile = bb.parse.ParseProfile()
+        statementcache.hits = statementcache.misses = 0
+        dependencycache.hits = dependencycache.misses = 0
+        bb.trace.flush()
+
+    def claim_jobs(self):
+        """
+        Claim the next chunk of job indexes. The job list is ordered most
+        expensive first, so the chunk is sized against a fraction of the
+        estimated cost still remaining. Expensive recipes are therefore handed
+        out one at a time while the cheap recipes at the end of the list are
+        claimed several at a time, reducing traffic on the shared lock.
+        """
+        with self.next_job_id.get_lock():
+            start = self.next_job_id.value
+            if start >= len(self.jobs):
+                return []
+            target = self.remaining[start] / (self.num_processes * 4)
+            end = start + 1
+            cost = self.costs[start]
+            while end < len(self.jobs) and end - start < self.max_chunk and cost + self.costs[end] <= target:
+                cost += self.costs[end]
+                end += 1
+            self.next_job_id.value = end
+        return list(range(start, end))
 
     def parse(self, mc, cache, filename, appends, layername):
         try:
@@ -2132,7 +2496,13 @@ class Parser(multiprocessing.Process):
             bb.event.set_class_handlers(self.handlers.copy())
             bb.event.LogHandler.filter = parse_filter
 
-            return True, mc, cache.parse(filename, appends, layername)
+            with bb.trace.span("parse", "parse", fn=filename):
+                infos = cache.parse(filename, appends, layername)
+            # Write the results to a shard in the cache file format and only pass
+            # the location of the records back to the main process
+            if mc not in self.shards:
+                self.shards[mc] = bb.cache.CacheShard(cache, self.generation)
+            return True, mc, self.shards[mc].write(infos)
         except Exception as exc:
             tb = sys.exc_info()[2]
             exc.recipe = filename
@@ -2145,6 +2515,149 @@ class Parser(multiprocessing.Process):
         finally:
             bb.event.LogHandler.filter = origfilter
 
+class PoolParser(Parser):
+    """
+    Parser process which stays alive between parses so that its statement,
+    codeparser and inherit caches stay warm, see ParserPool
+    """
+    def __init__(self, caches, cfgdata, sessions, num_processes, next_job_id, results, quit, profile):
+        Parser.__init__(self, [], [], num_processes, next_job_id, results, quit, profile)
+        self.caches = caches
+        self.cfgdata = cfgdata
+        self.sessions = sessions
+
+    def parse_jobs(self):
+        # Only the parsing side of the caches is needed, not the loaded cache data
+        for cache in self.caches.values():
+            cache.depends_cache = {}
+
+        while not self.exit and not self.quit.is_set():
+            try:
+                jobs, costs, clear_statements, defervariants = self.sessions.get(timeout=0.25)
+            except queue.Empty:
+                continue
+
+            self.start_session(jobs, costs, clear_statements, defervariants)
+            Parser.parse_jobs(self)
+
+            # Hand the cache data gathered so far to the main process to merge
+            bb.codeparser.parser_cache_flush()
+            bb.fetch.fetcher_parse_flush()
+            self.results.put(None)
+
+    def start_session(self, jobs, costs, clear_statements, defervariants):
+        # The main process adds the previous shards to the cache
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+        self.generation += 1
+
+        for cache in self.caches.values():
+            cache.defervariants = defervariants
+        self.jobs = [(mc, self.caches[mc], filename, appends, layername) for mc, filename, appends, layername in jobs]
+        self.costs = costs
+        self.remaining = list(itertools.accumulate(reversed(costs)))[::-1]
+
+        bb.parse.clear_cache()
+        if clear_statements:
+            bb.parse.BBHandler.cached_statements = {}
+        if self.generation > 1:
+            bb.parse.siggen.reset(self.cfgdata)
+
+class ParserPool(object):
+    """
+    Parser processes held by the cooker between parses when BB_PERSISTENT_PARSERS
+    is set. The processes are forked with the base configuration so the pool
+    is only valid while the configuration hash is unchanged. Each parse sends
+    the parsers a session with the list of recipes to reparse.
+    """
+    def __init__(self, cooker, caches, cfghash, num_processes):
+        self.cfghash = cfghash
+        self.cachenames = [cache_class.__name__ for cache_class in cooker.caches_array]
+        self.next_job_id = multiprocessing.Value(ctypes.c_int, 0)
+        self.quit = multiprocessing.Event()
+        self.results = multiprocessing.Queue()
+        # Set when files the parsers may have cached statements for change
+        self.clear_statements = False
+        self.processes = []
+        self.sessions = []
+
+        for i in range(0, num_processes):
+            sessions = multiprocessing.Queue()
+            parser = PoolParser(caches, cooker.data, sessions, num_processes, self.next_job_id, self.results, self.quit, cooker.configuration.profile)
+            parser.parseprofile = bb.utils.to_boolean(cooker.data.getVar("BB_PARSE_PROFILE"))
+            parser.start()
+            self.sessions.append(sessions)
+            self.processes.append(parser)
+
+    def valid(self, cfghash, caches_array):
+        if cfghash != self.cfghash:
+            return False
+        if [cache_class.__name__ for cache_class in caches_array] != self.cachenames:
+            return False
+        return all(process.is_alive() for process in self.processes)
+
+    def start_session(self, willparse, costs, defervariants):
+        self.next_job_id.value = 0
+        jobs = [(mc, filename, appends, layername) for mc, _, filename, appends, layername in willparse]
+        for sessions in self.sessions:
+            sessions.put((jobs, costs, self.clear_statements, defervariants))
+        self.clear_statements = False
+
+    def finish_session(self, done):
+        """
+        Wait for all the parsers to finish the session, given the number which
+        have already reported back. Returns False if a parser exited.
+        """
+        while done < len(self.processes):
+            try:
+                result = self.results.get(timeout=0.25)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    return False
+                continue
+            if result is None:
+                done += 1
+        return True
+
+    def shutdown(self):
+        stop_parsers(self.processes, self.quit, self.results)
+
+def stop_parsers(processes, quit, results):
+    # Cleanup the queue before call process.join(), otherwise there might be
+    # deadlocks.
+    def read_results():
+        while True:
+            try:
+               results.get(timeout=0.25)
+            except queue.Empty:
+                break
+
+    quit.set()
+
+    read_results()
+
+    for process in processes:
+        process.join(2)
+
+    for process in processes:
+        if process.exitcode is None:
+            os.kill(process.pid, signal.SIGINT)
+
+    read_results()
+
+    for process in processes:
+        process.join(2)
+
+    for process in processes:
+        if process.exitcode is None:
+            process.terminate()
+
+    for process in processes:
+        process.join()
+        # clean up zombies
+        process.close()
+
 class CookerParser(object):
     def __init__(self, cooker, mcfilelist, masked):
         self.mcfilelist = mcfilelist
@@ -2165,7 +2678,11 @@ class CookerParser(object):
         self.current = 0
         self.process_names = []
 
-        self.bb_caches = bb.cache.MulticonfigCache(self.cfgbuilder, self.cfghash, cooker.caches_array)
+        self.bb_caches = bb.cache.MulticonfigCache(self.cfgbuilder, cooker.databuilder.cache_hash, cooker.caches_array)
+        self.defervariants = cooker.can_defer_variants()
+        for mc in self.cooker.multiconfigs:
+            self.bb_caches[mc].defervariants = self.defervariants
+            self.cooker.deferredvariants[mc] = {}
         self.fromcache = set()
         self.willparse = []
         for mc in self.cooker.multiconfigs:
@@ -2177,14 +2694,32 @@ class CookerParser(object):
                 else:
                     self.fromcache.add((mc, self.bb_caches[mc], filename, appends, layername))
 
+        # Parse the recipes which took longest last time first so that they
+        # don't end up running alone at the end of parsing
+        self.parsetime_cache = bb.cache.SimpleCache("1")
+        parsetimes = self.parsetime_cache.init_cache(self.cfgdata, "bb_parsetimes.dat", {})
+        self.parsetimes = {}
+        for mc, _, filename, _, _ in itertools.chain(self.willparse, self.fromcache):
+            if (mc, filename) in parsetimes:
+                self.parsetimes[(mc, filename)] = parsetimes[(mc, filename)]
+        known = [self.parsetimes[(job[0], job[2])] for job in self.willparse if (job[0], job[2]) in self.parsetimes]
+        default_cost = sum(known) / len(known) if known else 1.0
+        self.willparse.sort(key=lambda job: self.parsetimes.get((job[0], job[2]), default_cost), reverse=True)
+        self.jobcosts = [self.parsetimes.get((job[0], job[2]), default_cost) for job in self.willparse]
+        self.tailstart = None
+        self.tailtime = 0
+
         self.total = len(self.fromcache) + len(self.willparse)
         self.toparse = len(self.willparse)
         self.progress_chunk = int(max(self.toparse / 100, 1))
 
         self.num_processes = min(int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS") or
                                  multiprocessing.cpu_count()), self.toparse)
+        self.parseprofile = bb.utils.to_boolean(self.cfgdata.getVar("BB_PARSE_PROFILE"))
+        self.statementcachesize = int(self.cfgdata.getVar("BB_STATEMENT_CACHE_SIZE") or 256) * 1024 * 1024
 
         bb.cache.SiggenRecipeInfo.reset()
+        self.tracestart = time.monotonic_ns()
         self.start()
         self.haveshutdown = False
         self.syncthread = None
@@ -2192,18 +2727,42 @@ class CookerParser(object):
     def start(self):
         self.results = self.load_cached()
         self.processes = []
+        self.pool = None
+        self.sessions_done = 0
 
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
 
-            next_job_id = multiprocessing.Value(ctypes.c_int, 0)
+            pool = self.cooker.parserpool
+            if pool and not pool.valid(self.cfghash, self.cooker.caches_array):
+                parselog.debug("Base configuration changed, stopping parser pool")
+                pool.shutdown()
+                self.cooker.parserpool = pool = None
+            if not pool and bb.utils.to_boolean(self.cfgdata.getVar("BB_PERSISTENT_PARSERS")):
+                num_processes = int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS") or multiprocessing.cpu_count())
+                pool = ParserPool(self.cooker, self.bb_caches, self.cfghash, num_processes)
+                self.cooker.parserpool = pool
+
+            if pool:
+                self.pool = pool
+                self.next_job_id = pool.next_job_id
+                self.parser_quit = pool.quit
+                self.result_queue = pool.results
+                self.processes = list(pool.processes)
+                self.process_names = [parser.name for parser in pool.processes]
+                pool.start_session(self.willparse, self.jobcosts, self.defervariants)
+                self.results = itertools.chain(self.results, self.parse_generator())
+                return
+
+            self.next_job_id = multiprocessing.Value(ctypes.c_int, 0)
             self.parser_quit = multiprocessing.Event()
             self.result_queue = multiprocessing.Queue()
 
             # Have to pass in willparse at fork time so all parsing processes have the unpickleable data
             # then access it by index from the parse queue.
             for i in range(0, self.num_processes):
-                parser = Parser(self.willparse, next_job_id, self.result_queue, self.parser_quit, self.cooker.configuration.profile)
+                parser = Parser(self.willparse, self.jobcosts, self.num_processes, self.next_job_id, self.result_queue, self.parser_quit, self.cooker.configuration.profile)
+                parser.parseprofile = self.parseprofile
                 parser.start()
                 self.process_names.append(parser.name)
                 self.processes.append(parser)
@@ -2218,63 +2777,40 @@ class CookerParser(object):
         self.haveshutdown = True
 
         if clean:
+            if self.tailstart is not None:
+                self.tailtime = time.monotonic() - self.tailstart
+                parselog.debug("Parsing tail: %.2fs between all recipes being handed out and parsing completing" % self.tailtime)
             event = bb.event.ParseCompleted(self.cached, self.parsed,
                                             self.skipped, self.masked,
                                             self.virtuals, self.error,
-                                            self.total)
+                                            self.total, self.tailtime)
 
             bb.event.fire(event, self.cfgdata)
         else:
             bb.event.fire(bb.event.ParseError(eventmsg), self.cfgdata)
             bb.error("Parsing halted due to errors, see error messages above")
 
-        # Cleanup the queue before call process.join(), otherwise there might be
-        # deadlocks.
-        def read_results():
-            while True:
-                try:
-                   self.result_queue.get(timeout=0.25)
-                except queue.Empty:
-                    break
-                except KeyError:
-                    # The restore state from SiggenRecipeInfo in cache.py can
-                    # fail here if this is an unclean shutdown since the state may have been
-                    # reset. Ignore key errors for that reason, we don't care.
-                    pass
-
         def sync_caches():
             for c in self.bb_caches.values():
                 bb.cache.SiggenRecipeInfo.reset()
-                c.sync()
-
+                with bb.trace.span("Cache.sync", "parse", mc=c.mc, shards=len(c.shards)):
+                    c.sync()
+            if clean:
+                self.parsetime_cache.save(self.parsetimes)
+            if clean and self.toparse:
+                bb.parse.statementcache.prune(self.statementcachesize)
+
+        # A pool of parsers is kept for the next parse if they all finished
+        # cleanly, otherwise they're stopped like any other parsers
+        if not (clean and self.pool and self.pool.finish_session(self.sessions_done)):
+            if self.pool:
+                self.cooker.parserpool = None
+            stop_parsers(self.processes, self.parser_quit, self.result_queue)
+
+        # The parser shards are added to the cache so the parsers must be done with them
         self.syncthread = threading.Thread(target=sync_caches, name="SyncThread")
         self.syncthread.start()
 
-        self.parser_quit.set()
-
-        read_results()
-
-        for process in self.processes:
-            process.join(2)
-
-        for process in self.processes:
-            if process.exitcode is None:
-                os.kill(process.pid, signal.SIGINT)
-
-        read_results()
-
-        for process in self.processes:
-            process.join(2)
-
-        for process in self.processes:
-            if process.exitcode is None:
-                process.terminate()
-
-        for process in self.processes:
-            process.join()
-            # clean up zombies
-            process.close()
-
         bb.codeparser.parser_cache_save()
         bb.codeparser.parser_cache_savemerge()
         bb.cache.SiggenRecipeInfo.reset()
@@ -2290,6 +2826,21 @@ class CookerParser(object):
                 fn_out = "profile-parse.log.report"
                 bb.utils.process_profilelog(profiles, fn_out=fn_out)
                 print("Processed parsing statistics saved to %s" % (fn_out))
+        if clean and self.parseprofile:
+            self.write_parse_profile()
+        bb.trace.add_span("CookerParser", "parse", self.tracestart, parsed=self.parsed, cached=self.cached, skipped=self.skipped)
+        if clean:
+            self.cooker.write_trace()
+
+    def write_parse_profile(self):
+        profile = bb.parse.ParseProfile()
+        for name in self.process_names:
+            logfile = "parse-profile-%s.json" % name
+            if os.path.exists(logfile):
+                profile.merge(logfile)
+                os.unlink(logfile)
+        profile.write_report("parse-profile.json", "parse-profile.txt")
+        parselog.info("Parse profile saved to %s and %s" % (os.path.abspath("parse-profile.txt"), os.path.abspath("parse-profile.json")))
 
     def final_cleanup(self):
         if self.syncthread:
@@ -2318,6 +2869,10 @@ class CookerParser(object):
                 yield None, None, None
             else:
                 empty = False
+                if result is None:
+                    # A pool parser has finished its part of this parse
+                    self.sessions_done += 1
+                    continue
                 yield result
 
         if not (self.parsed >= self.toparse):
@@ -2335,6 +2890,8 @@ class CookerParser(object):
             if parsed is None:
                 # Timeout, loop back through the main loop
                 return True
+            if parsed:
+                result = self.bb_caches[mc].load_shard(*result)
 
         except StopIteration:
             self.shutdown()
@@ -2398,6 +2955,8 @@ class CookerParser(object):
         self.virtuals += len(result)
         if parsed:
             self.parsed += 1
+            if self.tailstart is None and self.next_job_id.value >= self.toparse:
+                self.tailstart = time.monotonic()
             if self.parsed % self.progress_chunk == 0:
                 bb.event.fire(bb.event.ParseProgress(self.parsed, self.toparse),
                               self.cfgdata)
@@ -2405,13 +2964,34 @@ class CookerParser(object):
             self.cached += 1
 
         for virtualfn, info_array in result:
+            if parsed and info_array[0].parsetime:
+                self.parsetimes[(mc, virtualfn)] = info_array[0].parsetime
             if info_array[0].skipped:
                 self.skipped += 1
                 self.cooker.skiplist_by_mc[mc][virtualfn] = SkippedPackage(info_array[0])
             self.bb_caches[mc].add_info(virtualfn, info_array, self.cooker.recipecaches[mc],
                                         parsed=parsed, watcher = self.cooker.add_filewatch)
+        self.record_deferred(mc, result)
         return True
 
+    def record_deferred(self, mc, infos):
+        """
+        Note the variants of a recipe which were left unparsed and aren't
+        cached, along with the names of the base recipe to find them by
+        """
+        fns = set(virtualfn for virtualfn, _ in infos)
+        for virtualfn, info_array in infos:
+            info = info_array[0]
+            if not info.deferred_variants:
+                continue
+            variants = [v for v in info.deferred_variants if bb.cache.variant2virtual(virtualfn, v) not in fns]
+            if not variants:
+                continue
+            names = [info.pn] + info.provides + info.packages + info.rprovides
+            for package in info.packages:
+                names += info.rprovides_pkg[package]
+            self.cooker.deferredvariants[mc][virtualfn] = (variants, names)
+
     def reparse(self, filename):
         bb.cache.SiggenRecipeInfo.reset()
         to_reparse = set()
@@ -2423,3 +3003,5 @@ class CookerParser(object):
             infos = self.bb_caches[mc].parse(filename, appends, layername)
             for vfn, info_array in infos:
                 self.cooker.recipecaches[mc].add_from_recipeinfo(vfn, info_array)
+            self.cooker.deferredvariants[mc].pop(filename, None)
+            self.record_deferred(mc, infos)
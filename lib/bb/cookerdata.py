@@ -15,6 +15,7 @@ import os
 import re
 import sys
 import hashlib
+import pickle
 from functools import wraps
 import bb
 from bb import data
@@ -185,6 +186,17 @@ def _inherit(bbclass, data):
     bb.parse.BBHandler.inherit(bbclass, "configuration INHERITs", 0, data)
     return data
 
+def _register_handlers(data):
+    # Normally we only register event handlers at the end of parsing .bb files
+    # We register any handlers we've found so far here...
+    for var in data.getVar('__BBHANDLERS', False) or []:
+        handlerfn = data.getVarFlag(var, "filename", False)
+        if not handlerfn:
+            parselog.critical("Undefined event handler function '%s'" % var)
+            raise bb.BBHandledException()
+        handlerln = int(data.getVarFlag(var, "lineno", False))
+        bb.event.register(var, data.getVar(var, False),  (data.getVarFlag(var, "eventmask") or "").split(), handlerfn, handlerln, data)
+
 def findConfigFile(configfile, data):
     search = []
     bbpath = data.getVar("BBPATH")
@@ -220,7 +232,111 @@ def findTopdir():
 
     return os.path.abspath(os.getcwd())
 
+class ConfigSnapshot(object):
+    """
+    A datastore returned by CookerDataBuilder.parseConfigurationFiles(),
+    saved when BB_CACHE_BASECONFIG is set so that later invocations can
+    restore it rather than parsing the configuration again. There is one
+    snapshot per multiconfig, build directory and set of prefiles and
+    postfiles under BB_CACHEDIR if it is set in the environment and
+    ${TOPDIR}/cache otherwise. A snapshot is only used when the environment,
+    the parser and every file looked up while parsing are unchanged. The event
+    handlers and the calls recorded while parsing are replayed by the caller
+    and the ConfigParsed event is fired as usual.
+    """
+    version = "1"
+
+    def __init__(self, basedata, prefiles, postfiles, mc, tracking):
+        self.fn = None
+        self.exists = False
+        self.basedata = basedata
+        self._key = None
+        # The filters need to see the files being parsed
+        if bb.parse.ConfHandler.confFilters:
+            return
+        layerconf = findConfigFile("bblayers.conf", basedata)
+        cachedir = basedata.getVar("BB_CACHEDIR")
+        if not cachedir:
+            origenv = basedata.getVar("BB_ORIGENV", False)
+            cachedir = origenv.getVar("BB_CACHEDIR") if origenv else None
+        if not cachedir:
+            if layerconf:
+                topdir = os.path.dirname(os.path.dirname(layerconf))
+            else:
+                topdir = os.getcwd()
+            cachedir = os.path.join(topdir, "cache")
+
+        snapshot = repr((mc, layerconf, list(prefiles), list(postfiles), tracking))
+        snapshot = hashlib.sha256(snapshot.encode("utf-8")).hexdigest()[:16]
+        self.fn = os.path.join(cachedir, "bb_baseconfig", snapshot + ".dat")
+
+    @property
+    def key(self):
+        # Only worked out when a snapshot is loaded or saved, as it needs a
+        # copy of the base datastore
+        if self._key is None:
+            version = [self.version, bb.__version__]
+            for module in (__file__, bb.data_smart.__file__, bb.parse.ast.__file__, bb.parse.ConfHandler.__file__, bb.parse.BBHandler.__file__):
+                version.append(bb.parse.cached_mtime_noerror(module))
+            # The original environment is only kept for child processes, the
+            # variables the configuration can read are copied into basedata
+            env = bb.data.createCopy(self.basedata)
+            env.delVar("BB_ORIGENV")
+            self._key = repr((version, os.getcwd(), env.get_hash()))
+        return self._key
+
+    def load(self):
+        """
+        Return the datastore, the recorded calls and the parser cache
+        directory, or None if there is no snapshot which can be used
+        """
+        if not self.fn:
+            return None
+        try:
+            with open(self.fn, "rb") as f:
+                self.exists = True
+                if pickle.load(f) != self.key:
+                    return None
+                for fn, mtime in pickle.load(f):
+                    if not bb.parse.check_mtime(fn, mtime):
+                        return None
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:
+            parselog.debug("Unable to load the configuration from %s: %s" % (self.fn, exc))
+            return None
+
+    def save(self, data, calls, cachedir):
+        if not self.fn:
+            return
+        depends = data.getVar("__depends", False) or []
+        for fn, mtime in depends:
+            # Don't save a snapshot if a file changed while it was parsed
+            if not bb.parse.check_mtime(fn, mtime):
+                self.remove()
+                return
+
+        tmpfile = "%s.%d" % (self.fn, os.getpid())
+        try:
+            bb.utils.mkdirhier(os.path.dirname(self.fn))
+            with open(tmpfile, "wb") as f:
+                pickle.dump(self.key, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(depends, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((data, calls, cachedir), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, self.fn)
+        except Exception as exc:
+            parselog.debug("Unable to save the configuration to %s: %s" % (self.fn, exc))
+            bb.utils.remove(tmpfile)
+
+    def remove(self):
+        if self.fn:
+            bb.utils.remove(self.fn)
+            self.exists = False
+
 class CookerDataBuilder(object):
+    # Variables (by prefix) which key the whole recipe cache with BB_CACHE_VARDEPS
+    cache_structure_vars = ("BBFILE", "BBLAYERS", "BBMASK", "BBMULTICONFIG", "BB_RENAMED_VARIABLES", "LAYER")
 
     def __init__(self, cookercfg, worker = False):
 
@@ -258,10 +374,13 @@ class CookerDataBuilder(object):
 
         self.data = self.basedata
         self.mcdata = {}
+        # Variables read when setting up the fetcher and signature generator
+        self.setupvars = set()
 
     def calc_datastore_hashes(self, clean=True):
         if not clean:
             self.data_hash = None
+            self.cache_hash = None
             return
 
         data_hash = hashlib.sha256()
@@ -271,14 +390,50 @@ class CookerDataBuilder(object):
             data_hash.update(self.mcdata[config].get_hash().encode('utf-8'))
         self.data_hash = data_hash.hexdigest()
 
+        self.cache_hash = self.data_hash
+        if bb.utils.to_boolean(self.data.getVar("BB_CACHE_VARDEPS")):
+            cache_hash = hashlib.sha256()
+            cache_hash.update(self.get_cache_structure_hash(self.data).encode('utf-8'))
+            for config in multiconfig:
+                cache_hash.update(self.get_cache_structure_hash(self.mcdata[config]).encode('utf-8'))
+            self.cache_hash = cache_hash.hexdigest()
+
+    def get_cache_structure_hash(self, d):
+        """
+        With BB_CACHE_VARDEPS, recipes record which configuration variables
+        they read so the recipe cache is only keyed on the parts of the
+        configuration used as a whole. These are the set of variable names,
+        the function definitions, the layer setup and the variables read
+        when setting up the parser.
+        """
+        digests = d.get_var_digests()
+        data = []
+        for key in sorted(digests):
+            if key in self.setupvars or key.startswith(self.cache_structure_vars) or d.getVarFlag(key, "func", False):
+                data.append((key, digests[key]))
+            else:
+                data.append((key, None))
+
+        for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
+            data.append((key, str(d.getVar(key, False) or [])))
+
+        moddeps = bb.codeparser.modulecode_deps
+        for dep in sorted(moddeps):
+            data.append(('moddep[%s]' % dep, [sorted(moddeps[dep][0]), sorted(moddeps[dep][1]), sorted(moddeps[dep][2]), sorted(moddeps[dep][3]), moddeps[dep][4]]))
+
+        return hashlib.sha256(str(data).encode("utf-8")).hexdigest()
+
     def parseBaseConfiguration(self, worker=False):
         mcdata = {}
+        self.setupvars = set()
         try:
             self.data = self.parseConfigurationFiles(self.prefiles, self.postfiles)
 
             servercontext = self.data.getVar("BB_WORKERCONTEXT", False) is None and not worker
+            self.data.enableLookupTracking(self.setupvars)
             bb.fetch.fetcher_init(self.data, servercontext)
             bb.parse.init_parser(self.data)
+            self.data.disableLookupTracking()
 
             bb.event.fire(bb.event.ConfigParsed(), self.data)
 
@@ -294,7 +449,9 @@ class CookerDataBuilder(object):
                 reparse_cnt += 1
                 bb.event.fire(bb.event.ConfigParsed(), self.data)
 
+            self.data.enableLookupTracking(self.setupvars)
             bb.parse.init_parser(self.data)
+            self.data.disableLookupTracking()
             mcdata[''] = self.data
 
             multiconfig = (self.data.getVar("BBMULTICONFIG") or "").split()
@@ -354,7 +511,41 @@ class CookerDataBuilder(object):
     def _findLayerConf(self, data):
         return findConfigFile("bblayers.conf", data)
 
+    def _initParserCaches(self, data):
+        if not data.getVar("BB_CACHEDIR"):
+            data.setVar("BB_CACHEDIR", "${TOPDIR}/cache")
+        self.parsercachedir = data.getVar("BB_CACHEDIR")
+        bb.codeparser.parser_cache_init(self.parsercachedir)
+        bb.parse.statement_cache_init(self.parsercachedir)
+
     def parseConfigurationFiles(self, prefiles, postfiles, mc = ""):
+        snapshot = ConfigSnapshot(self.basedata, prefiles, postfiles, mc, self.tracking)
+        restored = snapshot.load()
+        if restored:
+            data, calls, self.parsercachedir = restored
+            parselog.debug("Restored the configuration from %s" % snapshot.fn)
+            bb.codeparser.parser_cache_init(self.parsercachedir)
+            bb.parse.statement_cache_init(self.parsercachedir)
+            for func, args in calls:
+                func(*args)
+            data.setVar("BB_ORIGENV", self.savedenv)
+            _register_handlers(data)
+            return data
+
+        bb.parse.ast.recorded_calls = calls = []
+        try:
+            data = self._parseConfigurationFiles(prefiles, postfiles, mc)
+        finally:
+            bb.parse.ast.recorded_calls = None
+
+        if bb.utils.to_boolean(data.getVar("BB_CACHE_BASECONFIG")):
+            snapshot.save(data, calls, self.parsercachedir)
+        elif snapshot.exists:
+            # The snapshots were turned off since this one was saved
+            snapshot.remove()
+        return data
+
+    def _parseConfigurationFiles(self, prefiles, postfiles, mc):
         data = bb.data.createCopy(self.basedata)
         data.setVar("BB_CURRENT_MC", mc)
 
@@ -370,10 +561,7 @@ class CookerDataBuilder(object):
             data.setVar("TOPDIR", os.path.dirname(os.path.dirname(layerconf)))
             data = parse_config_file(layerconf, data)
 
-            if not data.getVar("BB_CACHEDIR"):
-                data.setVar("BB_CACHEDIR", "${TOPDIR}/cache")
-
-            bb.codeparser.parser_cache_init(data.getVar("BB_CACHEDIR"))
+            self._initParserCaches(data)
 
             layers = (data.getVar('BBLAYERS') or "").split()
             broken_layers = []
@@ -478,9 +666,7 @@ class CookerDataBuilder(object):
 
         if not data.getVar("TOPDIR"):
             data.setVar("TOPDIR", os.path.abspath(os.getcwd()))
-        if not data.getVar("BB_CACHEDIR"):
-            data.setVar("BB_CACHEDIR", "${TOPDIR}/cache")
-        bb.codeparser.parser_cache_init(data.getVar("BB_CACHEDIR"))
+        self._initParserCaches(data)
 
         data = parse_config_file(os.path.join("conf", "bitbake.conf"), data)
 
@@ -493,15 +679,7 @@ class CookerDataBuilder(object):
         for bbclass in bbclasses:
             data = _inherit(bbclass, data)
 
-        # Normally we only register event handlers at the end of parsing .bb files
-        # We register any handlers we've found so far here...
-        for var in data.getVar('__BBHANDLERS', False) or []:
-            handlerfn = data.getVarFlag(var, "filename", False)
-            if not handlerfn:
-                parselog.critical("Undefined event handler function '%s'" % var)
-                raise bb.BBHandledException()
-            handlerln = int(data.getVarFlag(var, "lineno", False))
-            bb.event.register(var, data.getVar(var, False),  (data.getVarFlag(var, "eventmask") or "").split(), handlerfn, handlerln, data)
+        _register_handlers(data)
 
         data.setVar('BBINCLUDED',bb.parse.get_file_depends(data))
 
@@ -522,10 +700,12 @@ class CookerDataBuilder(object):
 
         return bb.parse.handle(bbfile, bb_data)
 
-    def parseRecipeVariants(self, bbfile, appends, virtonly=False, mc=None, layername=None):
+    def parseRecipeVariants(self, bbfile, appends, virtonly=False, mc=None, layername=None, variants=None):
         """
         Load and parse one .bb build file
         Return the data and whether parsing resulted in the file being skipped
+        A list of variants limits which BBCLASSEXTEND variants are finalised,
+        an empty list meaning only the base recipe.
         """
 
         if virtonly:
@@ -536,6 +716,8 @@ class CookerDataBuilder(object):
 
         if mc is not None:
             bb_data = self.mcdata[mc].createCopy()
+            if variants is not None:
+                bb_data.setVar("__ONLYFINALISE", list(variants) or ["default"])
             return self._parse_recipe(bb_data, bbfile, appends, mc, layername)
 
         bb_data = self.data.createCopy()
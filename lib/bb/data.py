@@ -262,7 +262,14 @@ def emit_func_python(func, o=sys.__stdout__, d = init()):
                newdeps |= set((d.getVarFlag(dep, "vardeps") or "").split())
         newdeps -= seen
 
-def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparsedata):
+def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparsedata, inputs=None):
+    def record(ds, parser):
+        # Note what the result depends on besides the variable itself, for
+        # the DependencyCache
+        if inputs is not None:
+            inputs.references(ds, parser.references)
+            inputs.execs |= parser.execs
+
     def handle_contains(value, contains, exclusions, d):
         newvalue = []
         if value:
@@ -270,6 +277,8 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
         for k in sorted(contains):
             if k in exclusions or k in ignored_vars:
                 continue
+            if inputs is not None:
+                inputs.references(d, [k])
             l = (d.getVar(k) or "").split()
             for item in sorted(contains[k]):
                 for word in item.split():
@@ -283,6 +292,7 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
     def handle_remove(value, deps, removes, d):
         for r in sorted(removes):
             r2 = d.expandWithRefs(r, None)
+            record(d, r2)
             value += "\n_remove of %s" % r
             deps |= r2.references
             deps = deps | (keys & r2.execs)
@@ -302,6 +312,7 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
             if vf[1] == "vardepvalueexclude":
                 return deps, ""
             value, parser = d.getVarFlag(vf[0], vf[1], False, retparser=True)
+            record(d, parser)
             deps |= parser.references
             deps = deps | (keys & parser.execs)
             deps -= ignored_vars
@@ -309,6 +320,8 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
         varflags = d.getVarFlags(key, ["vardeps", "vardepvalue", "vardepsexclude", "exports", "postfuncs", "prefuncs", "lineno", "filename"]) or {}
         vardeps = varflags.get("vardeps")
         exclusions = varflags.get("vardepsexclude", "").split()
+        if inputs is not None:
+            inputs.flags(d, key, varflags)
 
         if "vardepvalue" in varflags:
             value = varflags.get("vardepvalue")
@@ -317,6 +330,8 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
                 value = codeparsedata.getVarFlag(key, "_content", False)
                 parser = bb.codeparser.PythonParser(key, logger)
                 parser.parse_python(value, filename=varflags.get("filename"), lineno=varflags.get("lineno"))
+                if inputs is not None:
+                    inputs.execs |= parser.execs
                 deps = deps | parser.references
                 deps = deps | (keys & parser.execs)
                 value = handle_contains(value, parser.contains, exclusions, d)
@@ -324,6 +339,9 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
                 value, parsedvar = codeparsedata.getVarFlag(key, "_content", False, retparser=True)
                 parser = bb.codeparser.ShellParser(key, logger)
                 parser.parse_shell(parsedvar.value)
+                record(codeparsedata, parsedvar)
+                if inputs is not None:
+                    inputs.execs |= parser.execs
                 deps = deps | shelldeps
                 deps = deps | parsedvar.references
                 deps = deps | (keys & parser.execs) | (keys & parsedvar.execs)
@@ -340,6 +358,7 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
                 deps = deps | set(varflags["exports"].split())
         else:
             value, parser = d.getVarFlag(key, "_content", False, retparser=True)
+            record(d, parser)
             deps |= parser.references
             deps = deps | (keys & parser.execs)
             value = handle_contains(value, parser.contains, exclusions, d)
@@ -373,6 +392,129 @@ def build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_va
     #bb.note("Variable %s references %s and calls %s" % (key, str(deps), str(execs)))
     #d.setVarFlag(key, "vardeps", deps)
 
+# The flags build_dependencies() reads expanded
+dependency_flags = ("vardeps", "vardepvalue", "vardepsexclude", "exports", "postfuncs", "prefuncs", "lineno", "filename")
+
+def _lookup_reference(d, ref):
+    if ref.endswith("]") and "[" in ref:
+        var, flag = ref[:-1].split("[", 1)
+        return d.getVarFlag(var, flag)
+    return d.getVar(ref)
+
+class DependencyInputs(object):
+    """
+    What a result of build_dependencies() was computed from, besides the
+    definition of the variable: the values of the variables it references
+    and the names it calls, which are dependencies if they are variables
+    """
+    def __init__(self, datastores):
+        self.datastores = datastores
+        self.checks = []
+        self.execs = set()
+        self.keyexecs = None
+
+    def index(self, d):
+        for i, ds in enumerate(self.datastores):
+            if ds is d:
+                return i
+
+    def references(self, d, refs):
+        ds = self.index(d)
+        for ref in refs:
+            self.checks.append((ds, ref, _lookup_reference(d, ref)))
+
+    def flags(self, d, key, varflags):
+        local_var = d._findVar(key) or {}
+        for flag in dependency_flags:
+            if "${" in str(local_var.get(flag, "")):
+                self.checks.append((self.index(d), "%s[%s]" % (key, flag), varflags.get(flag)))
+
+    def removes(self, d, local_var):
+        # Whether a remove applies depends on the values it references even
+        # when it doesn't, so these aren't among the parser's references
+        for (r, o) in (local_var or {}).get(":remove", ()):
+            self.references(d, d.expandWithRefs(r, None).references)
+
+    def valid(self, keys, datastores):
+        if keys.intersection(self.execs) != self.keyexecs:
+            return False
+        for ds, ref, value in self.checks:
+            if _lookup_reference(datastores[ds], ref) != value:
+                return False
+        return True
+
+class DependencyCache(object):
+    """
+    Results of build_dependencies() reused across the recipes parsed by a
+    process, for the functions and variables most of them share from the
+    configuration and classes. A result is only reused when the definition
+    of the variable is the same, including which of its appends, prepends
+    and removes apply, as are the values of the variables it references and
+    which of the names it calls are variables. Variables with overrides are
+    not cached.
+    """
+    max_entries = 50000
+    max_definitions = 4
+
+    def __init__(self):
+        self.entries = {}
+        self.contexts = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def definition(d, local_var):
+        if not local_var:
+            return None
+        # The lists of appends, prepends and removes are changed in place
+        definition = dict(local_var)
+        for op in (":append", ":prepend", ":remove"):
+            if op in definition:
+                d.need_overrides()
+                definition[op] = tuple((r, o, not o or set(o.split(":")).issubset(d.overridesset)) for (r, o) in definition[op])
+        return definition
+
+    def build_dependencies(self, key, context, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparsedata):
+        var = key.split("[")[0]
+        if key in mod_funcs or var in d.overridedata or var in codeparsedata.overridedata:
+            return build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparsedata)
+
+        datastores = (d, codeparsedata)
+        local_var = d._findVar(var)
+        definition = self.definition(d, local_var)
+        codeparser_var = codeparsedata._findVar(var)
+        if codeparser_var is local_var:
+            definition = (definition, definition)
+        else:
+            definition = (definition, self.definition(codeparsedata, codeparser_var))
+        entries = self.entries.get((key, context))
+        if entries:
+            for entry in entries:
+                if entry[0] == definition and entry[1].valid(keys, datastores):
+                    self.hits += 1
+                    return entry[2]
+        self.misses += 1
+
+        inputs = DependencyInputs(datastores)
+        inputs.removes(d, local_var)
+        if codeparser_var is not local_var:
+            inputs.removes(codeparsedata, codeparser_var)
+        deps, value = build_dependencies(key, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparsedata, inputs)
+        inputs.keyexecs = keys.intersection(inputs.execs)
+        inputs.datastores = None
+        result = (frozenset(deps), value)
+
+        if entries is None:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+                self.contexts.clear()
+            entries = self.entries[(key, context)] = []
+        entries.insert(0, (definition, inputs, result))
+        del entries[self.max_definitions:]
+        return result
+
+dependency_cache = DependencyCache()
+
 def generate_dependencies(d, ignored_vars):
 
     mod_funcs = set(bb.codeparser.modulecode_deps.keys())
@@ -388,9 +530,16 @@ def generate_dependencies(d, ignored_vars):
     deps = {}
     values = {}
 
+    # Everything else the results depend on which is the same for all the
+    # variables, for the DependencyCache
+    context = (frozenset(shelldeps), tuple(varflagsexcl), frozenset(ignored_vars), d.getVar('BB_HASH_CODEPARSER_VALS') or "")
+    context = dependency_cache.contexts.setdefault(context, context)
+    def build(key):
+        return dependency_cache.build_dependencies(key, context, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparserd)
+
     tasklist = d.getVar('__BBTASKS', False) or []
     for task in tasklist:
-        deps[task], values[task] = build_dependencies(task, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparserd)
+        deps[task], values[task] = build(task)
         newdeps = deps[task]
         seen = set()
         while newdeps:
@@ -399,7 +548,7 @@ def generate_dependencies(d, ignored_vars):
             newdeps = set()
             for dep in nextdeps:
                 if dep not in deps:
-                    deps[dep], values[dep] = build_dependencies(dep, keys, mod_funcs, shelldeps, varflagsexcl, ignored_vars, d, codeparserd)
+                    deps[dep], values[dep] = build(dep)
                 newdeps |=  deps[dep]
             newdeps -= seen
         #print "For %s: %s" % (task, str(deps[task]))
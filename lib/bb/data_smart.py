@@ -20,13 +20,13 @@ import builtins
 import copy
 import re
 import sys
+import weakref
 from collections.abc import MutableMapping
 import logging
 import hashlib
 import bb, bb.codeparser
 import bb.filter
 from bb   import utils
-from bb.COW  import COWDictBase
 
 logger = logging.getLogger("BitBake.Data")
 
@@ -34,6 +34,8 @@ __setvar_keyword__ = [":append", ":prepend", ":remove"]
 __setvar_regexp__ = re.compile(r'(?P<base>.*?)(?P<keyword>:append|:prepend|:remove)(:(?P<add>[^A-Z]*))?$')
 __expand_var_regexp__ = re.compile(r"\${[a-zA-Z0-9\-_+./~:]+}")
 __expand_python_regexp__ = re.compile(r"\${@(?:{.*?}|.)+?}")
+__expand_var_split__ = re.compile(r"\${([a-zA-Z0-9\-_+./~:]+)}")
+__expand_python_split__ = re.compile(r"\${@((?:{.*?}|.)+?)}")
 __whitespace_split__ = re.compile(r'(\s)')
 __override_regexp__ = re.compile(r'[a-z0-9]+')
 
@@ -49,6 +51,62 @@ bitbake_renamed_vars = {
     "BB_STAMP_POLICY": "is a deprecated variable and support has been removed",
 }
 
+# Strings being expanded, split into alternating literal text and the names
+# of the variables referenced or the inline python code. These are shared by
+# all datastores as the same values are expanded in every recipe.
+expansion_templates = ({}, {})
+max_expansion_templates = 50000
+# The code objects for the inline python, by code and variable name
+compiled_expressions = {}
+
+def expansion_template(s, python=False):
+    """
+    Return s split by the variable references (or the inline python if
+    python is set) it contains, the matches being at the odd indexes
+    """
+    templates = expansion_templates[python]
+    parts = templates.get(s)
+    if parts is None:
+        if len(templates) >= max_expansion_templates:
+            templates.clear()
+        if python:
+            parts = tuple(__expand_python_split__.split(s))
+        else:
+            parts = tuple(__expand_var_split__.split(s))
+        templates[s] = parts
+    return parts
+
+def resolve_override(overridedata, overrides, overridesset):
+    """
+    Given overridedata, the (name, override) pairs for the overrides set on a
+    variable, return the name of the one which applies with the active
+    overrides or False if none do
+    """
+    match = False
+    active = {}
+    for (r, o) in overridedata:
+        # FIXME What about double overrides both with "_" in the name?
+        if o in overridesset:
+            active[o] = r
+        elif ":" in o:
+            if set(o.split(":")).issubset(overridesset):
+                active[o] = r
+
+    mod = True
+    while mod:
+        mod = False
+        for o in overrides:
+            for a in active.copy():
+                if a.endswith(":" + o):
+                    t = active[a]
+                    del active[a]
+                    active[a.replace(":" + o, "")] = t
+                    mod = True
+                elif a == o:
+                    match = active[a]
+                    del active[a]
+    return match
+
 def infer_caller_details(loginfo, parent = False, varval = True):
     """Save the caller the trouble of specifying everything."""
     # Save effort.
@@ -107,16 +165,50 @@ class VariableParse:
         self.contains = {}
 
     def var_sub(self, match):
-        key = match.group()[2:-1]
+        var = self.var_value(match.group()[2:-1])
+        if var is not None:
+            return var
+        else:
+            return match.group()
+
+    def var_value(self, key):
         if self.varname and key:
             if self.varname == key:
                 raise Exception("variable %s references itself!" % self.varname)
         var = self.d.getVarFlag(key, "_content")
         self.references.add(key)
-        if var is not None:
-            return var
-        else:
-            return match.group()
+        return var
+
+    def expand_vars(self, s):
+        """
+        Substitute the variable references in s, equivalent to
+        __expand_var_regexp__.sub(self.var_sub, s)
+        """
+        parts = expansion_template(s)
+        if len(parts) == 1:
+            return s
+        out = list(parts)
+        for i in range(1, len(parts), 2):
+            var = self.var_value(parts[i])
+            if var is None:
+                var = "${%s}" % parts[i]
+            out[i] = var
+        return "".join(out)
+
+    def expand_python(self, s):
+        """
+        Substitute the results of the inline python in s, equivalent to
+        __expand_python_regexp__.sub(self.python_sub, s)
+        """
+        if "${@" not in s:
+            return s
+        parts = expansion_template(s, python=True)
+        if len(parts) == 1:
+            return s
+        out = list(parts)
+        for i in range(1, len(parts), 2):
+            out[i] = self.python_sub(parts[i])
+        return "".join(out)
 
     def python_sub(self, match):
         if isinstance(match, str):
@@ -126,14 +218,18 @@ class VariableParse:
 
         # Do not run code that contains one or more unexpanded variables
         # instead return the code with the characters we removed put back
-        if __expand_var_regexp__.findall(code):
+        if "${" in code and __expand_var_regexp__.search(code):
             return "${@" + code + "}"
 
         if self.varname:
             varname = 'Var <%s>' % self.varname
         else:
             varname = '<expansion>'
-        codeobj = compile(code.strip(), varname, "eval")
+        codeobj = compiled_expressions.get((code, varname))
+        if codeobj is None:
+            if len(compiled_expressions) >= max_expansion_templates:
+                compiled_expressions.clear()
+            codeobj = compiled_expressions[(code, varname)] = compile(code.strip(), varname, "eval")
 
         parser = bb.codeparser.PythonParser(self.varname, logger)
         parser.parse_python(code)
@@ -240,28 +336,83 @@ class IncludeHistory(object):
             o.write("\n")
             child.emit(o, level)
 
+# Variable history events are stored as tuples of these fields followed by
+# a tuple of any other (key, value) pairs, rather than as a dict each. The
+# file and op names are interned as they repeat across many events.
+history_fields = ("variable", "file", "line", "op", "detail", "flag", "func", "parsing")
+history_fieldset = frozenset(history_fields)
+history_interned = {}
+history_missing = object()
+
+def encode_history_event(loginfo):
+    get = loginfo.get
+    missing = history_missing
+    file = get("file", missing)
+    if type(file) is str:
+        file = history_interned.setdefault(file, file)
+    op = get("op", missing)
+    if type(op) is str:
+        op = history_interned.setdefault(op, op)
+    extra = None
+    if not history_fieldset.issuperset(loginfo):
+        extra = tuple(sorted(((k, v) for k, v in loginfo.items() if k not in history_fieldset), key=lambda item: item[0]))
+    return (get("variable", missing), file, get("line", missing), op, get("detail", missing),
+            get("flag", missing), get("func", missing), get("parsing", missing), extra)
+
+def decode_history_event(event):
+    loginfo = {}
+    for field, value in zip(history_fields, event):
+        if value is not history_missing:
+            loginfo[field] = value
+    if event[-1]:
+        loginfo.update(event[-1])
+    return loginfo
+
 class VariableHistory(object):
     def __init__(self, dataroot):
         self.dataroot = dataroot
-        self.variables = COWDictBase.copy()
+        # The events recorded for each variable, and the dicts of the
+        # histories this was copied from, nearest first. Their lists of
+        # events are shared until an event is recorded for the variable here.
+        self.variables = {}
+        self.layers = ()
 
     def copy(self):
         new = VariableHistory(self.dataroot)
-        new.variables = self.variables.copy()
+        if self.variables:
+            new.layers = (self.variables,) + self.layers
+        else:
+            new.layers = self.layers
         return new
 
+    def _events(self, var):
+        if var in self.variables:
+            return self.variables[var]
+        for layer in self.layers:
+            if var in layer:
+                return layer[var]
+        return None
+
+    def _own_events(self, var):
+        events = self.variables.get(var)
+        if events is None:
+            events = self.variables[var] = list(self._events(var) or [])
+        return events
+
     def __getstate__(self):
         vardict = {}
-        for k, v in self.variables.iteritems():
-            vardict[k] = v
+        for layer in reversed((self.variables,) + self.layers):
+            for k, v in layer.items():
+                vardict[k] = [decode_history_event(event) for event in v]
         return {'dataroot': self.dataroot,
                 'variables': vardict}
 
     def __setstate__(self, state):
         self.dataroot = state['dataroot']
-        self.variables = COWDictBase.copy()
+        self.variables = {}
+        self.layers = ()
         for k, v in state['variables'].items():
-            self.variables[k] = v
+            self.variables[k] = [encode_history_event(loginfo) for loginfo in v]
 
     def record(self, *kwonly, **loginfo):
         if not self.dataroot._tracking:
@@ -276,29 +427,21 @@ class VariableHistory(object):
         if 'variable' not in loginfo or 'file' not in loginfo:
             raise ValueError("record() missing variable or file.")
         var = loginfo['variable']
-        if var not in self.variables:
-            self.variables[var] = []
-        if not isinstance(self.variables[var], list):
-            return
-        if 'nodups' in loginfo and loginfo in self.variables[var]:
+        event = encode_history_event(loginfo)
+        if 'nodups' in loginfo and event in (self._events(var) or ()):
             return
-        self.variables[var].append(loginfo.copy())
+        self._own_events(var).append(event)
 
     def rename_variable_hist(self, oldvar, newvar):
         if not self.dataroot._tracking:
             return
-        if oldvar not in self.variables:
+        events = self._events(oldvar)
+        if events is None:
             return
-        if newvar not in self.variables:
-            self.variables[newvar] = []
-        for i in self.variables[oldvar]:
-            self.variables[newvar].append(i.copy())
+        self._own_events(newvar).extend(events)
 
     def variable(self, var):
-        varhistory = []
-        if var in self.variables:
-            varhistory.extend(self.variables[var])
-        return varhistory
+        return [decode_history_event(event) for event in self._events(var) or ()]
 
     def emit(self, var, oval, val, o, d):
         history = self.variable(var)
@@ -399,9 +542,10 @@ class VariableHistory(object):
 
     def del_var_history(self, var, f=None, line=None):
         """If file f and line are not given, the entire history of var is deleted"""
-        if var in self.variables:
+        events = self._events(var)
+        if events is not None:
             if f and line:
-                self.variables[var] = [ x for x in self.variables[var] if x['file']!=f and x['line']!=line]
+                self.variables[var] = [ x for x in events if x[1]!=f and x[2]!=line]
             else:
                 self.variables[var] = []
 
@@ -422,9 +566,60 @@ def _print_rename_error(var, loginfo, renamedvars, fullvar=None):
     else:
         bb.erroronce('Variable %s has been renamed to %s%s' % (var, renameinfo, info))
 
+class LayerCache(object):
+    """
+    The variables of a datastore which has been copied, found in its own dict
+    or in those of the datastores it was itself copied from. This is shared
+    by all of its copies so that their lookups don't have to walk the whole
+    chain of dicts each time.
+
+    Changes to variables are made in place so only need invalidating the
+    cache when variables are added to or removed from one of the dicts. This
+    also invalidates the caches of the copies built on top of it.
+    """
+    def __init__(self, d, parent):
+        self.parent = parent
+        self.layers = (d,)
+        if parent:
+            self.layers += parent.layers
+        self.cache = {}
+        self.dependents = weakref.WeakSet()
+        if parent:
+            parent.dependents.add(self)
+
+    def __getstate__(self):
+        return (self.parent, self.layers)
+
+    def __setstate__(self, state):
+        self.parent, self.layers = state
+        self.cache = {}
+        self.dependents = weakref.WeakSet()
+        if self.parent:
+            self.parent.dependents.add(self)
+
+    def find(self, var):
+        value = self.cache.get(var, self.cache)
+        if value is self.cache:
+            value = None
+            for layer in self.layers:
+                if var in layer:
+                    value = layer[var]
+                    break
+            self.cache[var] = value
+        return value
+
+    def invalidate(self):
+        self.cache = {}
+        for dependent in list(self.dependents):
+            dependent.invalidate()
+
 class DataSmart(MutableMapping):
     def __init__(self):
         self.dict = {}
+        # Lookups in the datastore this was copied from, and the one shared
+        # with the copies of this datastore
+        self.parentcache = None
+        self.layercache = None
 
         self.inchistory = IncludeHistory()
         self.varhistory = VariableHistory(self)
@@ -443,6 +638,12 @@ class DataSmart(MutableMapping):
         self.overrides = None
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
+        # The overrides which apply to each variable for the given overrides,
+        # shared with copies of the datastore, see find_override()
+        self.overridetable = (None, {})
+
+        # Set of the names of variables looked up, when enabled
+        self.lookups = None
 
     def enableTracking(self):
         self._tracking = True
@@ -450,6 +651,16 @@ class DataSmart(MutableMapping):
     def disableTracking(self):
         self._tracking = False
 
+    def enableLookupTracking(self, lookups):
+        """
+        Record the names of the variables looked up in this datastore, and in
+        any copies subsequently made from it, into the set lookups
+        """
+        self.lookups = lookups
+
+    def disableLookupTracking(self):
+        self.lookups = None
+
     def expandWithRefs(self, s, varname):
 
         if not isinstance(s, str): # sanity check
@@ -460,9 +671,9 @@ class DataSmart(MutableMapping):
         while s.find('${') != -1:
             olds = s
             try:
-                s = __expand_var_regexp__.sub(varparse.var_sub, s)
+                s = varparse.expand_vars(s)
                 try:
-                    s = __expand_python_regexp__.sub(varparse.python_sub, s)
+                    s = varparse.expand_python(s)
                 except SyntaxError as e:
                     # Likely unmatched brackets, just don't expand the expression
                     if e.msg != "EOL while scanning string literal" and not e.msg.startswith("unterminated string literal"):
@@ -511,21 +722,47 @@ class DataSmart(MutableMapping):
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work. The list of failing override expansions: %s" % "\n".join(str(s) for s in overrride_stack))
 
+        if self.overridetable[0] == self.overrides:
+            self.overrides = self.overridetable[0]
+        else:
+            self.overridetable = (self.overrides, {})
+
+    def find_override(self, var, overridedata):
+        """
+        Return the name of the override of var which applies, from its
+        overridedata, or False if none do. The results are kept in a table
+        until OVERRIDES changes. Changes to overridedata replace the list
+        rather than altering it so an entry is valid while it holds the
+        same list.
+        """
+        overrides, table = self.overridetable
+        if overrides is not self.overrides:
+            return resolve_override(overridedata, self.overrides, self.overridesset)
+        entry = table.get(var)
+        if entry is not None and entry[0] is overridedata:
+            return entry[1]
+        match = resolve_override(overridedata, overrides, self.overridesset)
+        table[var] = (overridedata, match)
+        return match
+
     def initVar(self, var):
         self.expand_cache = {}
         if not var in self.dict:
             self.dict[var] = {}
+            self._layerChanged()
 
-    def _findVar(self, var):
-        dest = self.dict
-        while dest:
-            if var in dest:
-                return dest[var]
+    def _layerChanged(self):
+        if self.layercache is not None:
+            self.layercache.invalidate()
 
-            if "_data" not in dest:
-                break
-            dest = dest["_data"]
-        return None
+    def _findVar(self, var):
+        if self.lookups is not None:
+            self.lookups.add(var)
+        if var in self.dict:
+            return self.dict[var]
+        if self.parentcache is None:
+            return None
+        return self.parentcache.find(var)
 
     def _makeShadowCopy(self, var):
         if var in self.dict:
@@ -535,6 +772,7 @@ class DataSmart(MutableMapping):
 
         if local_var:
             self.dict[var] = copy.copy(local_var)
+            self._layerChanged()
         else:
             self.initVar(var)
 
@@ -721,6 +959,7 @@ class DataSmart(MutableMapping):
         loginfo['op'] = 'del'
         self.varhistory.record(**loginfo)
         self.dict[var] = {}
+        self._layerChanged()
         if var in self.overridedata:
             del self.overridedata[var]
         if ':' in var:
@@ -793,30 +1032,8 @@ class DataSmart(MutableMapping):
         if flag == "_content" and not parsing:
             overridedata = self.overridedata.get(var, None)
         if flag == "_content" and not parsing and overridedata is not None:
-            match = False
-            active = {}
             self.need_overrides()
-            for (r, o) in overridedata:
-                # FIXME What about double overrides both with "_" in the name?
-                if o in self.overridesset:
-                    active[o] = r
-                elif ":" in o:
-                    if set(o.split(":")).issubset(self.overridesset):
-                        active[o] = r
-
-            mod = True
-            while mod:
-                mod = False
-                for o in self.overrides:
-                    for a in active.copy():
-                        if a.endswith(":" + o):
-                            t = active[a]
-                            del active[a]
-                            active[a.replace(":" + o, "")] = t
-                            mod = True
-                        elif a == o:
-                            match = active[a]
-                            del active[a]
+            match = self.find_override(var, overridedata)
             if match:
                 value, subparser = self.getVarFlag(match, "_content", False, retparser=True)
                 if hasattr(subparser, "removes"):
@@ -998,6 +1215,7 @@ class DataSmart(MutableMapping):
                 self.dict[var]["_content"] = content
             else:
                 del self.dict[var]
+            self._layerChanged()
 
     def createCopy(self):
         """
@@ -1006,6 +1224,9 @@ class DataSmart(MutableMapping):
         # we really want this to be a DataSmart...
         data = DataSmart()
         data.dict["_data"] = self.dict
+        if self.layercache is None:
+            self.layercache = LayerCache(self.dict, self.parentcache)
+        data.parentcache = self.layercache
         data.varhistory = self.varhistory.copy()
         data.varhistory.dataroot = data
         data.inchistory = self.inchistory.copy()
@@ -1013,8 +1234,10 @@ class DataSmart(MutableMapping):
 
         data._tracking = self._tracking
         data._var_renames = self._var_renames
+        data.lookups = self.lookups
 
         data.overrides = None
+        data.overridetable = self.overridetable
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
         # Instead, we're careful with writes.
@@ -1055,22 +1278,23 @@ class DataSmart(MutableMapping):
     def __iter__(self):
         deleted = set()
         overrides = set()
-        def keylist(d):        
+        def keylist():
             klist = set()
-            for key in d:
-                if key in ["_data"]:
-                    continue
-                if key in deleted:
-                    continue
-                if key in overrides:
-                    continue
-                if not d[key]:
-                    deleted.add(key)
-                    continue
-                klist.add(key)
-
-            if "_data" in d:
-                klist |= keylist(d["_data"])
+            layers = (self.dict,)
+            if self.parentcache is not None:
+                layers += self.parentcache.layers
+            for d in layers:
+                for key in d:
+                    if key == "_data":
+                        continue
+                    if key in deleted:
+                        continue
+                    if key in overrides:
+                        continue
+                    if not d[key]:
+                        deleted.add(key)
+                        continue
+                    klist.add(key)
 
             return klist
 
@@ -1083,7 +1307,7 @@ class DataSmart(MutableMapping):
                     if set(o.split(":")).issubset(self.overridesset):
                         overrides.add(var)
 
-        for k in keylist(self.dict):
+        for k in keylist():
              yield k
 
         for k in overrides:
@@ -1111,38 +1335,66 @@ class DataSmart(MutableMapping):
         bb.data.expandKeys(d)
 
         config_ignore_vars = set((d.getVar("BB_HASHCONFIG_IGNORE_VARS") or "").split())
-        keys = set(key for key in iter(d) if not key.startswith("__"))
-        for key in keys:
-            if key in config_ignore_vars:
+        for key in d:
+            if key.startswith("__") or key in config_ignore_vars:
                 continue
 
             value = d.getVar(key, False) or ""
             if type(value) is type(self):
-                data.update({key:value.get_hash()})
-            else:
-                data.update({key:value})
+                value = value.get_hash()
+            data[key] = value
 
-            varflags = d.getVarFlags(key, internalflags = True, expand=["vardepvalue"])
-            if not varflags:
-                continue
-            for f in varflags:
+            # As getVarFlags(key, internalflags=True, expand=["vardepvalue"])
+            # without building the dict of flags
+            for f, flagvalue in (d._findVar(key) or {}).items():
                 if f == "_content":
                     continue
-                data.update({'%s[%s]' % (key, f):varflags[f]})
+                if f == "vardepvalue":
+                    flagvalue = d.expand(flagvalue, key + "[vardepvalue]")
+                data['%s[%s]' % (key, f)] = flagvalue
 
         for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
             bb_list = d.getVar(key, False) or []
-            data.update({key:str(bb_list)})
+            data[key] = str(bb_list)
 
             if key == "__BBANONFUNCS":
                 for i in bb_list:
                     value = d.getVar(i, False) or ""
-                    data.update({i:value})
+                    data[i] = value
 
         moddeps = bb.codeparser.modulecode_deps
         for dep in sorted(moddeps):
             # Ignore visitor code, sort sets
-            data.update({'moddep[%s]' % dep : [sorted(moddeps[dep][0]), sorted(moddeps[dep][1]), sorted(moddeps[dep][2]), sorted(moddeps[dep][3]), moddeps[dep][4]]})
-
-        data_str = str([(k, data[k]) for k in sorted(data.keys())])
-        return hashlib.sha256(data_str.encode("utf-8")).hexdigest()
+            data['moddep[%s]' % dep] = [sorted(moddeps[dep][0]), sorted(moddeps[dep][1]), sorted(moddeps[dep][2]), sorted(moddeps[dep][3]), moddeps[dep][4]]
+
+        # This is the hash of str() of the sorted list of items, fed to the
+        # hash a chunk at a time rather than building the whole string
+        items = sorted(data.items())
+        data_hash = hashlib.sha256(b"[")
+        for i in range(0, len(items), 1000):
+            chunk = ", ".join(repr(item) for item in items[i:i + 1000])
+            if i:
+                chunk = ", " + chunk
+            data_hash.update(chunk.encode("utf-8"))
+        data_hash.update(b"]")
+        return data_hash.hexdigest()
+
+    def get_var_digests(self):
+        """
+        Return a dict mapping the name of each variable to a digest of its
+        contents, including all of its flags, appends and removes. Like
+        get_hash(), internal variables and those in BB_HASHCONFIG_IGNORE_VARS
+        are left out.
+        """
+        config_ignore_vars = set((self.getVar("BB_HASHCONFIG_IGNORE_VARS") or "").split())
+        digests = {}
+        for key in self:
+            if key.startswith("__") or key in config_ignore_vars:
+                continue
+            items = []
+            for flag, value in sorted((self._findVar(key) or {}).items()):
+                if type(value) is type(self):
+                    value = value.get_hash()
+                items.append((flag, value))
+            digests[key] = hashlib.sha256(str(items).encode("utf-8")).digest()[:8]
+        return digests
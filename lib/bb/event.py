@@ -627,7 +627,7 @@ class ParseStarted(OperationStarted):
 
 class ParseCompleted(OperationCompleted):
     """Recipe parsing for the runqueue has completed"""
-    def __init__(self, cached, parsed, skipped, masked, virtuals, errors, total):
+    def __init__(self, cached, parsed, skipped, masked, virtuals, errors, total, tailtime=0):
         OperationCompleted.__init__(self, total, "Recipe parsing Completed")
         self.cached = cached
         self.parsed = parsed
@@ -636,6 +636,8 @@ class ParseCompleted(OperationCompleted):
         self.masked = masked
         self.errors = errors
         self.sofar = cached + parsed
+        # Seconds between the last recipe being handed to a parser and parsing completing
+        self.tailtime = tailtime
 
 class ParseProgress(OperationProgress):
     """Recipe parsing progress"""
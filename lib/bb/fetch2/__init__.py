@@ -566,6 +566,10 @@ def fetcher_parse_save():
     _checksum_cache.save_extras()
     _revisions_cache.save_extras()
 
+def fetcher_parse_flush():
+    _checksum_cache.flush_extras()
+    _revisions_cache.flush_extras()
+
 def fetcher_parse_done():
     _checksum_cache.save_merge()
     _revisions_cache.save_merge()
@@ -1309,6 +1313,16 @@ def get_file_checksums(filelist, pn, localdirsexclude):
     """
     return _checksum_cache.get_checksums(filelist, pn, localdirsexclude)
 
+def get_file_checksums_multi(filelists, localdirsexclude):
+    """Get the checksums for several lists of local files
+
+    filelists is a list of (filelist, pn) pairs and a list of the checksums
+    of each is returned, the files missing from the cache being checksummed
+    together
+
+    """
+    return _checksum_cache.get_checksums_multi(filelists, localdirsexclude)
+
 
 class FetchData(object):
     """
@@ -17,9 +17,13 @@ File parsers for the BitBake build tools.
 handlers = []
 
 import errno
+import hashlib
+import json
 import logging
 import os
+import pickle
 import stat
+import time
 import bb
 import bb.utils
 import bb.siggen
@@ -46,6 +50,210 @@ class SkipRecipe(Exception):
 class SkipPackage(SkipRecipe):
     """Exception raised to skip this recipe (use SkipRecipe in new code)"""
 
+class ParseProfile(object):
+    """
+    Wall clock time spent parsing each recipe, broken down into finalisation,
+    anonymous python and dependency generation, along with the time spent in
+    each inherited class and anonymous python function. The parser processes
+    record this when BB_PARSE_PROFILE is set and the cooker merges the results
+    into a report. Times are inclusive, so a class includes the time of the
+    classes it inherits and finalize includes the anonymous python.
+    """
+    phases = ("total", "finalize", "anonfuncs", "dependencies")
+
+    def __init__(self):
+        self.recipes = {}
+        self.classes = {}
+        self.anonfuncs = {}
+        self.current = None
+        # Statement and dependency cache hits and misses
+        self.statementcache = [0, 0]
+        self.dependencycache = [0, 0]
+
+    def start_recipe(self, fn):
+        self.current = self.recipes.setdefault(fn, dict.fromkeys(self.phases, 0.0))
+
+    def add_recipe(self, phase, elapsed):
+        if self.current is not None:
+            self.current[phase] += elapsed
+
+    @staticmethod
+    def _add(table, key, elapsed, count=1):
+        entry = table.setdefault(key, [0, 0.0])
+        entry[0] += count
+        entry[1] += elapsed
+
+    def add_class(self, fn, elapsed):
+        self._add(self.classes, fn, elapsed)
+
+    def add_anonfunc(self, funcname, elapsed):
+        self._add(self.anonfuncs, funcname, elapsed)
+
+    def save(self, fn):
+        with open(fn, "w") as f:
+            json.dump({"recipes": self.recipes, "classes": self.classes, "anonfuncs": self.anonfuncs, "statementcache": self.statementcache, "dependencycache": self.dependencycache}, f)
+
+    def merge(self, fn):
+        with open(fn, "r") as f:
+            data = json.load(f)
+        for recipe, phases in data["recipes"].items():
+            entry = self.recipes.setdefault(recipe, dict.fromkeys(self.phases, 0.0))
+            for phase in self.phases:
+                entry[phase] += phases.get(phase, 0.0)
+        for table, name in ((self.classes, "classes"), (self.anonfuncs, "anonfuncs")):
+            for key, (count, elapsed) in data[name].items():
+                self._add(table, key, elapsed, count)
+        for i, count in enumerate(data.get("statementcache", [0, 0])):
+            self.statementcache[i] += count
+        for i, count in enumerate(data.get("dependencycache", [0, 0])):
+            self.dependencycache[i] += count
+
+    def write_report(self, jsonfile, textfile, limit=25):
+        recipes = sorted(self.recipes.items(), key=lambda r: r[1]["total"], reverse=True)
+        classes = sorted(self.classes.items(), key=lambda c: c[1][1], reverse=True)
+        anonfuncs = sorted(self.anonfuncs.items(), key=lambda a: a[1][1], reverse=True)
+
+        with open(jsonfile, "w") as f:
+            json.dump({
+                "recipes": [dict(recipe=fn, **phases) for fn, phases in recipes],
+                "classes": [{"class": fn, "count": count, "time": elapsed} for fn, (count, elapsed) in classes],
+                "anonfuncs": [{"function": name, "count": count, "time": elapsed} for name, (count, elapsed) in anonfuncs],
+                "statementcache": {"hits": self.statementcache[0], "misses": self.statementcache[1]},
+                "dependencycache": {"hits": self.dependencycache[0], "misses": self.dependencycache[1]},
+            }, f, indent=2)
+
+        with open(textfile, "w") as f:
+            total = sum(phases["total"] for phases in self.recipes.values())
+            f.write("%d recipes parsed in %.2fs of parser time\n" % (len(self.recipes), total))
+            for name, (hits, misses) in (("Statement", self.statementcache), ("Dependency", self.dependencycache)):
+                if hits + misses:
+                    f.write("%s cache: %d hits, %d misses (%.1f%% hit rate)\n" % (name, hits, misses, 100.0 * hits / (hits + misses)))
+
+            f.write("\nSlowest recipes:\n")
+            f.write("%10s %10s %10s %10s  %s\n" % ("total", "finalize", "anonfuncs", "deps", "recipe"))
+            for fn, phases in recipes[:limit]:
+                f.write("%9.3fs %9.3fs %9.3fs %9.3fs  %s\n" % (phases["total"], phases["finalize"], phases["anonfuncs"], phases["dependencies"], fn))
+
+            for title, entries in (("Slowest classes (inclusive)", classes), ("Slowest anonymous functions", anonfuncs)):
+                f.write("\n%s:\n" % title)
+                f.write("%10s %8s %10s  %s\n" % ("total", "count", "average", "name"))
+                for name, (count, elapsed) in entries[:limit]:
+                    f.write("%9.3fs %8d %9.4fs  %s\n" % (elapsed, count, elapsed / count, name))
+
+# Set to a ParseProfile() to record parse times, see ParseProfile
+parse_profile = None
+
+class StatementCache(object):
+    """
+    Persistent cache of the statements parsed from each file, shared between
+    processes and bitbake invocations using the same BB_CACHEDIR. Entries are
+    keyed by the file's path, mtime, size and inode along with how it was
+    parsed and the version of the parser, so a changed file or parser is never
+    matched. Each entry is a separate file written atomically so no locking
+    is needed. The least recently used entries are removed by prune().
+    """
+    cache_version = "2"
+
+    def __init__(self):
+        self.cachedir = None
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_cache(self, cachedir):
+        if not cachedir:
+            return
+        self.cachedir = os.path.join(cachedir, "bb_statements")
+
+        # Changes to the parser code invalidate the cache, as well as releases
+        version = [self.cache_version, bb.__version__]
+        for module in ("ast", "parse_py/BBHandler", "parse_py/ConfHandler"):
+            fn = os.path.join(os.path.dirname(__file__), module + ".py")
+            version.append(cached_mtime_noerror(fn))
+        self.version = repr(version)
+
+    def entry(self, key):
+        h = hashlib.sha256((self.version + repr(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cachedir, h[:2], h[2:])
+
+    def key(self, kind, fn, abs_fn, *args):
+        """Return the key for abs_fn, or None if it can't be cached"""
+        if not self.cachedir:
+            return None
+        try:
+            st = os.stat(abs_fn)
+        except OSError:
+            return None
+        return (kind, fn, abs_fn, st.st_mtime_ns, st.st_size, st.st_ino) + args
+
+    def get(self, key):
+        if not key:
+            return None
+        entry = self.entry(key)
+        try:
+            with open(entry, "rb") as f:
+                statements = pickle.load(f)
+                mtime = os.fstat(f.fileno()).st_mtime
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # The modification time marks when the entry was last used
+        now = time.time()
+        if now - mtime > 3600:
+            try:
+                os.utime(entry, (now, now))
+            except OSError:
+                pass
+        return statements
+
+    def put(self, key, statements):
+        if not key:
+            return
+        entry = self.entry(key)
+        tmpfile = "%s.%d" % (entry, os.getpid())
+        try:
+            bb.utils.mkdirhier(os.path.dirname(entry))
+            with open(tmpfile, "wb") as f:
+                pickle.dump(statements, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, entry)
+        except (OSError, pickle.PicklingError) as exc:
+            logger.debug("Unable to write statement cache entry %s: %s" % (entry, exc))
+            bb.utils.remove(tmpfile)
+
+    def prune(self, maxsize):
+        """
+        Remove the least recently used entries until the cache is no larger
+        than maxsize bytes
+        """
+        if not self.cachedir:
+            return
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.cachedir):
+            for f in files:
+                fn = os.path.join(root, f)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+        if total <= maxsize:
+            return
+        entries.sort()
+        for _, size, fn in entries:
+            if total <= maxsize:
+                break
+            bb.utils.remove(fn)
+            total -= size
+        logger.debug("Pruned statement cache to %d bytes" % total)
+
+statementcache = StatementCache()
+
+def statement_cache_init(cachedir):
+    statementcache.init_cache(cachedir)
+
 __mtime_cache = {}
 def cached_mtime(f):
     if f not in __mtime_cache:
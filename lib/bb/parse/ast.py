@@ -9,12 +9,38 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import logging
 import sys
+import time
 import bb
 from bb import methodpool
 from bb.parse import logger
 
+# When set to a list, calls made while parsing which change the state of the
+# process rather than the datastore are appended to it, so they can be
+# replayed when a datastore is restored without parsing it
+recorded_calls = None
+
+def call_recorded(func, *args):
+    if recorded_calls is not None:
+        recorded_calls.append((func, args))
+    func(*args)
+
 class StatementGroup(list):
+    def __init__(self):
+        list.__init__(self)
+        # Warnings issued while parsing, kept so they can be shown again
+        # when the statements come from the statement cache
+        self.warnings = []
+
+    def warn(self, log, msg):
+        log.warning(msg)
+        self.warnings.append((log.name, msg))
+
+    def replay_warnings(self):
+        for name, msg in self.warnings:
+            logging.getLogger(name).warning(msg)
+
     def eval(self, data):
         for statement in self:
             statement.eval(data)
@@ -214,7 +240,7 @@ class PythonMethodNode(AstNode):
         # 'this' file. This means we will not parse methods from
         # bb classes twice
         text = '\n'.join(self.body)
-        bb.methodpool.insert_method(self.modulename, text, self.filename, self.lineno - len(self.body) - 1)
+        call_recorded(bb.methodpool.insert_method, self.modulename, text, self.filename, self.lineno - len(self.body) - 1)
         data.setVarFlag(self.function, "func", 1)
         data.setVarFlag(self.function, "python", 1)
         data.setVar(self.function, text, parsing=True)
@@ -299,32 +325,34 @@ class PyLibNode(AstNode):
 
     def eval(self, data):
         global_mods = (data.getVar("BB_GLOBAL_PYMODULES") or "").split()
-        for m in global_mods:
-            if m not in bb.utils._context:
-                bb.utils._context[m] = __import__(m)
-
-        libdir = data.expand(self.libdir)
-        if libdir not in sys.path:
-            sys.path.append(libdir)
-        try:
-            bb.utils._context[self.namespace] = __import__(self.namespace)
-            toimport = getattr(bb.utils._context[self.namespace], "BBIMPORTS", [])
-            for i in toimport:
-                bb.utils._context[self.namespace] = __import__(self.namespace + "." + i)
-                mod = getattr(bb.utils._context[self.namespace], i)
-                fn = getattr(mod, "__file__")
-                funcs = {}
-                for f in dir(mod):
-                    if f.startswith("_"):
-                        continue
-                    fcall = getattr(mod, f)
-                    if not callable(fcall):
-                        continue
-                    funcs[f] = fcall
-                bb.codeparser.add_module_functions(fn, funcs, "%s.%s" % (self.namespace, i))
-
-        except AttributeError as e:
-            bb.error("Error importing OE modules: %s" % str(e))
+        call_recorded(import_pylib, global_mods, data.expand(self.libdir), self.namespace)
+
+def import_pylib(global_mods, libdir, namespace):
+    for m in global_mods:
+        if m not in bb.utils._context:
+            bb.utils._context[m] = __import__(m)
+
+    if libdir not in sys.path:
+        sys.path.append(libdir)
+    try:
+        bb.utils._context[namespace] = __import__(namespace)
+        toimport = getattr(bb.utils._context[namespace], "BBIMPORTS", [])
+        for i in toimport:
+            bb.utils._context[namespace] = __import__(namespace + "." + i)
+            mod = getattr(bb.utils._context[namespace], i)
+            fn = getattr(mod, "__file__")
+            funcs = {}
+            for f in dir(mod):
+                if f.startswith("_"):
+                    continue
+                fcall = getattr(mod, f)
+                if not callable(fcall):
+                    continue
+                funcs[f] = fcall
+            bb.codeparser.add_module_functions(fn, funcs, "%s.%s" % (namespace, i))
+
+    except AttributeError as e:
+        bb.error("Error importing OE modules: %s" % str(e))
 
 class InheritNode(AstNode):
     def __init__(self, filename, lineno, classes):
@@ -484,6 +512,17 @@ def handleAddFragments(statements, filename, lineno, m):
     statements.append(AddFragmentsNode(filename, lineno, fragments_path_prefix, fragments_variable, flagged_variables_list_variable, builtin_fragments_variable))
 
 def runAnonFuncs(d):
+    profile = bb.parse.parse_profile
+    if profile:
+        # Run the functions one at a time so each can be timed
+        start = time.monotonic()
+        for funcname in list(d.getVar("__BBANONFUNCS", False) or []):
+            funcstart = time.monotonic()
+            bb.utils.better_exec("%s(d)" % funcname, {"d": d})
+            profile.add_anonfunc(funcname, time.monotonic() - funcstart)
+        profile.add_recipe("anonfuncs", time.monotonic() - start)
+        return
+
     code = []
     for funcname in d.getVar("__BBANONFUNCS", False) or []:
         code.append("%s(d)" % funcname)
@@ -514,6 +553,7 @@ def handleVirtRecipeProviders(tasklist, d):
         d.setVarFlag(task, "depends", " ".join(remapped))
 
 def finalize(fn, d, variant = None):
+    start = time.monotonic()
     saved_handlers = bb.event.get_handlers().copy()
     try:
         # Found renamed variables. Exit immediately
@@ -562,6 +602,8 @@ def finalize(fn, d, variant = None):
         bb.event.fire(bb.event.RecipeParsed(fn), d)
     finally:
         bb.event.set_handlers(saved_handlers)
+        if bb.parse.parse_profile:
+            bb.parse.parse_profile.add_recipe("finalize", time.monotonic() - start)
 
 def _create_variants(datastores, names, function, onlyfinalise):
     def create_variant(name, orig_d, arg = None):
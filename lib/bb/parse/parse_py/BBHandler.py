@@ -12,7 +12,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
-import re, bb, os
+import re, bb, os, time
 import bb.build, bb.utils, bb.data_smart
 
 from . import ConfHandler
@@ -84,10 +84,13 @@ def inherit(files, fn, lineno, d, deferred=False):
             logger.debug("Inheriting %s (from %s:%d)" % (file, fn, lineno))
             __inherit_cache.append( file )
             d.setVar('__inherit_cache', __inherit_cache)
+            start = time.monotonic()
             try:
                 bb.parse.handle(file, d, True)
             except (IOError, OSError) as exc:
                 raise ParseError("Could not inherit file %s: %s" % (fn, exc.strerror), fn, lineno)
+            if bb.parse.parse_profile:
+                bb.parse.parse_profile.add_class(file, time.monotonic() - start)
             __inherit_cache = d.getVar('__inherit_cache', False) or []
 
 def get_statements(filename, absolute_filename, base_name):
@@ -96,6 +99,14 @@ def get_statements(filename, absolute_filename, base_name):
     try:
         return cached_statements[absolute_filename]
     except KeyError:
+        key = bb.parse.statementcache.key("bb", filename, absolute_filename, base_name)
+        statements = bb.parse.statementcache.get(key)
+        if statements is not None:
+            statements.replay_warnings()
+            if filename.endswith(".bbclass") or filename.endswith(".inc"):
+                cached_statements[absolute_filename] = statements
+            return statements
+
         with open(absolute_filename, 'r') as f:
             statements = ast.StatementGroup()
 
@@ -116,6 +127,9 @@ def get_statements(filename, absolute_filename, base_name):
         if __body__:
             raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
 
+        # A function left open is an error raised after the statements are run
+        if not __infunc__:
+            bb.parse.statementcache.put(key, statements)
         if filename.endswith(".bbclass") or filename.endswith(".inc"):
             cached_statements[absolute_filename] = statements
         return statements
@@ -182,7 +196,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
     if __inpython__ or (__infunc__ and ('__anonymous' == __infunc__[0] or __infunc__[3])):
         tab = __python_tab_regexp__.match(s)
         if tab:
-            bb.warn('python should use 4 spaces indentation, but found tabs in %s, line %s' % (root, lineno))
+            statements.warn(bb.mainlogger, 'python should use 4 spaces indentation, but found tabs in %s, line %s' % (root, lineno))
 
     if __infunc__:
         if s == '}':
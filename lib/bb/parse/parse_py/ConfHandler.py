@@ -119,6 +119,26 @@ def handle(fn, data, include, baseconfig=False):
         oldfile = data.getVar('FILE', False)
 
     abs_fn = resolve_file(fn, data)
+    key = bb.parse.statementcache.key("conf", fn, abs_fn, baseconfig)
+    statements = bb.parse.statementcache.get(key)
+    if statements is None:
+        statements = get_statements(fn, abs_fn, baseconfig)
+        bb.parse.statementcache.put(key, statements)
+    else:
+        statements.replay_warnings()
+
+    # DONE WITH PARSING... time to evaluate
+    data.setVar('FILE', abs_fn)
+    statements.eval(data)
+    if oldfile:
+        data.setVar('FILE', oldfile)
+
+    for f in confFilters:
+        f(fn, data)
+
+    return data
+
+def get_statements(fn, abs_fn, baseconfig):
     with open(abs_fn, 'r') as f:
 
         statements = ast.StatementGroup()
@@ -149,16 +169,7 @@ def handle(fn, data, include, baseconfig=False):
                 continue
             feeder(lineno, s, abs_fn, statements, baseconfig=baseconfig)
 
-    # DONE WITH PARSING... time to evaluate
-    data.setVar('FILE', abs_fn)
-    statements.eval(data)
-    if oldfile:
-        data.setVar('FILE', oldfile)
-
-    for f in confFilters:
-        f(fn, data)
-
-    return data
+    return statements
 
 # baseconfig is set for the bblayers/layer.conf cookerdata config parsing
 # The function is also used by BBHandler, conffile would be False
@@ -169,7 +180,7 @@ def feeder(lineno, s, fn, statements, baseconfig=False, conffile=True):
         if groupd['var'] == "":
             raise ParseError("Empty variable name in assignment: '%s'" % s, fn, lineno);
         if not groupd['whitespace'] or not groupd['whitespace2']:
-            logger.warning("%s:%s has a lack of whitespace around the assignment: '%s'" % (fn, lineno, s))
+            statements.warn(logger, "%s:%s has a lack of whitespace around the assignment: '%s'" % (fn, lineno, s))
         ast.handleData(statements, fn, lineno, groupd)
         return
 
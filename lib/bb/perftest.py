@@ -0,0 +1,274 @@
+"""
+BitBake performance test suite
+
+Generates synthetic layers of configurable size and shape and times BitBake
+running against them: a parse with no cache, a parse loading everything
+from the cache, a dry run of the runqueue, writing the task signatures and
+optionally running the (noop) tasks. Everything runs offline. The results
+are written as JSON and can be compared against the results of a previous
+run to spot regressions. See bin/bitbake-perftest.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import time
+
+import bb
+import bb.utils
+
+# The shape of the generated layer, with its defaults
+LAYER_DEFAULTS = {
+    "recipes": 500,
+    # Number of bbclasses, inherited in chains of inherit_depth classes
+    "classes": 20,
+    "inherit_depth": 3,
+    # Number of extra OVERRIDES values used by the recipes and classes
+    "overrides": 4,
+    # Percentage of the recipes with a native BBCLASSEXTEND variant
+    "variants": 25,
+    # Number of recipes each recipe depends on
+    "fanout": 3,
+    # Number of variables set by each recipe
+    "variables": 20,
+    "seed": 0,
+}
+
+class PhaseError(Exception):
+    pass
+
+TASKS = ["fetch", "unpack", "configure", "compile", "install", "populate_sysroot", "build"]
+
+def _write(path, content):
+    bb.utils.mkdirhier(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+def generate_layer(layerdir, **settings):
+    """
+    Write a synthetic layer to layerdir, settings overriding LAYER_DEFAULTS,
+    and return the settings used
+    """
+    unknown = set(settings) - set(LAYER_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown layer settings: %s" % ", ".join(sorted(unknown)))
+    config = dict(LAYER_DEFAULTS, **settings)
+    rng = random.Random(config["seed"])
+    overrides = ["ov%d" % i for i in range(config["overrides"])]
+
+    _write(os.path.join(layerdir, "conf", "bitbake.conf"), """\
+CACHE = "${TOPDIR}/cache"
+PERSISTENT_DIR = "${TOPDIR}/cache"
+BBFILES = "%s/recipes/*.bb"
+BPN = "${@bb.parse.vars_from_file(d.getVar('FILE', False), d)[0]}"
+PN = "${BPN}"
+PF = "${PN}"
+PROVIDES = "${PN}"
+TMPDIR ??= "${TOPDIR}/tmp"
+STAMP = "${TMPDIR}/stamps/${PN}"
+T = "${TMPDIR}/work/${PN}/temp"
+CLASSOVERRIDE ?= "class-target"
+OVERRIDES = "${CLASSOVERRIDE}%s"
+BB_SIGNATURE_HANDLER = "basichash"
+BB_NO_NETWORK = "1"
+BB_BASEHASH_IGNORE_VARS = "TMPDIR TOPDIR FILE BB_CURRENTTASK BB_TRACE"
+export PATH
+""" % (layerdir, "".join(":" + o for o in overrides)))
+
+    base = []
+    for task in TASKS:
+        # The tasks read a variable so they have some variable dependencies
+        base.append('python do_%s() {\n    d.getVar("VAR%d")\n}\n' % (task, TASKS.index(task) % config["variables"]))
+    base.append("addtask fetch\n")
+    for prev, task in zip(TASKS, TASKS[1:]):
+        base.append("addtask %s after do_%s\n" % (task, prev))
+    base.append('do_configure[deptask] = "do_populate_sysroot"\n')
+    _write(os.path.join(layerdir, "classes", "base.bbclass"), "".join(base))
+
+    _write(os.path.join(layerdir, "classes", "native.bbclass"), """\
+CLASSOVERRIDE = "class-native"
+PN = "${BPN}-native"
+
+python () {
+    deps = (d.getVar("DEPENDS") or "").split()
+    d.setVar("DEPENDS", " ".join(dep if dep.endswith("-native") else dep + "-native" for dep in deps))
+}
+""")
+
+    depth = max(config["inherit_depth"], 1)
+    for i in range(config["classes"]):
+        lines = []
+        if (i + 1) % depth and i + 1 < config["classes"]:
+            lines.append("inherit cls%d\n" % (i + 1))
+        lines.append('CLS%d_FLAGS = "${PN} cls%d ${@d.getVar(\'BPN\')}"\n' % (i, i))
+        for o in overrides:
+            if rng.random() < 0.5:
+                lines.append('CLS%d_FLAGS:%s = "${PN} cls%d %s"\n' % (i, o, i, o))
+        lines.append('CLS%d_FLAGS:append:class-native = " native"\n' % i)
+        lines.append('VAR0:append = " ${CLS%d_FLAGS}"\n' % i)
+        lines.append('do_compile[vardeps] += "CLS%d_FLAGS"\n' % i)
+        lines.append('python cls%d_prefunc() {\n    bb.debug(2, d.getVar("CLS%d_FLAGS"))\n}\n' % (i, i))
+        lines.append('do_install[prefuncs] += "cls%d_prefunc"\n' % i)
+        lines.append('python () {\n    if d.getVar("CLS%d_FLAGS"):\n        d.setVar("CLS%d_ANON", "1")\n}\n' % (i, i))
+        _write(os.path.join(layerdir, "classes", "cls%d.bbclass" % i), "".join(lines))
+
+    # Chain heads, which the recipes inherit
+    heads = [i for i in range(config["classes"]) if i % depth == 0]
+    extended = []
+    for i in range(config["recipes"]):
+        isextended = rng.random() * 100 < config["variants"]
+        # Dependencies only go to earlier recipes to keep the graph acyclic,
+        # and native variants can only depend on other native variants
+        candidates = extended if isextended else range(i)
+        depends = sorted(rng.sample(list(candidates), min(config["fanout"], len(candidates))))
+        lines = ['SUMMARY = "Synthetic recipe %d"\n' % i, 'LICENSE = "MIT"\n']
+        if depends:
+            lines.append('DEPENDS = "%s"\n' % " ".join("r%d" % dep for dep in depends))
+        if heads:
+            lines.append("inherit cls%d\n" % rng.choice(heads))
+        for v in range(config["variables"]):
+            lines.append('VAR%d = "${PN} value %d ${@d.getVar(\'BPN\')}"\n' % (v, v))
+        for v, o in zip(range(config["variables"]), overrides):
+            lines.append('VAR%d:%s = "${PN} %s value %d"\n' % (v, o, o, v))
+            lines.append('VAR%d:append:%s = " appended"\n' % (v, o))
+        if isextended:
+            lines.append('BBCLASSEXTEND = "native"\n')
+            extended.append(i)
+        _write(os.path.join(layerdir, "recipes", "r%d.bb" % i), "".join(lines))
+
+    return config
+
+def _clean(builddir, *names):
+    for name in names:
+        bb.utils.remove(os.path.join(builddir, name), recurse=True)
+
+# Each phase is a bitbake command line and the directories of the build
+# directory to remove before running it. -S changes the configuration, so
+# the sigs phase parses again.
+PHASES = {
+    "parse-cold": (["-p"], ["cache"]),
+    "parse-warm": (["-p"], []),
+    "dry-run": (["-n", "world"], ["tmp"]),
+    "sigs": (["-S", "none", "world"], ["tmp"]),
+    "build": (["world"], ["tmp"]),
+}
+DEFAULT_PHASES = ["parse-cold", "parse-warm", "dry-run", "sigs"]
+
+LOADED_RE = re.compile(r"Loaded (\d+) entries from dependency cache")
+PARSE_RE = re.compile(r"Parsing of (\d+) \.bb files complete \((\d+) cached, (\d+) parsed\)\. (\d+) targets")
+
+def run_phase(phase, layerdir, builddir, trace=False):
+    """
+    Run a phase against the layer in layerdir and return the wall clock time
+    it took along with what BitBake reported about the cache and parsing
+    """
+    args, clean = PHASES[phase]
+    _clean(builddir, *clean)
+
+    bindir = os.path.abspath(os.path.join(os.path.dirname(bb.__file__), "..", "..", "bin"))
+    env = os.environ.copy()
+    env["PATH"] = bindir + os.pathsep + env.get("PATH", "")
+    env["BBPATH"] = layerdir
+    env["TOPDIR"] = builddir
+    env["BB_ENV_PASSTHROUGH_ADDITIONS"] = "TOPDIR BB_TRACE"
+    if trace:
+        # The environment is part of the configuration hash, so every phase
+        # uses the same path to keep the cache valid
+        env["BB_TRACE"] = os.path.join(builddir, "trace.json")
+    else:
+        env.pop("BB_TRACE", None)
+
+    start = time.monotonic()
+    proc = subprocess.run([os.path.join(bindir, "bitbake")] + args, env=env, cwd=builddir,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed = time.monotonic() - start
+    if proc.returncode != 0:
+        raise PhaseError("Phase %s failed:\n%s" % (phase, proc.stdout[-4096:]))
+
+    if trace and os.path.exists(env["BB_TRACE"]):
+        os.replace(env["BB_TRACE"], os.path.join(builddir, "trace-%s.json" % phase))
+
+    result = {"time": elapsed}
+    m = LOADED_RE.search(proc.stdout)
+    if m:
+        result["loaded"] = int(m.group(1))
+    m = PARSE_RE.search(proc.stdout)
+    if m:
+        result["recipes"], result["cached"], result["parsed"], result["targets"] = (int(x) for x in m.groups())
+    return result
+
+def run(workdir, phases=DEFAULT_PHASES, repeat=1, trace=False, logfunc=None, **settings):
+    """
+    Generate a layer in workdir and run the phases against it repeat times,
+    returning the results
+    """
+    layerdir = os.path.join(workdir, "layer")
+    builddir = os.path.join(workdir, "build")
+    _clean(workdir, "layer", "build")
+    bb.utils.mkdirhier(builddir)
+
+    config = generate_layer(layerdir, **settings)
+    results = {
+        "bitbake": bb.__version__,
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "layer": config,
+        "phases": {},
+    }
+
+    for i in range(repeat):
+        for phase in phases:
+            result = run_phase(phase, layerdir, builddir, trace)
+            if logfunc:
+                logfunc("%s: %.2fs" % (phase, result["time"]))
+            entry = results["phases"].setdefault(phase, {"times": []})
+            entry["times"].append(result.pop("time"))
+            entry.update(result)
+
+    for entry in results["phases"].values():
+        entry["min"] = min(entry["times"])
+        entry["median"] = statistics.median(entry["times"])
+    return results
+
+def compare(results, baseline, threshold=10.0):
+    """
+    Compare the median phase times of results against baseline, returning
+    the report lines and whether any phase got slower by more than
+    threshold percent
+    """
+    lines = []
+    regressed = False
+    if results["layer"] != baseline.get("layer"):
+        lines.append("Warning: the layer settings differ from the baseline's")
+    lines.append("%-12s %10s %10s %8s" % ("phase", "baseline", "current", "change"))
+    for phase, entry in results["phases"].items():
+        if phase not in baseline.get("phases", {}):
+            lines.append("%-12s %10s %9.2fs" % (phase, "-", entry["median"]))
+            continue
+        before = baseline["phases"][phase]["median"]
+        change = (entry["median"] - before) * 100.0 / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        lines.append("%-12s %9.2fs %9.2fs %+7.1f%%%s" % (phase, before, entry["median"], change, flag))
+    return lines, regressed
+
+def load_results(fn):
+    with open(fn, "r") as f:
+        return json.load(f)
+
+def save_results(fn, results):
+    with open(fn, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
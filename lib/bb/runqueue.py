@@ -9,6 +9,7 @@ Handles preparation and execution of a queue of tasks
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import copy
 import enum
 import os
@@ -19,6 +20,7 @@ import itertools
 import logging
 import re
 import bb
+import bb.trace
 from bb import msg, event
 from bb import monitordisk
 import subprocess
@@ -662,7 +664,10 @@ class RunQueueData:
         Turn a set of taskData into a RunQueue and compute data needed
         to optimise the execution order.
         """
+        with bb.trace.span("RunQueueData.prepare", "runqueue"):
+            return self._prepare()
 
+    def _prepare(self):
         runq_build = {}
         recursivetasks = {}
         recursiveitasks = {}
@@ -1284,33 +1289,66 @@ class RunQueueData:
         starttime = time.time()
         lasttime = starttime
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(self.runtaskentries)
-        while todeal:
-            ready = set()
-            for tid in todeal.copy():
-                if not (self.runtaskentries[tid].depends - dealtwith):
+        # Iterate over the task list level by level, a level being the tasks
+        # whose dependencies are all in earlier levels, and call into the
+        # siggen code. The unihashes of a level are queried in the background
+        # while the next level is prepared, since prep_taskhash() only needs
+        # the task hashes of the dependencies.
+        depsleft = {}
+        ready = []
+        for tid in self.runtaskentries:
+            depsleft[tid] = len(self.runtaskentries[tid].depends)
+            if not depsleft[tid]:
+                ready.append(tid)
+
+        def set_unihashes(query):
+            unihashes = query.result()
+            for tid in unihashes:
+                self.runtaskentries[tid].unihash = unihashes[tid]
+
+        todeal = len(self.runtaskentries)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            query = None
+            while ready:
+                bb.parse.siggen.prep_file_checksums(ready, self.dataCaches)
+                for tid in ready:
                     self.runtaskentries[tid].taskhash_deps = bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+
+                if query:
+                    set_unihashes(query)
+                for tid in ready:
                     # get_taskhash for a given tid *must* be called before get_unihash* below
                     self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-                    ready.add(tid)
-            unihashes = bb.parse.siggen.get_unihashes(ready)
-            for tid in ready:
-                dealtwith.add(tid)
-                todeal.remove(tid)
-                self.runtaskentries[tid].unihash = unihashes[tid]
+                query = executor.submit(bb.parse.siggen.get_unihashes, ready)
 
-            bb.event.check_for_interrupts()
+                todeal -= len(ready)
+                nextready = []
+                for tid in ready:
+                    for revdep in self.runtaskentries[tid].revdeps:
+                        depsleft[revdep] -= 1
+                        if not depsleft[revdep]:
+                            nextready.append(revdep)
+                ready = nextready
 
-            if time.time() > (lasttime + 30):
-                lasttime = time.time()
-                hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (len(todeal), len(self.runtaskentries), lasttime - starttime))
+                bb.event.check_for_interrupts()
+
+                if time.time() > (lasttime + 30):
+                    lasttime = time.time()
+                    hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (todeal, len(self.runtaskentries), lasttime - starttime))
+
+            if query:
+                set_unihashes(query)
 
         endtime = time.time()
         if (endtime-starttime > 60):
             hashequiv_logger.verbose("Initial setup loop took: %s" % (endtime-starttime))
 
+        stats = bb.parse.siggen.get_unihash_stats()
+        if stats:
+            hashequiv_logger.verbose("Unihash lookups: %s answered locally, %s sent to the server" %
+                    (stats.get("task", 0) + stats.get("memory", 0) + stats.get("local", 0), stats.get("server", 0)))
+            bb.event.fire(UniHashCacheStats(stats), self.cooker.data)
+
         bb.parse.siggen.writeout_file_checksum_cache()
 
         #self.dump_data()
@@ -1392,6 +1430,7 @@ class RunQueue:
 
         workerdata = {
             "sigdata" : bb.parse.siggen.get_taskdata(),
+            "trace" : bb.trace.tracer.path if bb.trace.tracer else None,
             "logdefaultlevel" : bb.msg.loggerDefaultLogLevel,
             "build_verbose_shell" : self.cooker.configuration.build_verbose_shell,
             "build_verbose_stdout" : self.cooker.configuration.build_verbose_stdout,
@@ -1540,7 +1579,8 @@ class RunQueue:
                 sq_data['hashfn'][tid] = self.rqdata.dataCaches[mc].hashfn[taskfn]
                 sq_data['unihash'][tid] = self.rqdata.runtaskentries[tid].unihash
 
-            valid = self.validate_hash(sq_data, data, siginfo, currentcount, summary)
+            with bb.trace.span("validate_hashes", "runqueue", tasks=len(sq_data['hash'])):
+                valid = self.validate_hash(sq_data, data, siginfo, currentcount, summary)
 
         return valid
 
@@ -1813,12 +1853,13 @@ class RunQueue:
 
     def write_diffscenetasks(self, invalidtasks):
         bb.siggen.check_siggen_version(bb.siggen)
+        sigindex = bb.siggen.SigIndex.from_data(self.cfgData)
 
         # Define recursion callback
         def recursecb(key, hash1, hash2):
             hashes = [hash1, hash2]
             bb.debug(1, "Recursively looking for recipe {} hashes {}".format(key, hashes))
-            hashfiles = bb.siggen.find_siginfo(key, None, hashes, self.cfgData)
+            hashfiles = bb.siggen.find_siginfo_indexed(key, None, hashes, self.cfgData, sigindex)
             bb.debug(1, "Found hashfiles:\n{}".format(hashfiles))
 
             recout = []
@@ -1836,7 +1877,7 @@ class RunQueue:
             pn = self.rqdata.dataCaches[mc].pkg_fn[taskfn]
             h = self.rqdata.runtaskentries[tid].unihash
             bb.debug(1, "Looking for recipe {} task {}".format(pn, taskname))
-            matches = bb.siggen.find_siginfo(pn, taskname, [], self.cooker.databuilder.mcdata[mc])
+            matches = bb.siggen.find_siginfo_indexed(pn, taskname, [], self.cooker.databuilder.mcdata[mc], sigindex)
             bb.debug(1, "Found hashfiles:\n{}".format(matches))
             match = None
             for m in matches.values():
@@ -2203,7 +2244,10 @@ class RunQueueExecute:
         """
         Run the tasks in a queue prepared by prepare_runqueue
         """
+        with bb.trace.span("RunQueueExecute.execute", "runqueue"):
+            return self._execute()
 
+    def _execute(self):
         self.rq.read_workers()
         if self.updated_taskhash_queue or self.pending_migrations:
             self.process_possible_migrations()
@@ -3310,6 +3354,17 @@ class taskUniHashUpdate(bb.event.Event):
         self.unihash = unihash
         bb.event.Event.__init__(self)
 
+class UniHashCacheStats(bb.event.Event):
+    """
+    Event reporting how many unihash lookups of setscene tasks were answered
+    from the unitaskhashes ("task"), in memory ("memory") and local
+    persistent ("local") caches and how many were sent to the server
+    ("server")
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        bb.event.Event.__init__(self)
+
 class PSIEvent(bb.event.Event):
     def __init__(self, pressure_state, pressure_values):
         super().__init__()
@@ -0,0 +1,558 @@
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+"""
+BitBake shell scanner
+
+A fast, hand written recogniser for the shell syntax commonly found in
+metadata functions. It follows the tokenisation rules of bb.pysh.pyshlex and
+the subset of the bb.pysh.pyshyacc grammar needed to locate the words the
+codeparser inspects: the words of simple commands, for loop items and case
+patterns, grouped exactly as pysh groups them, plus the names of any shell
+functions defined.
+
+Anything outside that subset, including everything pysh itself would reject,
+raises Unsupported so the caller can fall back to the full pysh parser. The
+scanner never accepts input pysh would handle differently.
+"""
+
+import re
+
+from bb.pysh import pyshlex
+
+class Unsupported(Exception):
+    """The input is outside the subset handled by the scanner"""
+
+_OPERATORS = {
+    '&&': 'AND_IF',
+    '||': 'OR_IF',
+    ';;': 'DSEMI',
+    '<<': 'DLESS',
+    '>>': 'DGREAT',
+    '<&': 'LESSAND',
+    '>&': 'GREATAND',
+    '<>': 'LESSGREAT',
+    '<<-': 'DLESSDASH',
+    '>|': 'CLOBBER',
+    '&': 'AMP',
+    ';': 'COMMA',
+    '<': 'LESS',
+    '>': 'GREATER',
+    '(': 'LPARENS',
+    ')': 'RPARENS',
+    # Not an operator for pysh, but lexed as one and then mapped to the
+    # reserved word of the same name
+    '|': 'PIPE',
+}
+
+_RESERVED = {
+    'if': 'If',
+    'then': 'Then',
+    'else': 'Else',
+    'elif': 'Elif',
+    'fi': 'Fi',
+    'do': 'Do',
+    'done': 'Done',
+    'case': 'Case',
+    'esac': 'Esac',
+    'while': 'While',
+    'until': 'Until',
+    'for': 'For',
+    '{': 'Lbrace',
+    '}': 'Rbrace',
+    '!': 'Bang',
+    'in': 'In',
+    '|': 'PIPE',
+}
+
+_REDIRECTS = frozenset(('LESS', 'LESSAND', 'GREATER', 'GREATAND', 'DGREAT', 'LESSGREAT', 'CLOBBER'))
+_HEREDOCS = frozenset(('DLESS', 'DLESSDASH'))
+_REDIRECT_START = _REDIRECTS | _HEREDOCS | frozenset(('IO_NUMBER',))
+
+# Tokens which may follow a command name as arguments
+_SUFFIX_WORDS = frozenset(('TOKEN', 'Fi', 'For', 'Done', 'Do', 'Until', 'ASSIGNMENT_WORD', 'If', 'Then', 'Bang'))
+
+# Tokens which may start a command
+_COMMAND_START = frozenset(('TOKEN', 'ASSIGNMENT_WORD', 'Bang', 'Lbrace', 'LPARENS',
+                            'For', 'Case', 'If', 'While', 'Until')) | _REDIRECT_START
+
+_re_blank = re.compile(r'[ \t]+')
+_re_plain = re.compile(r'[^ \t\n;&|<>()\\\'"`$]+')
+_re_name = re.compile(r'^[0-9a-zA-Z_]+$')
+_re_digits = re.compile(r'^\d+$')
+
+# Characters ending a run of literal text inside each kind of quoted or
+# expansion expression, and the character closing it
+_QUOTED = {
+    '"': (re.compile(r'[$\\`"]'), '"'),
+    '`': (re.compile(r'[$\\`"\']'), '`'),
+    '$(': (re.compile(r'[$\\`"\')]'), ')'),
+    '${': (re.compile(r'[$\\`"\'}]'), '}'),
+}
+
+def _quoted(s, i, cuts):
+    """Return the end of the quoted or expansion expression starting at s[i],
+    as delimited by pyshlex.WordLexer. Line continuations removed by the
+    lexer are recorded in cuts.
+    """
+    c = s[i]
+    if c == '\\':
+        if i + 1 >= len(s):
+            raise Unsupported()
+        if s[i + 1] == '\n':
+            cuts.append(i)
+        return i + 2
+    if c == "'":
+        end = s.find("'", i + 1)
+        if end < 0:
+            raise Unsupported()
+        return end + 1
+    if c == '$':
+        nxt = s[i + 1:i + 2]
+        if nxt == '(':
+            if s[i + 2:i + 3] in ('(', ''):
+                # Arithmetic expansion is not implemented by pysh
+                raise Unsupported()
+            return _delimited(s, i + 2, '$(', cuts)
+        if nxt == '{':
+            return _delimited(s, i + 2, '${', cuts)
+        if not nxt:
+            raise Unsupported()
+        if nxt in '@*#?-$!0':
+            return i + 2
+        # Parameter names are made of ordinary word characters
+        return i + 1
+    return _delimited(s, i + 1, c, cuts)
+
+def _delimited(s, i, kind, cuts):
+    special, close = _QUOTED[kind]
+    while True:
+        m = special.search(s, i)
+        if m is None:
+            raise Unsupported()
+        i = m.start()
+        if s[i] == close:
+            return i + 1
+        i = _quoted(s, i, cuts)
+
+class _Lexer(object):
+    """Split shell code into the token stream pyshlex.PLYLexer produces"""
+
+    def __init__(self, s):
+        self.s = s
+        self.types = []
+        self.values = []
+        self.for_count = None
+        # Pending here-document state: the operator, its delimiter and the
+        # tokens following it on the same line
+        self.heredoc = None
+        self.herename = None
+        self.pendings = None
+
+    def tokenize(self):
+        s = self.s
+        n = len(s)
+        i = 0
+        token = ''
+        cuts = []
+        while i < n:
+            c = s[i]
+            if c == '\n':
+                self.push(token, c)
+                token = ''
+                self.push_newline()
+                i += 1
+                if self.heredoc and self.herename is not None:
+                    i = self.read_heredoc(i)
+            elif c in '\\\'"`$':
+                end = _quoted(s, i, cuts)
+                if cuts:
+                    token += ''.join(s[start:stop] for start, stop in zip([i] + [x + 2 for x in cuts], cuts + [end]))
+                    cuts = []
+                else:
+                    token += s[i:end]
+                i = end
+            elif c in ';&|<>()':
+                self.push(token, c)
+                token = ''
+                op = s[i:i + 3]
+                if op != '<<-':
+                    op = s[i:i + 2]
+                    if op not in _OPERATORS:
+                        op = c
+                i += len(op)
+                self.push_op(op)
+            elif c in ' \t':
+                self.push(token, c)
+                token = ''
+                i = _re_blank.match(s, i).end()
+            elif c == '#' and not token:
+                i = s.find('\n', i)
+                if i < 0:
+                    # pysh fails on comments not terminated by a newline
+                    raise Unsupported()
+            else:
+                end = _re_plain.match(s, i).end()
+                token += s[i:end]
+                i = end
+        self.push(token, '')
+        if self.heredoc:
+            raise Unsupported()
+        return self.types, self.values
+
+    def push(self, token, delim):
+        if not token:
+            return
+        if self.heredoc:
+            if self.herename is None:
+                try:
+                    self.herename = pyshlex.unquote_wordtree(pyshlex.make_wordtree(token))
+                except Exception:
+                    raise Unsupported()
+                if not self.herename or self.herename in ('<', '>'):
+                    raise Unsupported()
+                self.emit('HERENAME', token)
+            else:
+                self.pendings.append((self.push, token, delim))
+            return
+        kind = 'TOKEN'
+        if '=' in token and not delim:
+            if not token.startswith('=') and _re_name.search(token[:token.find('=')]):
+                kind = 'ASSIGNMENT_WORD'
+        else:
+            reserved = _RESERVED.get(token)
+            if reserved is not None:
+                if reserved != 'In' or self.for_count == 2:
+                    kind = reserved
+                    if reserved in ('For', 'Case'):
+                        self.for_count = 0
+            elif delim in ('<', '>') and _re_digits.search(token):
+                kind = 'IO_NUMBER'
+        self.emit(kind, token)
+
+    def push_op(self, op):
+        if self.heredoc:
+            if self.herename is None or op in ('<<', '<<-'):
+                raise Unsupported()
+            self.pendings.append((self.push_op, op))
+            return
+        if op in ('<<', '<<-'):
+            self.heredoc = op
+            self.herename = None
+            self.pendings = []
+        self.emit(_OPERATORS[op], op)
+
+    def push_newline(self):
+        if self.heredoc:
+            if self.herename is None:
+                raise Unsupported()
+            self.pendings.append((self.push_newline,))
+            return
+        self.emit('NEWLINE', '\n')
+
+    def emit(self, kind, token):
+        if self.for_count is not None:
+            self.for_count += 1
+            if self.for_count == 3:
+                self.for_count = None
+        self.types.append(kind)
+        self.values.append(token)
+
+    def read_heredoc(self, i):
+        """Read the here-document body starting at s[i] the way
+        pyshlex.HereDocLexer does, then release the pending tokens.
+        """
+        s = self.s
+        content = []
+        while True:
+            end = s.find('\n', i)
+            while end >= 0:
+                # Newlines can be escaped by an odd number of backslashes
+                start = end
+                while start > i and s[start - 1] == '\\':
+                    start -= 1
+                if not (end - start) % 2:
+                    break
+                end = s.find('\n', end + 1)
+            if end < 0:
+                raise Unsupported()
+            line = s[i:end]
+            i = end + 1
+            if self.heredoc == '<<-':
+                line = line.lstrip('\t')
+            if line == self.herename:
+                break
+            content.append(line + '\n')
+
+        if not content:
+            raise Unsupported()
+        pendings = self.pendings
+        self.heredoc = self.herename = self.pendings = None
+        self.emit('TOKEN', ''.join(content))
+        for pending in pendings:
+            pending[0](*pending[1:])
+        return i
+
+class _Parser(object):
+    """Recursive descent recogniser for the pysh grammar subset, collecting
+    the word lists pysh would hand to ShellParser.process_words().
+    """
+
+    def __init__(self, types, values):
+        self.types = types + ['EOF']
+        self.values = values + ['']
+        self.pos = 0
+        self.groups = []
+        self.funcdefs = []
+
+    def parse(self):
+        self.linebreak()
+        while self.types[self.pos] != 'EOF':
+            while True:
+                self.and_or()
+                kind = self.types[self.pos]
+                if kind in ('COMMA', 'AMP'):
+                    self.pos += 1
+                    if self.types[self.pos] in _COMMAND_START:
+                        continue
+                    self.linebreak()
+                elif kind == 'NEWLINE':
+                    self.linebreak()
+                elif kind != 'EOF':
+                    raise Unsupported()
+                break
+        return self.funcdefs, self.groups
+
+    def expect(self, kind):
+        if self.types[self.pos] != kind:
+            raise Unsupported()
+        self.pos += 1
+
+    def linebreak(self):
+        types = self.types
+        while types[self.pos] == 'NEWLINE':
+            self.pos += 1
+
+    def compound_list(self):
+        self.linebreak()
+        types = self.types
+        while True:
+            self.and_or()
+            kind = types[self.pos]
+            if kind in ('COMMA', 'AMP'):
+                self.pos += 1
+                self.linebreak()
+            elif kind == 'NEWLINE':
+                self.linebreak()
+            else:
+                return
+            if types[self.pos] not in _COMMAND_START:
+                # pysh does not implement a trailing '&' in compound lists
+                if kind == 'AMP':
+                    raise Unsupported()
+                return
+
+    def and_or(self):
+        self.pipeline()
+        while self.types[self.pos] in ('AND_IF', 'OR_IF'):
+            self.pos += 1
+            self.linebreak()
+            self.pipeline()
+
+    def pipeline(self):
+        if self.types[self.pos] == 'Bang':
+            self.pos += 1
+        self.command()
+        while self.types[self.pos] == 'PIPE':
+            self.pos += 1
+            self.linebreak()
+            self.command()
+
+    def command(self, function=False):
+        kind = self.types[self.pos]
+        if kind == 'TOKEN' and not function:
+            if self.types[self.pos + 1] == 'LPARENS':
+                self.function_definition()
+            else:
+                self.simple_command()
+            return
+        if kind == 'Lbrace':
+            self.pos += 1
+            self.compound_list()
+            self.expect('Rbrace')
+        elif kind == 'LPARENS':
+            self.pos += 1
+            self.compound_list()
+            self.expect('RPARENS')
+        elif kind == 'If':
+            self.if_clause()
+        elif kind in ('While', 'Until'):
+            self.pos += 1
+            self.compound_list()
+            self.do_group()
+        elif kind == 'For':
+            self.for_clause()
+        elif kind == 'Case':
+            self.case_clause()
+        elif not function and kind in _COMMAND_START:
+            self.simple_command()
+            return
+        else:
+            raise Unsupported()
+
+        if self.types[self.pos] in _REDIRECT_START:
+            if function:
+                # Function redirections are not implemented by pysh
+                raise Unsupported()
+            while self.redirect():
+                pass
+
+    def redirect(self):
+        types = self.types
+        pos = self.pos
+        if types[pos] == 'IO_NUMBER':
+            pos += 1
+        kind = types[pos]
+        if kind in _REDIRECTS:
+            if types[pos + 1] != 'TOKEN':
+                raise Unsupported()
+            self.pos = pos + 2
+        elif kind in _HEREDOCS:
+            if types[pos + 1] != 'HERENAME' or types[pos + 2] != 'TOKEN':
+                raise Unsupported()
+            self.pos = pos + 3
+        elif pos != self.pos:
+            raise Unsupported()
+        else:
+            return False
+        return True
+
+    def simple_command(self):
+        types = self.types
+        values = self.values
+        start = self.pos
+        assigns = []
+        while True:
+            if types[self.pos] == 'ASSIGNMENT_WORD':
+                assigns.append(values[self.pos].split('=', 1))
+                self.pos += 1
+            elif not self.redirect():
+                break
+
+        words = []
+        if self.pos == start:
+            if types[self.pos] != 'TOKEN':
+                raise Unsupported()
+            words.append(('cmd_name', values[self.pos]))
+        elif types[self.pos] == 'TOKEN':
+            words.append(('cmd_word', values[self.pos]))
+        elif types[self.pos] == 'Fi':
+            raise Unsupported()
+
+        if words:
+            self.pos += 1
+            while True:
+                if types[self.pos] in _SUFFIX_WORDS:
+                    words.append(('TOKEN', values[self.pos]))
+                    self.pos += 1
+                elif not self.redirect():
+                    break
+
+        if words or assigns:
+            self.groups.append(words + assigns)
+
+    def function_definition(self):
+        name = self.values[self.pos]
+        self.pos += 2
+        self.expect('RPARENS')
+        self.linebreak()
+        self.command(function=True)
+        self.funcdefs.append(name)
+
+    def if_clause(self):
+        self.pos += 1
+        self.compound_list()
+        self.expect('Then')
+        self.compound_list()
+        while self.types[self.pos] == 'Elif':
+            self.pos += 1
+            self.compound_list()
+            self.expect('Then')
+            self.compound_list()
+        if self.types[self.pos] == 'Else':
+            self.pos += 1
+            self.compound_list()
+        self.expect('Fi')
+
+    def do_group(self):
+        self.expect('Do')
+        self.compound_list()
+        self.expect('Done')
+
+    def for_clause(self):
+        types = self.types
+        self.pos += 1
+        self.expect('TOKEN')
+        # pysh does not implement loops without an 'in' list
+        self.expect('In')
+        items = []
+        while types[self.pos] in ('TOKEN', 'Fi'):
+            items.append(('TOKEN', self.values[self.pos]))
+            self.pos += 1
+        if types[self.pos] == 'COMMA':
+            self.pos += 1
+        elif types[self.pos] != 'NEWLINE':
+            raise Unsupported()
+        self.linebreak()
+        self.do_group()
+        if items:
+            self.groups.append(items)
+
+    def case_clause(self):
+        types = self.types
+        self.pos += 1
+        self.expect('TOKEN')
+        self.expect('In')
+        self.linebreak()
+        patterns = []
+        while types[self.pos] != 'Esac':
+            parens = types[self.pos] == 'LPARENS'
+            if parens:
+                self.pos += 1
+            item = []
+            while True:
+                if types[self.pos] not in ('TOKEN', 'Fi'):
+                    raise Unsupported()
+                item.append(('TOKEN', self.values[self.pos]))
+                self.pos += 1
+                if types[self.pos] != 'PIPE':
+                    break
+                self.pos += 1
+            self.expect('RPARENS')
+            self.linebreak()
+            if types[self.pos] not in ('DSEMI', 'Esac'):
+                self.compound_list()
+            if types[self.pos] == 'DSEMI':
+                self.pos += 1
+                self.linebreak()
+            elif types[self.pos] != 'Esac':
+                raise Unsupported()
+            elif parens:
+                # pysh loses the patterns of a final "(pattern)" item
+                # without ';;'
+                continue
+            patterns.extend(item)
+        self.pos += 1
+        if patterns:
+            self.groups.append(patterns)
+
+def scan(value):
+    """Return the shell functions defined in value and the lists of words
+    pysh would pass to ShellParser.process_words(), in the same order.
+    Raise Unsupported if value needs the full pysh parser.
+    """
+    types, values = _Lexer(value).tokenize()
+    return _Parser(types, values).parse()
@@ -4,11 +4,14 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import collections
 import hashlib
 import logging
 import os
 import re
+import sqlite3
 import tempfile
+import time
 import pickle
 import bb.data
 import difflib
@@ -17,6 +20,7 @@ import json
 import types
 from contextlib import contextmanager
 import bb.compress.zstd
+from bb.cache import MultiProcessCache
 from bb.checksum import FileChecksumCache
 from bb import runqueue
 import hashserv
@@ -123,6 +127,12 @@ class SignatureGenerator(object):
     def get_unihashes(self, tids):
         return {tid: self.get_unihash(tid) for tid in tids}
 
+    def get_unihash_stats(self):
+        return {}
+
+    def prep_file_checksums(self, tids, dataCaches):
+        return
+
     def prep_taskhash(self, tid, deps, dataCaches):
         return
 
@@ -238,6 +248,8 @@ class SignatureGeneratorBasic(SignatureGenerator):
         self.unihash_cache = bb.cache.SimpleCache("3")
         self.unitaskhashes = self.unihash_cache.init_cache(data, "bb_unihashes.dat", {})
         self.localdirsexclude = (data.getVar("BB_SIGNATURE_LOCAL_DIRS_EXCLUDE") or "CVS .bzr .git .hg .osc .p4 .repo .svn").split()
+        self.prepped_file_checksums = {}
+        self.sigindex = SigIndex(data.getVar("PERSISTENT_DIR") or data.getVar("CACHE"))
         self.tidtopn = {}
 
     def init_rundepcheck(self, data):
@@ -250,7 +262,10 @@ class SignatureGeneratorBasic(SignatureGenerator):
     def _build_data(self, mcfn, d):
 
         ignore_mismatch = ((d.getVar("BB_HASH_IGNORE_MISMATCH") or '') == '1')
+        start = time.monotonic()
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d, self.basehash_ignore_vars)
+        if bb.parse.parse_profile:
+            bb.parse.parse_profile.add_recipe("dependencies", time.monotonic() - start)
 
         taskdeps, basehash = bb.data.generate_dependency_hash(tasklist, gendeps, lookupcache, self.basehash_ignore_vars, mcfn)
 
@@ -330,6 +345,33 @@ class SignatureGeneratorBasic(SignatureGenerator):
             pass
         return taint
 
+    def get_file_checksums(self, filelist, recipename):
+        if self.checksum_cache:
+            return self.checksum_cache.get_checksums(filelist, recipename, self.localdirsexclude)
+        return bb.fetch2.get_file_checksums(filelist, recipename, self.localdirsexclude)
+
+    def prep_file_checksums(self, tids, dataCaches):
+        """
+        Compute the file checksums prep_taskhash() needs for tids in one go,
+        so the files of all of the tasks which aren't in the checksum cache
+        are checksummed by a single pool of threads
+        """
+        filelists = {}
+        for tid in tids:
+            (mc, _, task, mcfn) = bb.runqueue.split_tid_mcfn(tid)
+            if task in dataCaches[mc].file_checksums[mcfn]:
+                filelists[(dataCaches[mc].file_checksums[mcfn][task], dataCaches[mc].pkg_fn[mcfn])] = None
+
+        if len(filelists) < 2:
+            self.prepped_file_checksums = {}
+            return
+
+        if self.checksum_cache:
+            checksums = self.checksum_cache.get_checksums_multi(list(filelists), self.localdirsexclude)
+        else:
+            checksums = bb.fetch2.get_file_checksums_multi(filelists, self.localdirsexclude)
+        self.prepped_file_checksums = dict(zip(filelists, checksums))
+
     def prep_taskhash(self, tid, deps, dataCaches):
 
         (mc, _, task, mcfn) = bb.runqueue.split_tid_mcfn(tid)
@@ -355,10 +397,10 @@ class SignatureGeneratorBasic(SignatureGenerator):
             self.runtaskdeps[tid].append((dep_pnid, dep))
 
         if task in dataCaches[mc].file_checksums[mcfn]:
-            if self.checksum_cache:
-                checksums = self.checksum_cache.get_checksums(dataCaches[mc].file_checksums[mcfn][task], recipename, self.localdirsexclude)
-            else:
-                checksums = bb.fetch2.get_file_checksums(dataCaches[mc].file_checksums[mcfn][task], recipename, self.localdirsexclude)
+            key = (dataCaches[mc].file_checksums[mcfn][task], recipename)
+            checksums = self.prepped_file_checksums.get(key)
+            if checksums is None:
+                checksums = self.get_file_checksums(*key)
             for (f,cs) in checksums:
                 self.file_checksum_values[tid].append((f,cs))
 
@@ -478,9 +520,10 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
         fd, tmpfile = bb.utils.mkstemp(dir=os.path.dirname(sigfile), prefix="sigtask.")
         try:
-            with bb.compress.zstd.open(fd, "wt", encoding="utf-8", num_threads=1) as f:
-                json.dump(data, f, sort_keys=True, separators=(",", ":"), cls=SetEncoder)
-                f.flush()
+            # Serialise up front so the file is compressed in a single write
+            # rather than in the many small chunks json.dump() produces
+            with bb.compress.zstd.open(fd, "wb", num_threads=1) as f:
+                f.write(json.dumps(data, sort_keys=True, separators=(",", ":"), cls=SetEncoder).encode("utf-8"))
             os.chmod(tmpfile, 0o664)
             bb.utils.rename(tmpfile, sigfile)
         except (OSError, IOError) as err:
@@ -490,6 +533,10 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 pass
             raise err
 
+        if tid in self.tidtopn:
+            self.sigindex.add(mc, self.tidtopn[tid], task, data.get('unihash') or data['basehash'],
+                              data.get('taskhash'), sigfile, sstate=sigfile.endswith(".siginfo"))
+
 class SignatureGeneratorBasicHash(SignatureGeneratorBasic):
     name = "basichash"
 
@@ -530,9 +577,32 @@ class SignatureGeneratorBasicHash(SignatureGeneratorBasic):
         with open(taintfn, 'w') as taintf:
             taintf.write(str(uuid.uuid4()))
 
+class LocalUnihashCache(MultiProcessCache):
+    """
+    Unihashes returned by the hash equivalence server, keyed by
+    "server method taskhash" and stored along with the time they were
+    returned so they can be given a time to live
+    """
+    cache_file_name = "bb_unihash_cache.sqlite3"
+    CACHE_VERSION = 1
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+
 class SignatureGeneratorUniHashMixIn(object):
+    # Number of (server, method, taskhash) -> unihash answers kept in
+    # memory
+    UNIHASH_LRU_SIZE = 100000
+
     def __init__(self, data):
         self.extramethod = {}
+        self.unihash_lru = collections.OrderedDict()
+        self.unihash_stats = collections.Counter()
+        # Optional persistent copy of the server answers, which lets a new
+        # server process avoid querying the hash equivalence server again
+        self.local_unihashes = None
+        self.local_unihashes_ttl = int(data.getVar("BB_HASHSERVE_LOCAL_CACHE_TTL") or 0)
+        self.local_unihashes_dir = data.getVar("PERSISTENT_DIR") or data.getVar("CACHE")
         # NOTE: The cache only tracks hashes that exist. Hashes that don't
         # exist are always queried from the server since it is possible for
         # hashes to appear over time, but much less likely for them to
@@ -591,7 +661,14 @@ class SignatureGeneratorUniHashMixIn(object):
 
     def reset(self, data):
         self.__close_clients()
-        return super().reset(data)
+        # Keep the server answers for the next build with this signature
+        # generator. They are keyed by server so a changed BB_HASHSERVE
+        # doesn't reuse them. A reparse creates a new signature generator
+        # and so starts with none.
+        unihash_lru = self.unihash_lru
+        ret = super().reset(data)
+        self.unihash_lru = unihash_lru
+        return ret
 
     def exit(self):
         self.__close_clients()
@@ -622,6 +699,11 @@ class SignatureGeneratorUniHashMixIn(object):
         key = mc + ":" + self.tidtopn[tid] + ":" + taskname
         self.unitaskhashes[key] = (self.taskhash[tid], unihash)
         self.unihash[tid] = unihash
+        # Keep the in memory server answers coherent with updates made during
+        # the build
+        lrukey = (self.server, self._get_method(tid), self.taskhash[tid])
+        if lrukey in self.unihash_lru:
+            self.unihash_lru[lrukey] = unihash
 
     def _get_unihash(self, tid, checkkey=None):
         if tid not in self.tidtopn:
@@ -685,33 +767,109 @@ class SignatureGeneratorUniHashMixIn(object):
 
         return result
 
+    def get_local_unihashes(self):
+        if self.local_unihashes is None and self.local_unihashes_ttl > 0 and self.local_unihashes_dir:
+            self.local_unihashes = LocalUnihashCache()
+            self.local_unihashes.init_cache(self.local_unihashes_dir)
+        return self.local_unihashes
+
+    def get_known_unihash(self, method, taskhash, stats=None):
+        """
+        Return the unihash the server previously returned for method and
+        taskhash, looking in memory and then in the local persistent cache.
+        Where it was found is counted in stats if given.
+        """
+        key = (self.server, method, taskhash)
+        unihash = self.unihash_lru.get(key)
+        if unihash is not None:
+            self.unihash_lru.move_to_end(key)
+            if stats is not None:
+                stats["memory"] += 1
+            return unihash
+
+        local = self.get_local_unihashes()
+        if local is not None:
+            localkey = "%s %s %s" % (self.server, method, taskhash)
+            entry = local.cachedata_extras[0].get(localkey) or local.cachedata[0].get(localkey)
+            if entry is not None and entry[1] + self.local_unihashes_ttl > time.time():
+                self.add_known_unihash(method, taskhash, entry[0], persist=False)
+                if stats is not None:
+                    stats["local"] += 1
+                return entry[0]
+
+        return None
+
+    def add_known_unihash(self, method, taskhash, unihash, persist=True):
+        self.unihash_lru[(self.server, method, taskhash)] = unihash
+        while len(self.unihash_lru) > self.UNIHASH_LRU_SIZE:
+            self.unihash_lru.popitem(last=False)
+
+        local = self.get_local_unihashes()
+        if persist and local is not None:
+            localkey = "%s %s %s" % (self.server, method, taskhash)
+            local.cachedata_extras[0][localkey] = (unihash, time.time())
+
+    def get_unihash_stats(self):
+        return dict(self.unihash_stats)
+
+    def save_unitaskhashes(self):
+        if self.local_unihashes is not None:
+            self.local_unihashes.flush_extras()
+            self.local_unihashes.save_merge()
+        super().save_unitaskhashes()
+
     def get_unihash(self, tid):
-        return self.get_unihashes([tid])[tid]
+        # Single lookups are mostly those of the dependencies of a task, made
+        # after their own lookup, so they are left out of the statistics
+        return self._get_unihashes([tid], None)[tid]
 
     def get_unihashes(self, tids):
         """
         For a iterable of tids, returns a dictionary that maps each tid to a
         unihash
         """
+        return self._get_unihashes(tids, self.unihash_stats)
+
+    def _get_unihashes(self, tids, stats):
         result = {}
+        lookup_tids = []
         query_tids = []
+        known = {}
 
         for tid in tids:
             unihash = self.get_cached_unihash(tid)
             if unihash:
                 result[tid] = unihash
+                # Tasks without setscene tasks don't have unihashes to look up
+                if stats is not None and (not self.setscenetasks or tid in self.setscenetasks):
+                    stats["task"] += 1
+                continue
+            lookup_tids.append(tid)
+            unihash = self.get_known_unihash(self._get_method(tid), self.taskhash[tid], stats)
+            if unihash:
+                known[tid] = unihash
             else:
                 query_tids.append(tid)
 
         if query_tids:
             unihashes = []
+            if stats is not None:
+                stats["server"] += len(query_tids)
             try:
                 with self.client() as client:
                     unihashes = client.get_unihash_batch((self._get_method(tid), self.taskhash[tid]) for tid in query_tids)
             except (ConnectionError, FileNotFoundError, EOFError) as e:
                 bb.warn('Error contacting Hash Equivalence Server %s: %s' % (self.server, str(e)))
 
-        for idx, tid in enumerate(query_tids):
+            for idx, tid in enumerate(query_tids):
+                if unihashes and unihashes[idx]:
+                    self.add_known_unihash(self._get_method(tid), self.taskhash[tid], unihashes[idx])
+                    known[tid] = unihashes[idx]
+
+        if lookup_tids and stats is not None:
+            hashequiv_logger.debug("Unihash lookups: %s" % ", ".join("%s %d" % (k, v) for k, v in sorted(self.unihash_stats.items())))
+
+        for tid in lookup_tids:
             # In the absence of being able to discover a unique hash from the
             # server, make it be equivalent to the taskhash. The unique "hash" only
             # really needs to be a unique string (not even necessarily a hash), but
@@ -727,8 +885,8 @@ class SignatureGeneratorUniHashMixIn(object):
             #    the unique hash.
             taskhash = self.taskhash[tid]
 
-            if unihashes and unihashes[idx]:
-                unihash = unihashes[idx]
+            if tid in known:
+                unihash = known[tid]
                 # A unique hash equal to the taskhash is not very interesting,
                 # so it is reported it at debug level 2. If they differ, that
                 # is much more interesting, so it is reported at debug level 1
@@ -880,6 +1038,183 @@ def clean_checksum_file_path(file_checksum_tuple):
         return "./" + f.split("/./")[1]
     return os.path.basename(f)
 
+class SigIndex(object):
+    """
+    Index of signature files by recipe, task and hash, so bitbake-diffsigs
+    and friends can find them without globbing the stamps and sstate
+    directories and opening the candidates.
+
+    dump_sigtask() adds the files it writes. Queries the index can't answer
+    fall back to the metadata's find_siginfo(), whose results are then added
+    too. A recipe task's files are only listed from the index once such a
+    fallback has seen all of them. As files can also arrive without passing
+    through dump_sigtask(), for example from a shared sstate directory or a
+    mirror, that scan is only trusted for scan_ttl seconds and while the
+    directories the files were found in are unchanged.
+    """
+
+    scan_ttl = 600
+
+    def __init__(self, cachedir):
+        self.indexfile = None
+        if cachedir:
+            self.indexfile = os.path.join(cachedir, "bb_sigindex.sqlite3")
+        self.db = None
+        self.dbpid = None
+
+    @classmethod
+    def from_data(cls, d):
+        return cls(d.getVar("PERSISTENT_DIR") or d.getVar("CACHE"))
+
+    def connection(self):
+        if self.dbpid != os.getpid():
+            if self.db is not None:
+                MultiProcessCache.inherited_connections.append(self.db)
+            bb.utils.mkdirhier(os.path.dirname(self.indexfile))
+            self.db = sqlite3.connect(self.indexfile, timeout=600, isolation_level=None, check_same_thread=False)
+            self.dbpid = os.getpid()
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = OFF")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sigfiles (path TEXT PRIMARY KEY NOT NULL, mc TEXT NOT NULL, pn TEXT NOT NULL, task TEXT NOT NULL, unihash TEXT NOT NULL, taskhash TEXT, mtime REAL, sstate INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS sigfiles_task ON sigfiles (mc, pn, task)")
+            self.db.execute("DROP TABLE IF EXISTS complete")
+            self.db.execute("CREATE TABLE IF NOT EXISTS scans (mc TEXT NOT NULL, pn TEXT NOT NULL, task TEXT NOT NULL, time REAL NOT NULL, dirs TEXT NOT NULL, PRIMARY KEY (mc, pn, task))")
+        return self.db
+
+    @staticmethod
+    def dirstate(dirs):
+        state = []
+        for dirname in sorted(dirs):
+            try:
+                state.append([dirname, os.stat(dirname).st_mtime_ns])
+            except OSError:
+                state.append([dirname, None])
+        return state
+
+    def scan_valid(self, scantime, dirs):
+        if time.time() - scantime > self.scan_ttl:
+            return False
+        dirs = json.loads(dirs)
+        return self.dirstate(dirname for dirname, _ in dirs) == dirs
+
+    def add(self, mc, pn, task, unihash, taskhash, path, sstate=False):
+        """
+        Add a signature file, unihash being the hash in its name (the basehash
+        for sigbasedata files)
+        """
+        if not self.indexfile:
+            return
+        try:
+            self.connection().execute("INSERT OR REPLACE INTO sigfiles (path, mc, pn, task, unihash, taskhash, mtime, sstate) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (path, mc, pn, task, unihash, taskhash, os.stat(path).st_mtime, sstate))
+        except (OSError, sqlite3.Error) as e:
+            bb.debug(1, "Unable to add %s to the signature index: %s" % (path, e))
+
+    def add_found(self, mc, pn, task, found, complete):
+        """
+        Add the files returned by find_siginfo(), with complete set if they
+        are all the signature files of the task
+        """
+        if not self.indexfile:
+            return
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT OR IGNORE INTO sigfiles (path, mc, pn, task, unihash, taskhash, mtime, sstate) VALUES (?, ?, ?, ?, ?, NULL, ?, ?)",
+                           ((entry['path'], mc, pn, task, h, entry['time'], entry.get('sstate', False)) for h, entry in found.items()))
+            if complete:
+                dirs = self.dirstate({os.path.dirname(entry['path']) for entry in found.values()})
+                db.execute("INSERT OR REPLACE INTO scans (mc, pn, task, time, dirs) VALUES (?, ?, ?, ?, ?)",
+                           (mc, pn, task, time.time(), json.dumps(dirs)))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def find(self, mc, pn, task, sigs=None):
+        """
+        Return the signature files of a recipe task in the find_siginfo()
+        format, or None if the index can't tell. With sigs, only the files
+        matching those hashes are returned and all of them must be known.
+        """
+        if not self.indexfile:
+            return None
+
+        db = self.connection()
+        if not sigs:
+            scan = db.execute("SELECT time, dirs FROM scans WHERE mc = ? AND pn = ? AND task = ?", (mc, pn, task)).fetchone()
+            if scan is None or not self.scan_valid(*scan):
+                return None
+
+        result = {}
+        stale = []
+        for path, unihash, taskhash, sstate in db.execute("SELECT path, unihash, taskhash, sstate FROM sigfiles WHERE mc = ? AND pn = ? AND task = ?", (mc, pn, task)).fetchall():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                stale.append((path,))
+                continue
+            if sigs:
+                hashes = [h for h in (unihash, taskhash) if h in sigs]
+            else:
+                hashes = [unihash]
+            for h in hashes:
+                # Prefer files from the stamps directory, as find_siginfo() does
+                if h not in result or (result[h]['sstate'] and not sstate):
+                    result[h] = {'path': path, 'sstate': bool(sstate), 'time': mtime}
+
+        if stale:
+            db.executemany("DELETE FROM sigfiles WHERE path = ?", stale)
+
+        if sigs and not all(h in result for h in sigs):
+            return None
+        # Files may have arrived since the scan found none
+        if not result:
+            return None
+        return result
+
+    def clear(self, mc):
+        if not self.indexfile:
+            return
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM sigfiles WHERE mc = ?", (mc,))
+        db.execute("DELETE FROM scans WHERE mc = ?", (mc,))
+        db.execute("COMMIT")
+
+def find_siginfo_indexed(pn, taskname, sigs, d, index=None):
+    """
+    Wrapper around the metadata's find_siginfo() which answers from the
+    signature index when it can. Takes the same arguments, including a
+    "[mc:<mc>:]<pn>:<task>" key as pn with taskname None. Callers making
+    many queries should pass in a SigIndex to reuse.
+    """
+    mc = d.getVar("BB_CURRENT_MC") or ""
+    indexpn = pn
+    indextask = taskname
+    if not taskname:
+        if pn.startswith("mc:"):
+            _, mc, indexpn, indextask = pn.split(":", 3)
+        else:
+            indexpn, indextask = pn.split(":", 1)
+
+    if index is None:
+        index = SigIndex.from_data(d)
+    try:
+        result = index.find(mc, indexpn, indextask, sigs)
+    except sqlite3.Error as e:
+        bb.debug(1, "Unable to query the signature index: %s" % e)
+        result = None
+    if result is not None:
+        return result
+
+    result = find_siginfo(pn, taskname, sigs, d)
+    try:
+        index.add_found(mc, indexpn, indextask, result, complete=not sigs)
+    except sqlite3.Error as e:
+        bb.debug(1, "Unable to update the signature index: %s" % e)
+    return result
+
 def dump_this_task(outfile, d):
     import bb.parse
     mcfn = d.getVar("BB_FILENAME")
@@ -948,6 +1283,19 @@ def handle_renames(data):
         del data['taskwhitelist']
 
 
+def read_sigfile(path):
+    with bb.compress.zstd.open(path, "rt", encoding="utf-8", num_threads=1) as f:
+        data = json.load(f, object_hook=SetDecoder)
+    handle_renames(data)
+    return data
+
+def load_sigfile(path):
+    try:
+        return read_sigfile(path)
+    except (TypeError, OSError) as err:
+        bb.error("Failed to open sigdata file '%s': %s" % (path, str(err)))
+        raise err
+
 def compare_sigfiles(a, b, recursecb=None, color=False, collapsed=False):
     output = []
 
@@ -968,21 +1316,8 @@ def compare_sigfiles(a, b, recursecb=None, color=False, collapsed=False):
         formatparams.update(values)
         return formatstr.format(**formatparams)
 
-    try:
-        with bb.compress.zstd.open(a, "rt", encoding="utf-8", num_threads=1) as f:
-            a_data = json.load(f, object_hook=SetDecoder)
-    except (TypeError, OSError) as err:
-        bb.error("Failed to open sigdata file '%s': %s" % (a, str(err)))
-        raise err
-    try:
-        with bb.compress.zstd.open(b, "rt", encoding="utf-8", num_threads=1) as f:
-            b_data = json.load(f, object_hook=SetDecoder)
-    except (TypeError, OSError) as err:
-        bb.error("Failed to open sigdata file '%s': %s" % (b, str(err)))
-        raise err
-
-    for data in [a_data, b_data]:
-        handle_renames(data)
+    a_data = load_sigfile(a)
+    b_data = load_sigfile(b)
 
     def dict_diff(a, b, ignored_vars=set()):
         sa = set(a.keys())
@@ -1177,6 +1512,209 @@ def compare_sigfiles(a, b, recursecb=None, color=False, collapsed=False):
     return output
 
 
+# The fields of a signature file needed to tell why its task changed in a
+# whole build comparison; the (bulky) variable values are only read again
+# for the tasks whose own signature changed
+SIGSUMMARY_KEYS = ('task', 'basehash', 'taskhash', 'unihash', 'runtaskhashes', 'file_checksum_values', 'taint')
+
+def find_sigfiles(topdir):
+    """
+    Return the runtime signature files (sigdata and siginfo) under topdir
+    """
+    sigfiles = []
+    for root, dirs, files in os.walk(topdir):
+        for f in files:
+            if ".sigdata." in f or f.endswith(".siginfo"):
+                sigfiles.append(os.path.join(root, f))
+    return sigfiles
+
+def load_sigsummary(path):
+    """
+    Return the summary of a signature file, or None if it can't be read
+    (such as a truncated file)
+    """
+    try:
+        data = read_sigfile(path)
+    except (OSError, ValueError, TypeError):
+        return None
+    summary = {k: data[k] for k in SIGSUMMARY_KEYS if k in data}
+    summary['path'] = path
+    summary['time'] = os.stat(path).st_mtime
+    return summary
+
+def sigfile_name(topdir, summary):
+    """
+    Return the path of a signature file relative to topdir with its hashes
+    (and the hash based sstate subdirectories) left out, which is the same
+    for every signature file of a task
+    """
+    h = summary['unihash']
+    parts = os.path.relpath(summary['path'], topdir).split(os.sep)
+    dirs = [p for i, p in enumerate(parts[:-1]) if p not in (h[:2], h[2:4])]
+    basename = parts[-1]
+    for taskhash in (h, summary.get('taskhash')):
+        if taskhash:
+            basename = basename.replace(taskhash, "*")
+    return os.path.join(*dirs, basename)
+
+def sigfile_owners(pathname):
+    """
+    Return the recipe names and (recipe, task) pairs a signature file name
+    may belong to, for the stamps ("<pn>/..." or "<pn>.<task>...") and sstate
+    ("sstate:<pn>:...") layouts
+    """
+    owners = set()
+    for token in re.split(r"[/:]", pathname):
+        owners.add(token)
+        for i, c in enumerate(token):
+            if c == ".":
+                owners.add((token[:i], token[i + 1:].split(".")[0]))
+    return owners
+
+def load_sigdir(topdir, executor=None):
+    """
+    Load the signature files of a build (a stamps or sstate directory),
+    returning the latest summary of each task by name and the number of
+    files which couldn't be read. Tasks are named by the
+    "[mc:<mc>:]<pn>:<task>" key the tasks depending on them use when it can
+    be told which files it refers to, and by sigfile_name() otherwise.
+    """
+    paths = find_sigfiles(topdir)
+    if executor:
+        summaries = list(executor.map(load_sigsummary, paths, chunksize=64))
+    else:
+        summaries = [load_sigsummary(path) for path in paths]
+    skipped = summaries.count(None)
+    summaries = [s for s in summaries if s is not None and 'unihash' in s]
+
+    refs = {}
+    for s in summaries:
+        for dep, h in s.get('runtaskhashes', {}).items():
+            refs.setdefault(h, set()).add(dep)
+
+    byhash = {}
+    for s in summaries:
+        s['pathname'] = sigfile_name(topdir, s)
+        byhash.setdefault(s['unihash'], set()).add(s['pathname'])
+
+    # Several tasks may have the same hash, in which case the file names
+    # tell them apart. Naming the files rather than the hashes also names
+    # the older files of a task which nothing refers to any more.
+    pathnames = {}
+    for h, keys in refs.items():
+        candidates = byhash.get(h, set())
+        owners = {}
+        for pathname in candidates:
+            for owner in sigfile_owners(pathname):
+                owners.setdefault(owner, set()).add(pathname)
+        for key in keys:
+            pn, taskname = key.split(":")[-2:]
+            matching = owners.get(pn, set()) | owners.get((pn, taskname), set())
+            if len(matching) == 1:
+                pathnames[matching.pop()] = key
+            elif not matching and len(candidates) == 1 and len(keys) == 1:
+                pathnames[next(iter(candidates))] = key
+
+    tasks = {}
+    for s in summaries:
+        name = pathnames.get(s['pathname'], s['pathname'])
+        if name not in tasks or tasks[name]['time'] < s['time']:
+            tasks[name] = s
+    return tasks, skipped
+
+def compare_sigsummaries(args):
+    a, b, color = args
+    return compare_sigfiles(a, b, color=color, collapsed=True)
+
+def compare_sigdirs(a, b, color=False, jobs=None):
+    """
+    Compare the signature files of two builds, a and b being stamps or sstate
+    directories. Tasks whose own signature changed are reported as root
+    causes, followed by the tree of the tasks which only changed because a
+    task they depend on did.
+    """
+    import concurrent.futures
+
+    output = []
+    colors = init_colors(color)
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    else:
+        executor = None
+
+    try:
+        a_tasks, a_skipped = load_sigdir(a, executor)
+        b_tasks, b_skipped = load_sigdir(b, executor)
+
+        changed = {name for name in a_tasks.keys() & b_tasks.keys() if a_tasks[name]['unihash'] != b_tasks[name]['unihash']}
+        causes = {}
+        unknown = {}
+        roots = []
+        for name in sorted(changed):
+            a_sum = a_tasks[name]
+            b_sum = b_tasks[name]
+            a_deps = a_sum.get('runtaskhashes', {})
+            b_deps = b_sum.get('runtaskhashes', {})
+            depchanges = [dep for dep in sorted(a_deps.keys() & b_deps.keys()) if a_deps[dep] != b_deps[dep]]
+            causes[name] = [dep for dep in depchanges if dep in changed]
+            unknown[name] = [dep for dep in depchanges if dep not in changed]
+            if (a_sum['basehash'] != b_sum['basehash']
+                    or a_deps.keys() != b_deps.keys()
+                    or a_sum.get('file_checksum_values') != b_sum.get('file_checksum_values')
+                    or a_sum.get('taint') != b_sum.get('taint')
+                    or not causes[name]):
+                roots.append(name)
+
+        diffargs = [(a_tasks[name]['path'], b_tasks[name]['path'], color) for name in roots]
+        if executor:
+            diffs = executor.map(compare_sigsummaries, diffargs)
+        else:
+            diffs = map(compare_sigsummaries, diffargs)
+        diffs = dict(zip(roots, diffs))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    dependents = {}
+    for name, deps in causes.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(name)
+
+    output.append("{color_title}{changed} of {total} tasks changed{color_default}, {roots} of them directly; {added} tasks added, {removed} tasks removed".format(
+        changed=len(changed), total=len(b_tasks), roots=len(roots),
+        added=len(b_tasks.keys() - a_tasks.keys()), removed=len(a_tasks.keys() - b_tasks.keys()), **colors))
+    for topdir, skipped in ((a, a_skipped), (b, b_skipped)):
+        if skipped:
+            output.append("Skipped %d unreadable signature files in %s" % (skipped, topdir))
+
+    # Print each task once, under the first root cause it is reached from
+    shown = set(roots)
+    def add_dependents(name, indent):
+        for dep in dependents.get(name, []):
+            if dep in shown:
+                continue
+            shown.add(dep)
+            output.append("%s%s" % (indent, dep))
+            add_dependents(dep, indent + "  ")
+
+    for name in roots:
+        output.append("")
+        output.append("{color_title}{name}{color_default} changed from {a} to {b}".format(
+            name=name, a=a_tasks[name]['unihash'], b=b_tasks[name]['unihash'], **colors))
+        for change in diffs[name]:
+            for line in change.splitlines():
+                output.append("    " + line)
+        for dep in unknown[name]:
+            output.append("    Hash for task dependency %s changed, but its signature files are not in both builds" % dep)
+        before = len(output)
+        add_dependents(name, "      ")
+        if len(output) > before:
+            output.insert(before, "  causing:")
+
+    return output
+
 def calc_basehash(sigdata):
     task = sigdata['task']
     basedata = sigdata['varvals'][task]
@@ -8,7 +8,12 @@
 #
 
 import unittest
+import unittest.mock
+import glob
 import logging
+import multiprocessing
+import os
+import tempfile
 import bb
 
 logger = logging.getLogger('BitBake.TestCodeParser')
@@ -18,6 +23,31 @@ logger = logging.getLogger('BitBake.TestCodeParser')
 import bb.parse
 import bb.data
 
+def metadata_shell_functions():
+    """
+    Return the bodies of the shell functions in the metadata of the test layers
+    """
+    funcstart = bb.parse.parse_py.BBHandler.__func_start_regexp__
+    testdir = os.path.dirname(__file__)
+    files = glob.glob(os.path.join(testdir, "*-tests", "**", "*.bb*"), recursive=True)
+    files += glob.glob(os.path.join(testdir, "*-tests", "**", "*.inc"), recursive=True)
+    funcs = []
+    for fn in sorted(files):
+        body = None
+        with open(fn, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if body is None:
+                    m = funcstart.match(line)
+                    if m and not m.group("py"):
+                        body = []
+                elif line == "}":
+                    funcs.append("\n".join(body))
+                    body = None
+                else:
+                    body.append(line)
+    return funcs
+
 class ReferenceTest(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -216,6 +246,77 @@ END
         self.assertReferences(set(v))
         self.assertExecs(set(["cat"]))
 
+    def test_function_definition(self):
+        self.parseExpression("""
+foo() {
+    bar "$1" | baz
+}
+foo x
+""")
+        self.assertExecs(set(["bar", "baz"]))
+
+    def test_scanner_matches_pysh(self):
+        # The fast shell scanner must give the same results as the full pysh
+        # parser for everything it accepts
+        snippets = [
+            "a=b c='foo bar' alpha 1 2 3",
+            'x=$(foo) y=`bar` cmd $(baz) "$(q)" > $(r)',
+            'o=$(p) $(q) r',
+            'cmd_name=x',
+            'a=$(b)',
+            'echo if then do done fi !',
+            'echo a\\\ngain "$(b\\\nc)" \'d\\\ne\'',
+            'if a; then b; elif c\nthen d; else e; fi',
+            'for f in $(ls *.c) `x`; do gcc -c $f & done',
+            'while read l; do echo "$l"; done < $(f)',
+            'until a || b && c; do :; done',
+            'case $(a) in\n$(b)|c) d;;\n(e) f\nesac',
+            'case x in (a) b\nesac',
+            'foo () {\n\tbar\n}\n( baz ) > /dev/null 2>&1\n! qux',
+            'cat <<EOF | grep $(a)\n$(b)\nEOF\ncat <<-\'E\'\n\tc\n\tE\n',
+            'eval "$(a) b"',
+            '$CC -o x; "$(a)" b',
+            'echo $$(a)',
+            'a # comment $(b)\n# c\nd',
+            'echo a$ b',
+            'echo $\\\n{a',
+            'echo "$(( 1 + 2 ))"',
+            '{ a; } }',
+            'if a; then b; fi c',
+            'for x\nin a; do b; done',
+            'f() { a; } > /dev/null',
+            'cat <<A <<B\na\nA\nb\nB\n',
+            '# trailing comment',
+        ]
+        # Along with the shell functions of the test metadata
+        funcs = metadata_shell_functions()
+        self.assertTrue(funcs)
+        snippets.extend(funcs)
+
+        def parse(value):
+            parser = bb.codeparser.ShellParser("ParserTest", logger)
+            try:
+                parser._parse_shell(value)
+            except Exception as e:
+                return type(e)
+            return parser.allexecs, parser.funcdefs
+
+        def unsupported(value):
+            raise bb.shellscan.Unsupported()
+
+        scanned = 0
+        for snippet in snippets:
+            with self.subTest(snippet=snippet):
+                try:
+                    bb.shellscan.scan(snippet)
+                    scanned += 1
+                except bb.shellscan.Unsupported:
+                    pass
+                result = parse(snippet)
+                with unittest.mock.patch("bb.shellscan.scan", unsupported):
+                    self.assertEqual(result, parse(snippet))
+        self.assertGreater(scanned, len(snippets) // 2)
+
 #    def test_incomplete_command_expansion(self):
 #        self.assertRaises(reftracker.ShellSyntaxError, reftracker.execs,
 #                          bbvalue.shparse("cp foo`", self.d), self.d)
@@ -502,6 +603,48 @@ esac
         # Check final value
         self.assertEqual(self.d.getVar('ANOTHERVAR').split(), ['testval2'])
 
+    def test_dependency_cache(self):
+        cache = bb.data.DependencyCache()
+        context = (frozenset(), (), frozenset(), "")
+
+        def check(key, hit):
+            # The cached result must always match the uncached one
+            d = self.d.createCopy()
+            keys = set(d.keys())
+            hits = cache.hits
+            result = cache.build_dependencies(key, context, keys, set(), set(), [], set(), d, d)
+            self.assertEqual(result, bb.data.build_dependencies(key, keys, set(), set(), [], set(), d, d))
+            self.assertEqual(cache.hits, hits + hit)
+
+        self.d.setVar("OVERRIDES", "a")
+        self.d.setVar("REF", "ref")
+        self.d.setVar("TESTVAR", "x y")
+        self.d.setVar("FOO", 'echo ${REF} ${@bb.utils.contains("TESTVAR", "x", "1", "0", d)}\nrunthis')
+        self.d.setVarFlag("FOO", "func", "1")
+        check("FOO", False)
+        check("FOO", True)
+
+        for change in (
+                lambda: self.d.setVar("REF", "changed"),
+                lambda: self.d.setVar("TESTVAR", "y"),
+                lambda: self.d.setVar("runthis", "echo"),
+                lambda: self.d.setVar("FOO:append", " more"),
+                lambda: self.d.setVar("FOO:append:b", " b"),
+                lambda: self.d.setVar("OVERRIDES", "a:b"),
+                lambda: self.d.setVarFlag("FOO", "vardeps", "${REF}"),
+                lambda: self.d.setVar("REF", "again"),
+                lambda: self.d.setVar("FOO:remove", "${REMOVE}"),
+                lambda: self.d.setVar("REMOVE", "echo")):
+            change()
+            check("FOO", False)
+            check("FOO", True)
+
+        # Variables with overrides aren't cached
+        self.d.setVar("BAR", "bar")
+        self.d.setVar("BAR:a", "${REF}")
+        check("BAR", False)
+        check("BAR", False)
+
     #Currently no wildcard support
     #def test_vardeps_wildcards(self):
     #    self.d.setVar("oe_libinstall", "echo test")
@@ -510,3 +653,104 @@ esac
     #    self.assertEqual(deps, set(["oe_libinstall"]))
 
 
+
+class CodeParserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-codeparser-cache-")
+        self.cachedir = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def new_cache(self):
+        cache = bb.codeparser.CodeParserCache()
+        cache.init_cache(self.cachedir)
+        return cache
+
+    def test_concurrent_writers(self):
+        cache = self.new_cache()
+        cache.shellcacheextras["parent"] = cache.newShellCacheLine(["a"])
+
+        def child():
+            cache.shellcacheextras["child"] = cache.newShellCacheLine(["b"])
+            cache.save_extras()
+
+        # Entries saved by other processes are visible without any merge
+        p = multiprocessing.get_context("fork").Process(target=child)
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(cache.shellcache["child"].execs, frozenset(["b"]))
+
+        cache.save_extras()
+        cache = self.new_cache()
+        self.assertEqual(cache.shellcache["parent"].execs, frozenset(["a"]))
+        self.assertEqual(cache.shellcache["child"].execs, frozenset(["b"]))
+        self.assertNotIn("missing", cache.shellcache)
+
+    def test_version(self):
+        cache = self.new_cache()
+        cache.shellcacheextras["h"] = cache.newShellCacheLine(["a"])
+        cache.save_extras()
+
+        with unittest.mock.patch.object(bb.codeparser.CodeParserCache, "CACHE_VERSION", -1):
+            cache = self.new_cache()
+            self.assertNotIn("h", cache.shellcache)
+
+    def test_expire(self):
+        cache = self.new_cache()
+        for i in range(10):
+            cache.shellcacheextras["h%d" % i] = cache.newShellCacheLine(["a"])
+        cache.save_extras()
+
+        with unittest.mock.patch.object(bb.codeparser.CodeParserCache, "CACHE_MAX_ENTRIES", 5):
+            # Entries in use are kept in preference to the others
+            with unittest.mock.patch.object(bb.codeparser.CodeParserCache, "today", cache.today + 1):
+                cache = self.new_cache()
+                for i in range(5):
+                    self.assertIn("h%d" % i, cache.shellcache)
+                cache.save_extras()
+            cache.save_merge()
+
+        cache = self.new_cache()
+        self.assertEqual(sorted(cache.shellcache), ["h0", "h1", "h2", "h3", "h4"])
+
+        with unittest.mock.patch.object(bb.codeparser.CodeParserCache, "today", cache.today + 100):
+            cache.save_merge()
+        cache = self.new_cache()
+        self.assertEqual(len(cache.shellcache), 0)
+
+    def test_legacy_cache(self):
+        with open(os.path.join(self.cachedir, "bb_codeparser.dat"), "wb") as f:
+            f.write(b"pickled data")
+        with open(os.path.join(self.cachedir, "bb_codeparser.sqlite3"), "wb") as f:
+            f.write(b"not a database" * 100)
+
+        cache = self.new_cache()
+        self.assertFalse(os.path.exists(os.path.join(self.cachedir, "bb_codeparser.dat")))
+        cache.shellcacheextras["h"] = cache.newShellCacheLine(["a"])
+        cache.save_extras()
+        self.assertIn("h", self.new_cache().shellcache)
+
+    def test_damaged_database(self):
+        cache = self.new_cache()
+        for i in range(2000):
+            cache.shellcacheextras["h%d" % i] = cache.newShellCacheLine(["a" * 100])
+        cache.save_extras()
+        cache.db.close()
+        cache.db = None
+
+        cachefile = os.path.join(self.cachedir, "bb_codeparser.sqlite3")
+        with open(cachefile, "r+b") as f:
+            f.seek(os.path.getsize(cachefile) // 2)
+            f.write(b"\xff" * 8192)
+
+        # Lookups in a damaged database are misses and a new database is used
+        cache = self.new_cache()
+        self.assertEqual(len(cache.shellcache), 0)
+        self.assertNotIn("h1000", cache.shellcache)
+        cache.shellcacheextras["new"] = cache.newShellCacheLine(["b"])
+        cache.save_extras()
+        cache.save_merge()
+        cache = self.new_cache()
+        self.assertEqual(sorted(cache.shellcache), ["new"])
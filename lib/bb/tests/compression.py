@@ -5,6 +5,7 @@
 #
 
 from pathlib import Path
+import bb.compress._pipecompress
 import bb.compress.lz4
 import bb.compress.zstd
 import contextlib
@@ -12,6 +13,7 @@ import os
 import shutil
 import tempfile
 import unittest
+import unittest.mock
 import subprocess
 
 
@@ -70,6 +72,18 @@ class LZ4Tests(CompressionTests, unittest.TestCase):
             self.skipTest("'lz4' not found")
         super().setUp()
 
+    @contextlib.contextmanager
+    def do_open(self, *args, **kwargs):
+        with bb.compress._pipecompress.open_wrap(bb.compress.lz4.LZ4File, *args, **kwargs) as f:
+            yield f
+
+
+class LZ4ModuleTests(CompressionTests, unittest.TestCase):
+    def setUp(self):
+        if bb.compress.lz4._lz4frame is None:
+            self.skipTest("'lz4' module not found")
+        super().setUp()
+
     @contextlib.contextmanager
     def do_open(self, *args, **kwargs):
         with bb.compress.lz4.open(*args, **kwargs) as f:
@@ -82,11 +96,63 @@ class ZStdTests(CompressionTests, unittest.TestCase):
             self.skipTest("'zstd' not found")
         super().setUp()
 
+    @contextlib.contextmanager
+    def do_open(self, *args, **kwargs):
+        with bb.compress._pipecompress.open_wrap(bb.compress.zstd.ZstdFile, *args, **kwargs) as f:
+            yield f
+
+
+class ZStdModuleTests(CompressionTests, unittest.TestCase):
+    def setUp(self):
+        if bb.compress.zstd._zstd is None and bb.compress.zstd._zstandard is None:
+            self.skipTest("zstd module not found")
+        super().setUp()
+
     @contextlib.contextmanager
     def do_open(self, *args, **kwargs):
         with bb.compress.zstd.open(*args, **kwargs) as f:
             yield f
 
+    def test_truncated(self):
+        data = os.urandom(1000) * 100
+        tmp_file = self.tmpdir / "compressed"
+        with self.do_open(tmp_file, mode="wb") as f:
+            f.write(data)
+        with tmp_file.open("r+b") as f:
+            f.truncate(os.path.getsize(tmp_file) // 2)
+
+        def check():
+            with self.assertRaises(bb.compress._pipecompress.CompressionError):
+                with self.do_open(tmp_file, mode="rb") as f:
+                    f.read()
+
+        check()
+        # zstandard is used when the standard library has no zstd module
+        if bb.compress.zstd._zstd is not None and bb.compress.zstd._zstandard is not None:
+            with unittest.mock.patch("bb.compress.zstd._zstd", None):
+                check()
+
+    def test_pipe_compatible(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("'zstd' not found")
+
+        data = "Hello\n" * 1000
+        tmp_file = self.tmpdir / "compressed"
+
+        with bb.compress._pipecompress.open_wrap(bb.compress.zstd.ZstdFile, tmp_file, mode="wt") as f:
+            f.write(data)
+        with self.do_open(tmp_file, mode="rt") as f:
+            self.assertEqual(f.read(), data)
+
+        with self.do_open(tmp_file, mode="wt") as f:
+            f.write(data)
+            # Block flushes, as done when writing signature files, must
+            # still produce a stream the zstd tool accepts
+            f.flush()
+            f.write(data)
+        with bb.compress._pipecompress.open_wrap(bb.compress.zstd.ZstdFile, tmp_file, mode="rt") as f:
+            self.assertEqual(f.read(), data + data)
+
 
 class PZStdTests(CompressionTests, unittest.TestCase):
     def setUp(self):
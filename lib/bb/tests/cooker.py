@@ -10,6 +10,7 @@ import unittest
 import os
 import bb, bb.cooker
 import re
+import time
 import logging
 
 # Cooker tests
@@ -69,3 +70,67 @@ class CookerTest(unittest.TestCase):
         expected = []
 
         self.assertEqual(log_handler.logdata, expected)
+
+    def test_Parser_claim_jobs(self):
+        '''Test that expensive jobs are claimed alone and cheap ones in chunks'''
+        import ctypes
+        from bb import multiprocessing
+
+        jobs = list(range(40))
+        costs = [100.0, 50.0] + [1.0] * 38
+        next_job_id = multiprocessing.Value(ctypes.c_int, 0)
+        parser = bb.cooker.Parser(jobs, costs, 2, next_job_id, None, None, [])
+
+        self.assertEqual(parser.claim_jobs(), [0])
+        self.assertEqual(parser.claim_jobs(), [1])
+        chunk = parser.claim_jobs()
+        self.assertEqual(chunk[0], 2)
+        self.assertGreater(len(chunk), 1)
+
+        claimed = [0, 1] + chunk
+        while True:
+            chunk = parser.claim_jobs()
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), parser.max_chunk)
+            claimed.extend(chunk)
+        self.assertEqual(claimed, jobs)
+
+    def test_DirectoryListings(self):
+        '''Test that BBFILES entries expand as glob and os.walk would and that
+           the listings are reused until a directory changes'''
+        import glob
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            for fn in ["a/recipes-x/foo/foo_1.0.bb", "a/recipes-x/foo/foo.inc", "a/recipes-y/bar/bar_git.bb",
+                       "a/recipes-y/bar/.hidden.bb", "a/recipes-y/bar/bar_%.bbappend", "b/sub/baz.bb", "b/CVS/old.bb"]:
+                fn = os.path.join(tempdir, fn)
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                open(fn, "w").close()
+            # Listings of recently modified directories aren't kept
+            past = time.time() - 60
+            for root, dirs, files in os.walk(tempdir):
+                os.utime(root, (past, past))
+
+            self.d.setVar("CACHE", os.path.join(tempdir, "cache"))
+            listings = bb.cooker.DirectoryListings(self.d)
+            for pattern in ["a/recipes-*/*/*.bb", "a/recipes-*/*/*.bbappend", "a/recipes-[xy]/*/foo*", "a/*/.*", "a/recipes-x/foo/foo.inc", "a/missing/*.bb"]:
+                pattern = os.path.join(tempdir, pattern)
+                self.assertEqual(sorted(listings.glob(pattern, [])), sorted(glob.glob(pattern)))
+
+            searched = []
+            found = listings.walk(os.path.join(tempdir, "b"), searched)
+            self.assertEqual(found, [os.path.join(tempdir, "b/sub/baz.bb")])
+            self.assertEqual(searched, [os.path.join(tempdir, "b"), os.path.join(tempdir, "b/sub")])
+            listings.save()
+
+            # A new set of listings is loaded from the cache and a changed
+            # directory is listed again
+            os.rename(os.path.join(tempdir, "a/recipes-x/foo/foo_1.0.bb"), os.path.join(tempdir, "a/recipes-x/foo/foo_1.1.bb"))
+            bb.parse.update_mtime(os.path.join(tempdir, "a/recipes-x/foo"))
+            listings = bb.cooker.DirectoryListings(self.d)
+            self.assertIn(os.path.join(tempdir, "b/sub"), listings.listings)
+            pattern = os.path.join(tempdir, "a/recipes-*/*/*.bb")
+            self.assertEqual(sorted(listings.glob(pattern, [])), sorted(glob.glob(pattern)))
+            self.assertFalse(listings.changed)
@@ -70,6 +70,23 @@ class DataExpansions(unittest.TestCase):
         val = self.d.expand("${@2*2},${foo},${@d.getVar('foo') + ' ${bar}'},${foo}")
         self.assertEqual(str(val), "4,value_of_foo,${@d.getVar('foo') + ' ${unsetvar}'},value_of_foo")
 
+    def test_expansion_templates(self):
+        # Later expansions of the same string reuse its template, including
+        # from other datastores
+        s = "${foo} ${@d.getVar('bar')} ${@bb.utils.contains('foo', 'x', 'y', 'z', d)} ${unsetvar}"
+        other = bb.data.init()
+        other["foo"] = "other_foo"
+        for i in range(2):
+            varparse = self.d.expandWithRefs(s, "testvar")
+            self.assertEqual(varparse.value, "value_of_foo value_of_bar z ${unsetvar}")
+            self.assertEqual(varparse.references, set(["foo", "bar", "unsetvar"]))
+            self.assertEqual(varparse.execs, set())
+            self.assertEqual(varparse.contains, {"foo": set(["x"])})
+
+            varparse = other.expandWithRefs(s, "testvar")
+            self.assertEqual(varparse.value, "other_foo None z ${unsetvar}")
+            self.assertEqual(varparse.references, set(["foo", "bar", "unsetvar"]))
+
     def test_expand_in_python_snippet(self):
         val = self.d.expand("${@'boo ' + '${foo}'}")
         self.assertEqual(str(val), "boo value_of_foo")
@@ -432,6 +449,140 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("BAR:append:unusedoverride", "testvalue2")
         self.assertEqual(self.d.getVar("BAR"), None)
 
+class TestOverrideTable(unittest.TestCase):
+    overrides = ["arm", "armv7a", "qemuarm", "poky", "class-target", "class-native",
+                 "pn-busybox", "libc-glibc", "linux", "task-compile", "x86-64", "some_val"]
+
+    # The override resolution as it was before the results were kept in
+    # tables, to check against
+    @staticmethod
+    def reference(overridedata, overrides):
+        match = False
+        active = {}
+        for (r, o) in overridedata:
+            if o in overrides:
+                active[o] = r
+            elif ":" in o:
+                if set(o.split(":")).issubset(set(overrides)):
+                    active[o] = r
+        mod = True
+        while mod:
+            mod = False
+            for o in overrides:
+                for a in active.copy():
+                    if a.endswith(":" + o):
+                        t = active[a]
+                        del active[a]
+                        active[a.replace(":" + o, "")] = t
+                        mod = True
+                    elif a == o:
+                        match = active[a]
+                        del active[a]
+        return match
+
+    def set_overrides(self, d, rnd):
+        d.setVar("OVERRIDES", ":".join(rnd.sample(self.overrides, rnd.randint(1, len(self.overrides)))))
+
+    def set_vars(self, d, rnd, count):
+        for i in range(count):
+            var = "VAR%d" % rnd.randint(0, 40)
+            d.setVar(var, "base")
+            for j in range(rnd.randint(0, 4)):
+                o = ":".join(rnd.sample(self.overrides, rnd.randint(1, 3)))
+                d.setVar("%s:%s" % (var, o), "%s %s" % (var, o))
+
+    def check(self, d):
+        d.need_overrides()
+        for var in list(d.overridedata):
+            expected = self.reference(d.overridedata[var], d.overrides)
+            # The second lookup comes from the table
+            for i in range(2):
+                self.assertEqual(d.find_override(var, d.overridedata[var]), expected)
+            if expected:
+                self.assertEqual(d.getVar(var), d.getVar(expected))
+
+    def test_override_table(self):
+        import random
+        for seed in range(20):
+            rnd = random.Random(seed)
+            d = bb.data.init()
+            self.set_overrides(d, rnd)
+            self.set_vars(d, rnd, 20)
+            self.check(d)
+
+            # New overrides of existing variables
+            self.set_vars(d, rnd, 10)
+            self.check(d)
+
+            # Changed OVERRIDES
+            self.set_overrides(d, rnd)
+            self.check(d)
+
+            # Copies share the table while OVERRIDES is the same
+            d2 = bb.data.createCopy(d)
+            self.set_vars(d2, rnd, 10)
+            self.check(d2)
+            self.check(d)
+            self.set_overrides(d2, rnd)
+            self.check(d2)
+            self.check(d)
+
+            # Removed and renamed overrides
+            for var in list(d.keys()):
+                if ":" in var and rnd.random() < 0.3:
+                    d.delVar(var)
+                elif ":" in var and rnd.random() < 0.3:
+                    d.renameVar(var, var.replace("VAR", "NEWVAR", 1))
+            self.check(d)
+            self.check(d2)
+
+class TestCopyLayers(unittest.TestCase):
+    def test_parent_changes(self):
+        d = bb.data.init()
+        d.setVar("A", "a")
+        c1 = bb.data.createCopy(d)
+        c2 = bb.data.createCopy(c1)
+        self.assertEqual(c2.getVar("A", False), "a")
+        self.assertEqual(c2.getVar("B", False), None)
+
+        # Changes to the datastores copied from are seen by the copies
+        d.setVar("A", "a2")
+        d.setVar("B", "b")
+        self.assertEqual(c2.getVar("A", False), "a2")
+        self.assertEqual(c2.getVar("B", False), "b")
+
+        c1.setVar("A", "c1")
+        c1.delVar("B")
+        self.assertEqual(c2.getVar("A", False), "c1")
+        self.assertEqual(c2.getVar("B", False), None)
+        self.assertEqual(d.getVar("B", False), "b")
+        self.assertCountEqual(list(c2.keys()), ["A"])
+
+        c2.setVar("B", "c2")
+        self.assertEqual(c2.getVar("B", False), "c2")
+        self.assertEqual(c1.getVar("B", False), None)
+
+        # Removing the flags of a variable with no value uncovers the parent's
+        d.setVarFlag("C", "flag", "d")
+        c1.setVarFlag("C", "flag", "c1")
+        self.assertEqual(c2.getVarFlag("C", "flag", False), "c1")
+        c1.delVarFlags("C")
+        self.assertEqual(c2.getVarFlag("C", "flag", False), "d")
+
+    def test_pickle(self):
+        import pickle
+        d = bb.data.init()
+        d.setVar("A", "a")
+        c = bb.data.createCopy(d)
+        self.assertEqual(c.getVar("A", False), "a")
+        self.assertEqual(c.getVar("B", False), None)
+
+        d, c = pickle.loads(pickle.dumps((d, c)))
+        self.assertEqual(c.getVar("A", False), "a")
+        self.assertEqual(c.getVar("B", False), None)
+        d.setVar("B", "b")
+        self.assertEqual(c.getVar("B", False), "b")
+
 class TestKeyExpansion(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -596,6 +747,88 @@ class TaskHash(unittest.TestCase):
         nexthash = gettask_bashhash("mytask", d)
         self.assertEqual(orighash, nexthash)
 
+    def test_datastore_hash(self):
+        d = bb.data.init()
+        d.setVar("A", "a 'quoted' \"x\" \\ \u00fcn\u00efcode\nline")
+        d.setVar("B", "${A} b")
+        d.setVarFlag("B", "doc", "the B")
+        d.setVarFlag("B", "vardepvalue", "${A}")
+        d.setVar("${A}_KEY", "expanded key")
+        d.setVar("C:append", " c")
+        d.setVar("EMPTY", "")
+        d.setVar("IGNORED", "x")
+        d.setVar("BB_HASHCONFIG_IGNORE_VARS", "IGNORED")
+        d.setVar("__internal", "x")
+        d.setVar("__BBTASKS", ["do_a", "do_b"])
+        d.setVar("__BBANONFUNCS", ["__anon_1"])
+        d.setVar("__anon_1", "bb.note('x')")
+        for i in range(2500):
+            d.setVar("VAR%d" % i, "${VAR%d} %d" % (i - 1, i))
+
+        moddeps = bb.codeparser.modulecode_deps
+        try:
+            bb.codeparser.modulecode_deps = {"mod.func": [{"b", "a"}, set(), {"x"}, set(), "code"]}
+            # The hash must not change between releases for the same data
+            self.assertEqual(d.get_hash(), "8df6520cfe4c4c7dbe1a74ee033d1e90dc28deec005de0daf492bb2e45652dc5")
+        finally:
+            bb.codeparser.modulecode_deps = moddeps
+
+class TestVariableHistory(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.enableTracking()
+        self.d.setVar("A", "a", file="a.conf", line=1)
+        self.d.setVarFlag("A", "doc", "doc of A", file="a.conf", line=2)
+        self.d.appendVar("A", " b", file="b.conf", line=3, parsing=True)
+
+    def test_variable(self):
+        history = self.d.varhistory.variable("A")
+        self.assertEqual(history, [
+            {"variable": "A", "file": "a.conf", "line": 1, "op": "set", "detail": "a"},
+            {"variable": "A", "file": "a.conf", "line": 2, "op": "set", "detail": "doc of A", "flag": "doc"},
+            {"variable": "A", "file": "b.conf", "line": 3, "op": "append", "detail": " b", "parsing": True},
+        ])
+        self.assertEqual(self.d.varhistory.variable("B"), [])
+        self.assertEqual(self.d.varhistory.get_variable_files("A"), ["a.conf", "a.conf", "b.conf"])
+        self.assertEqual(self.d.varhistory.get_variable_refs("A"), {"a.conf": [1, 2], "b.conf": [3]})
+
+        # Other keys given to record() are kept
+        self.d.varhistory.record(variable="A", file="c.conf", line=4, op="custom", detail="x", other="o")
+        self.assertEqual(self.d.varhistory.variable("A")[-1]["other"], "o")
+
+        # Identical events marked nodups are only recorded once
+        for i in range(2):
+            self.d.varhistory.record(variable="A", file="c.conf", line=5, op="once", detail="", nodups=True)
+        self.assertEqual(len(self.d.varhistory.variable("A")), 5)
+
+    def test_copy(self):
+        c = bb.data.createCopy(self.d)
+        c.setVar("A", "c", file="c.conf", line=1)
+        c.setVar("B", "c", file="c.conf", line=2)
+        self.d.setVar("C", "d", file="d.conf", line=1)
+        self.assertEqual(len(c.varhistory.variable("A")), 4)
+        self.assertEqual(len(c.varhistory.variable("B")), 1)
+        self.assertEqual(len(self.d.varhistory.variable("A")), 3)
+        self.assertEqual(self.d.varhistory.variable("B"), [])
+
+        c.varhistory.del_var_history("A")
+        self.assertEqual(c.varhistory.variable("A"), [])
+        self.assertEqual(len(self.d.varhistory.variable("A")), 3)
+
+    def test_rename(self):
+        c = bb.data.createCopy(self.d)
+        c.renameVar("A", "B")
+        self.assertEqual(c.varhistory.get_variable_files("B")[:3], ["a.conf", "a.conf", "b.conf"])
+        self.assertEqual(c.varhistory.variable("B")[0]["variable"], "A")
+
+    def test_pickle(self):
+        import pickle
+        c = bb.data.createCopy(self.d)
+        c.setVar("B", "c", file="c.conf", line=2)
+        newc = pickle.loads(pickle.dumps(c))
+        self.assertEqual(newc.varhistory.variable("A"), self.d.varhistory.variable("A"))
+        self.assertEqual(newc.varhistory.variable("B"), c.varhistory.variable("B"))
+
 class Serialize(unittest.TestCase):
 
     def test_serialize(self):
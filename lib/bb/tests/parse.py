@@ -7,6 +7,7 @@
 #
 
 import unittest
+import unittest.mock
 import tempfile
 import logging
 import bb
@@ -227,6 +228,26 @@ python () {
             self.assertEqual(d1.getVar("VAR_var"), "B")
             self.assertEqual(d2.getVar("VAR_var"), None)
 
+    def test_parse_classextend_deferred(self):
+        self.d.setVar("__bbclasstype", "recipe")
+        with self.parsehelper(self.classextend_bbclass, suffix=".bbclass") as cls, \
+                self.parsehelper(self.classextend_bbclass, suffix=".bbclass") as cls2:
+            recipe = self.classextend.replace("###CLASS###", "%s %s" % (cls.name, cls2.name))
+            with self.parsehelper(recipe) as f:
+                # Only the base recipe
+                d = bb.data.createCopy(self.d)
+                d.setVar("__ONLYFINALISE", ["default"])
+                alldata = bb.parse.handle(f.name, d)
+                self.assertEqual(list(alldata.keys()), [''])
+                self.assertEqual(alldata[''].getVar("BBCLASSEXTEND"), "%s %s" % (cls.name, cls2.name))
+
+                # Only the variants asked for
+                d = bb.data.createCopy(self.d)
+                d.setVar("__ONLYFINALISE", [cls2.name])
+                alldata = bb.parse.handle(f.name, d)
+                self.assertEqual(sorted(alldata.keys()), sorted(['', cls2.name]))
+                self.assertEqual(alldata[cls2.name].getVar("VAR_var"), None)
+
     addtask_deltask = """
 addtask do_patch after do_foo after do_unpack before do_configure before do_compile
 addtask do_fetch2 do_patch2
@@ -390,6 +411,274 @@ EXPORT_FUNCTIONS do_compile do_compilepython
             self.assertIn("else", d.getVar("do_compilepython"))
             check_function_flags(d)
 
+    profile_recipe = """
+inherit someclass
+
+python () {
+    d.setVar("ANON", "1")
+}
+"""
+
+    def test_parse_profile(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.d.setVar("__bbclasstype", "recipe")
+            recipename = tempdir + "/recipe.bb"
+            os.makedirs(tempdir + "/classes")
+            with open(tempdir + "/classes/someclass.bbclass", "w") as f:
+                f.write(self.export_function_class)
+            with open(recipename, "w") as f:
+                f.write(self.profile_recipe)
+            os.chdir(tempdir)
+
+            profile = bb.parse.ParseProfile()
+            bb.parse.parse_profile = profile
+            try:
+                profile.start_recipe(recipename)
+                d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+            finally:
+                bb.parse.parse_profile = None
+            self.assertEqual(d.getVar("ANON"), "1")
+
+            self.assertIn(recipename, profile.recipes)
+            self.assertGreater(profile.recipes[recipename]["finalize"], 0)
+            self.assertEqual(list(profile.classes), [tempdir + "/classes/someclass.bbclass"])
+            self.assertEqual(len(profile.anonfuncs), 1)
+            self.assertEqual(list(profile.anonfuncs.values())[0][0], 1)
+
+            # Profiles from several parsers merge into one report
+            profile.save(tempdir + "/profile1.json")
+            profile.save(tempdir + "/profile2.json")
+            merged = bb.parse.ParseProfile()
+            merged.merge(tempdir + "/profile1.json")
+            merged.merge(tempdir + "/profile2.json")
+            self.assertEqual(merged.classes[tempdir + "/classes/someclass.bbclass"][0], 2)
+            merged.write_report(tempdir + "/report.json", tempdir + "/report.txt")
+            with open(tempdir + "/report.txt") as f:
+                self.assertIn("someclass.bbclass", f.read())
+
+    statementcache_recipe = """
+A = "1"
+include statementcache.inc
+python () {
+    d.setVar("ANON", d.getVar("A") + d.getVar("B"))
+}
+"""
+
+    def test_parse_statementcache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            recipename = tempdir + "/recipe.bb"
+            incname = tempdir + "/statementcache.inc"
+            with open(recipename, "w") as f:
+                f.write(self.statementcache_recipe)
+            with open(incname, "w") as f:
+                f.write('B = "2"\n')
+            os.chdir(tempdir)
+            self.d.setVar("BBPATH", tempdir)
+
+            origcache = bb.parse.statementcache
+            bb.parse.statementcache = bb.parse.StatementCache()
+            try:
+                cache = bb.parse.statementcache
+                cache.init_cache(tempdir + "/cache")
+                bb.parse.BBHandler.cached_statements = {}
+
+                d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+                self.assertEqual(d.getVar("ANON"), "12")
+                self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+                # A new process has no statements in memory but reuses the cache
+                bb.parse.BBHandler.cached_statements = {}
+                d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+                self.assertEqual(d.getVar("ANON"), "12")
+                self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+                # A modified file isn't matched
+                with open(incname, "w") as f:
+                    f.write('B = "34"\n')
+                bb.parse.BBHandler.cached_statements = {}
+                d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+                self.assertEqual(d.getVar("ANON"), "134")
+                self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+                # Pruning removes the least recently used entries
+                def cachefiles():
+                    return [os.path.join(root, f) for root, dirs, files in os.walk(cache.cachedir) for f in files]
+                self.assertEqual(len(cachefiles()), 3)
+                cache.prune(0)
+                self.assertEqual(cachefiles(), [])
+            finally:
+                bb.parse.statementcache = origcache
+                bb.parse.BBHandler.cached_statements = {}
+
+    statementcache_warnings_recipe = """
+A="1"
+python () {
+\td.setVar("B", "2")
+}
+"""
+
+    def test_parse_statementcache_warnings(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            recipename = tempdir + "/recipe.bb"
+            confname = tempdir + "/local.conf"
+            with open(recipename, "w") as f:
+                f.write(self.statementcache_warnings_recipe)
+            with open(confname, "w") as f:
+                f.write('C="3"\n')
+            os.chdir(tempdir)
+            self.d.setVar("BBPATH", tempdir)
+
+            origcache = bb.parse.statementcache
+            bb.parse.statementcache = bb.parse.StatementCache()
+            try:
+                cache = bb.parse.statementcache
+                cache.init_cache(tempdir + "/cache")
+
+                # The warnings are shown when the statements come from the
+                # cache too
+                for i in range(2):
+                    bb.parse.BBHandler.cached_statements = {}
+                    with self.assertLogs("BitBake", level="WARNING") as logs:
+                        bb.parse.handle(recipename, bb.data.createCopy(self.d))
+                        bb.parse.handle(confname, bb.data.createCopy(self.d))
+                    output = "\n".join(logs.output)
+                    self.assertIn("recipe.bb:2 has a lack of whitespace around the assignment", output)
+                    self.assertIn("local.conf:1 has a lack of whitespace around the assignment", output)
+                    self.assertIn("python should use 4 spaces indentation, but found tabs in recipe.bb, line 4", output)
+                    self.assertEqual(len(logs.output), 3)
+                self.assertEqual((cache.hits, cache.misses), (2, 2))
+            finally:
+                bb.parse.statementcache = origcache
+                bb.parse.BBHandler.cached_statements = {}
+
+    snapshot_class = """
+def snapshot_value(d):
+    return "a"
+
+addhandler snapshot_handler
+python snapshot_handler () {
+    pass
+}
+"""
+
+    def test_parse_config_snapshot(self):
+        import bb.cookerdata
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            os.makedirs(tempdir + "/conf")
+            os.makedirs(tempdir + "/classes")
+            def write_conf(content):
+                with open(tempdir + "/conf/bitbake.conf", "w") as f:
+                    f.write(content)
+                bb.parse.update_mtime(tempdir + "/conf/bitbake.conf")
+            write_conf('BB_CACHE_BASECONFIG = "1"\nINHERIT = "snapshot"\nA = "${@snapshot_value(d)}"\n')
+            with open(tempdir + "/classes/base.bbclass", "w") as f:
+                f.write("")
+            with open(tempdir + "/classes/snapshot.bbclass", "w") as f:
+                f.write(self.snapshot_class)
+            os.chdir(tempdir)
+
+            cfg = bb.cookerdata.CookerConfiguration()
+            cfg.env = {"BBPATH": tempdir}
+            def snapshot():
+                return bb.cookerdata.ConfigSnapshot(builder.basedata, [], [], "", False)
+
+            origcache = bb.parse.statementcache
+            bb.parse.statementcache = bb.parse.StatementCache()
+            try:
+                builder = bb.cookerdata.CookerDataBuilder(cfg)
+                self.assertIsNone(snapshot().load())
+                d = builder.parseConfigurationFiles([], [])
+                self.assertEqual(d.getVar("A"), "a")
+
+                # A new builder restores the datastore, replaying the methods
+                # and event handlers defined while parsing
+                builder = bb.cookerdata.CookerDataBuilder(cfg)
+                self.assertIsNotNone(snapshot().load())
+                self.assertNotIn("snapshot_handler", bb.event.get_handlers())
+                restored = builder.parseConfigurationFiles([], [])
+                self.assertEqual(restored.getVar("A"), "a")
+                self.assertIn("snapshot_handler", bb.event.get_handlers())
+                self.assertEqual(restored.get_hash(), d.get_hash())
+
+                # A change to any of the files is detected
+                write_conf('BB_CACHE_BASECONFIG = "1"\nINHERIT = "snapshot"\nA = "b"\n')
+                builder = bb.cookerdata.CookerDataBuilder(cfg)
+                self.assertIsNone(snapshot().load())
+                self.assertEqual(builder.parseConfigurationFiles([], []).getVar("A"), "b")
+
+                # As is a change to the environment
+                cfg.env["HOME"] = tempdir
+                builder = bb.cookerdata.CookerDataBuilder(cfg)
+                self.assertIsNone(snapshot().load())
+
+                # The snapshot is removed when it is disabled
+                write_conf('A = "c"\n')
+                builder.parseConfigurationFiles([], [])
+                self.assertFalse(os.path.exists(snapshot().fn))
+
+                # Without a snapshot the key isn't worked out when disabled
+                with unittest.mock.patch.object(bb.cookerdata.ConfigSnapshot, "key", new_callable=unittest.mock.PropertyMock) as key:
+                    builder = bb.cookerdata.CookerDataBuilder(cfg)
+                    builder.parseConfigurationFiles([], [])
+                    key.assert_not_called()
+
+                # BB_CACHEDIR in the environment sets where snapshots go
+                write_conf('BB_CACHE_BASECONFIG = "1"\nA = "d"\n')
+                cfg.env["BB_CACHEDIR"] = tempdir + "/othercache"
+                builder = bb.cookerdata.CookerDataBuilder(cfg)
+                builder.parseConfigurationFiles([], [])
+                self.assertTrue(snapshot().fn.startswith(tempdir + "/othercache/bb_baseconfig/"))
+                self.assertTrue(os.path.exists(snapshot().fn))
+            finally:
+                bb.parse.statementcache = origcache
+                bb.event.set_class_handlers(bb.event.clean_class_handlers())
+                bb.utils.set_context(bb.utils.clean_context())
+
+    vardeps_recipe = """
+X = "${A}"
+Z ?= "z"
+python () {
+    d.setVar("Y", d.getVar("B"))
+}
+"""
+
+    def test_parse_vardeps(self):
+        import bb.cache
+
+        def parse(config):
+            cfg = bb.data.init()
+            for var, value in config.items():
+                cfg.setVar(var, value)
+            lookups = set()
+            cfg.enableLookupTracking(lookups)
+            d = bb.parse.handle(f.name, bb.data.createCopy(cfg))['']
+            cfg.disableLookupTracking()
+            # Read the recipe's variables as the cache would, while still
+            # tracking lookups
+            values = dict((k, d.getVar(k)) for k in d.keys() if not k.startswith("__") and k not in config)
+            digests = bb.cache.ConfigDigests(cfg)
+            return values, digests, digests.mask(lookups)
+
+        config = {"A": "a", "B": "b", "Z": "zz", "UNUSED": "u"}
+        with self.parsehelper(self.vardeps_recipe) as f:
+            values, digests, mask = parse(config)
+            self.assertEqual(values["X"], "a")
+            self.assertEqual(values["Y"], "b")
+
+            # Compare against a full reparse with each variable changed
+            invalidated = set()
+            for var in config:
+                newvalues, newdigests, _ = parse(dict(config, **{var: "changed"}))
+                if newdigests.changed(digests.digests) & mask:
+                    invalidated.add(var)
+                else:
+                    self.assertEqual(values, newvalues)
+            self.assertEqual(invalidated, set(["A", "B", "Z"]))
+
+            # An unchanged configuration invalidates nothing
+            self.assertEqual(parse(config)[1].changed(digests.digests), 0)
+
     export_function_unclosed_tab = """
 do_compile () {
        bb.note("Something")
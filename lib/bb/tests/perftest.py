@@ -0,0 +1,61 @@
+#
+# BitBake Tests for the performance test suite (perftest.py)
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import tempfile
+import unittest
+
+import bb.perftest
+
+class PerfTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def test_generate(self):
+        layerdir = os.path.join(self.tempdir.name, "layer")
+        config = bb.perftest.generate_layer(layerdir, recipes=10, classes=4, inherit_depth=2, variants=50, seed=1)
+        self.assertEqual(config["recipes"], 10)
+        self.assertEqual(len(os.listdir(os.path.join(layerdir, "recipes"))), 10)
+        # The classes, base and native
+        self.assertEqual(len(os.listdir(os.path.join(layerdir, "classes"))), 6)
+        with open(os.path.join(layerdir, "classes", "cls0.bbclass")) as f:
+            self.assertIn("inherit cls1\n", f.read())
+        with open(os.path.join(layerdir, "classes", "cls1.bbclass")) as f:
+            self.assertNotIn("inherit", f.read())
+
+        # The same seed gives the same layer
+        otherdir = os.path.join(self.tempdir.name, "other")
+        bb.perftest.generate_layer(otherdir, recipes=10, classes=4, inherit_depth=2, variants=50, seed=1)
+        for i in range(10):
+            with open(os.path.join(layerdir, "recipes", "r%d.bb" % i)) as f1, open(os.path.join(otherdir, "recipes", "r%d.bb" % i)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        with self.assertRaises(ValueError):
+            bb.perftest.generate_layer(layerdir, recipe=10)
+
+    def test_run(self):
+        results = bb.perftest.run(self.tempdir.name, ["parse-cold", "parse-warm", "dry-run"], recipes=10, classes=4, variants=50)
+        phases = results["phases"]
+        self.assertEqual(set(phases), {"parse-cold", "parse-warm", "dry-run"})
+        self.assertEqual(phases["parse-cold"]["parsed"], 10)
+        self.assertEqual(phases["parse-cold"]["loaded"], 0)
+        # Everything comes from the cache the second time
+        self.assertEqual(phases["parse-warm"]["loaded"], phases["parse-cold"]["targets"])
+        self.assertNotIn("parsed", phases["parse-warm"])
+        self.assertEqual(results["layer"]["recipes"], 10)
+
+        lines, regressed = bb.perftest.compare(results, results)
+        self.assertFalse(regressed)
+
+        baseline = {"layer": results["layer"], "phases": {"dry-run": {"median": phases["dry-run"]["median"] / 2}}}
+        lines, regressed = bb.perftest.compare(results, baseline, threshold=50)
+        self.assertTrue(regressed)
+        self.assertIn("REGRESSION", lines[-1])
+        lines, regressed = bb.perftest.compare(results, baseline, threshold=150)
+        self.assertFalse(regressed)
@@ -10,6 +10,7 @@ import unittest
 import os
 import tempfile
 import subprocess
+import re
 import sys
 import time
 
@@ -26,7 +27,7 @@ class RunQueueTests(unittest.TestCase):
     a1_sstatevalid = "a1:do_package a1:do_package_qa a1:do_packagedata a1:do_package_write_ipk a1:do_package_write_rpm a1:do_populate_lic a1:do_populate_sysroot"
     b1_sstatevalid = "b1:do_package b1:do_package_qa b1:do_packagedata b1:do_package_write_ipk b1:do_package_write_rpm b1:do_populate_lic b1:do_populate_sysroot"
 
-    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False):
+    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False, withoutput=False):
         env = os.environ.copy()
         env["BBPATH"] = os.path.realpath(os.path.join(os.path.dirname(__file__), "runqueue-tests"))
         env["BB_ENV_PASSTHROUGH_ADDITIONS"] = "SSTATEVALID SLOWTASKS TOPDIR"
@@ -51,6 +52,8 @@ class RunQueueTests(unittest.TestCase):
                 tasks = [line.rstrip() for line in f]
             if cleanup:
                 os.remove(tasklog)
+        if withoutput:
+            return tasks, output
         return tasks
 
     def test_no_setscenevalid(self):
@@ -403,6 +406,82 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    lazy_recipes = {
+        "lazya.bb": 'DEPENDS = "lazyb-native"\n',
+        "lazyb.bb": 'BBCLASSEXTEND = "native"\n',
+        "lazyc.bb": 'BBCLASSEXTEND = "native"\nNATIVE_PROVIDES = "lazyprovider"\n',
+        "lazyd.bb": 'DEPENDS = "lazyprovider"\n',
+    }
+
+    def setup_lazy_variants(self, tempdir):
+        # A layer of recipes with native variants. It comes first in BBPATH so
+        # its native class, which renames the variants, is the one used.
+        layerdir = os.path.join(tempdir, "lazylayer")
+        os.makedirs(os.path.join(layerdir, "classes"))
+        os.makedirs(os.path.join(layerdir, "recipes"))
+        with open(os.path.join(layerdir, "classes", "native.bbclass"), "w") as f:
+            f.write('PN = "${@bb.parse.vars_from_file(d.getVar(\'FILE\', False), d)[0]}-native"\n')
+            f.write('PROVIDES:append = " ${NATIVE_PROVIDES}"\n')
+        for name, content in self.lazy_recipes.items():
+            with open(os.path.join(layerdir, "recipes", name), "w") as f:
+                f.write(content)
+        return {
+            "BBPATH" : layerdir + ":" + os.path.realpath(os.path.join(os.path.dirname(__file__), "runqueue-tests")),
+            "EXTRA_BBFILES" : os.path.join(layerdir, "recipes", "*.bb"),
+            "BB_LAZY_VARIANTS" : "1",
+        }
+
+    def test_lazy_variants_needed(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = self.setup_lazy_variants(tempdir)
+            cmd = ["bitbake", "lazya"]
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, cleanup=True, withoutput=True)
+            # Only the variant lazya depends upon is parsed
+            self.assertIn("Parsed 1 deferred recipe variants", output)
+            expected = ['lazya:' + x for x in self.alltasks] + ['lazyb-native:' + x for x in self.alltasks if x not in ('package_qa', 'build')]
+            self.assertEqual(set(tasks), set(expected))
+            targets = int(re.search(r"(\d+) targets", output).group(1))
+
+            # The variant is loaded from the appended cache the next time
+            cmd = ["bitbake", "lazya", "-n"]
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, withoutput=True)
+            self.assertIn("Loaded %d entries from dependency cache" % (targets + 1), output)
+            self.assertNotIn("deferred recipe variants", output)
+
+            self.shutdown(tempdir)
+
+    def test_lazy_variants_unresolved(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = self.setup_lazy_variants(tempdir)
+            # Nothing parsed provides lazyprovider, so all of the variants are
+            # parsed to find it
+            cmd = ["bitbake", "lazyd"]
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, cleanup=True, withoutput=True)
+            self.assertIn("Parsed 2 deferred recipe variants", output)
+            expected = ['lazyd:' + x for x in self.alltasks] + ['lazyc-native:' + x for x in self.alltasks if x not in ('package_qa', 'build')]
+            self.assertEqual(set(tasks), set(expected))
+
+            self.shutdown(tempdir)
+
+    def test_lazy_variants_invalidated(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = self.setup_lazy_variants(tempdir)
+            cmd = ["bitbake", "lazya", "-n"]
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, withoutput=True)
+            self.assertIn("Parsed 1 deferred recipe variants", output)
+
+            # Changing the recipe makes its cached variant invalid too
+            with open(os.path.join(tempdir, "lazylayer", "recipes", "lazyb.bb"), "a") as f:
+                f.write('EXTRA = "1"\n')
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, withoutput=True)
+            self.assertRegex(output, r"\(\d+ cached, 1 parsed\)")
+            self.assertIn("Parsed 1 deferred recipe variants", output)
+
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv, withoutput=True)
+            self.assertNotIn("deferred recipe variants", output)
+
+            self.shutdown(tempdir)
+
     def shutdown(self, tempdir):
         # Wait for the hashserve socket to disappear else we'll see races with the tempdir cleanup
         while (os.path.exists(tempdir + "/hashserve.sock") or os.path.exists(tempdir + "cache/hashserv.db-wal") or os.path.exists(tempdir + "/bitbake.lock")):
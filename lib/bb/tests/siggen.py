@@ -7,12 +7,18 @@
 #
 
 import unittest
+import unittest.mock
 import logging
 import bb
+import contextlib
+import json
+import os
+import tempfile
 import time
 
 logger = logging.getLogger('BitBake.TestSiggen')
 
+import bb.checksum
 import bb.siggen
 
 class SiggenTest(unittest.TestCase):
@@ -26,3 +32,334 @@ class SiggenTest(unittest.TestCase):
         for t in tests:
             self.assertEqual(bb.siggen.build_pnid(*t), tests[t])
 
+
+class FileChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.srcdir = os.path.join(self.tempdir.name, "files")
+        for name in ("a.patch", "defconfig", "fw/one.bin", "fw/sub/two.bin", "fw/.git/HEAD"):
+            path = os.path.join(self.srcdir, name)
+            bb.utils.mkdirhier(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(name)
+
+        self.cache = bb.checksum.FileChecksumCache()
+        self.cache.init_cache(os.path.join(self.tempdir.name, "cache"))
+        self.filelist = " ".join("%s:%s" % (os.path.join(self.srcdir, f), exists) for f, exists in (
+            ("a.patch", True), ("fw", True), ("*.patch", True), ("missing", False), ("defconfig", True)))
+
+    def expected(self):
+        checksums = []
+        for f in ("a.patch", "fw/./one.bin", "fw/./sub/two.bin", "a.patch", "defconfig"):
+            checksums.append((os.path.join(self.srcdir, f), bb.utils.md5_file(os.path.join(self.srcdir, f))))
+        return sorted(checksums, key=lambda c: c[1])
+
+    def test_checksums(self):
+        checksums = self.cache.get_checksums(self.filelist, "test", [".git"])
+        self.assertEqual(checksums, self.expected())
+
+        # Everything is cached now, including across cache instances
+        self.cache.save_extras()
+        self.cache.save_merge()
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(os.path.join(self.tempdir.name, "cache"))
+        with unittest.mock.patch("bb.utils.md5_file") as md5_file:
+            self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), checksums)
+            self.assertEqual(cache.get_checksum(os.path.join(self.srcdir, "defconfig")),
+                             dict(checksums)[os.path.join(self.srcdir, "defconfig")])
+            md5_file.assert_not_called()
+
+    def test_changed_file(self):
+        path = os.path.join(self.srcdir, "defconfig")
+        before = self.cache.get_checksum(path)
+        st = os.stat(path)
+
+        # A change in size is noticed even if the mtime is preserved
+        with open(path, "w") as f:
+            f.write("CONFIG_FOO=y\n")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.cache.stat_cache.clear()
+
+        after = self.cache.get_checksum(path)
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, bb.utils.md5_file(path))
+
+    def test_unreadable_file(self):
+        os.unlink(os.path.join(self.srcdir, "defconfig"))
+        with unittest.mock.patch("bb.warn") as warn:
+            checksums = self.cache.get_checksums(self.filelist, "test", [".git"])
+        self.assertEqual(warn.call_count, 1)
+        self.assertNotIn(os.path.join(self.srcdir, "defconfig"), dict(checksums))
+        self.assertEqual(len(checksums), 4)
+
+    def test_checksums_multi(self):
+        otherlist = "%s:True" % os.path.join(self.srcdir, "fw")
+        md5_file = bb.utils.md5_file
+        with unittest.mock.patch("bb.utils.md5_file", side_effect=md5_file) as mock:
+            checksums = self.cache.get_checksums_multi([(self.filelist, "test"), (otherlist, "other")], [".git"])
+        # Files shared by the lists are only checksummed once
+        self.assertEqual(mock.call_count, 4)
+        self.assertEqual(checksums[0], self.expected())
+        self.assertEqual(checksums[1], [c for c in self.expected() if "/fw/" in c[0]])
+
+
+class UnihashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", self.tempdir.name)
+        self.d.setVar("BB_HASHSERVE", "unix://%s/hashserve.sock" % self.tempdir.name)
+        self.d.setVar("BB_HASHSERVE_LOCAL_CACHE_TTL", "3600")
+        self.queries = []
+
+    def create_siggen(self, pnprefix="r"):
+        siggen = bb.siggen.SignatureGeneratorTestEquivHash(self.d)
+        # The server knows a unihash for every other task
+        @contextlib.contextmanager
+        def client():
+            class Client(object):
+                def get_unihash_batch(client, queries):
+                    queries = list(queries)
+                    self.queries.append(queries)
+                    return ["unihash%s" % taskhash if taskhash.isdigit() and int(taskhash) % 2 == 0 else None for method, taskhash in queries]
+            yield Client()
+        siggen.client = client
+        self.tids = []
+        for i in range(4):
+            tid = "/%s%d.bb:do_install" % (pnprefix, i)
+            siggen.taskhash[tid] = str(i)
+            siggen.tidtopn[tid] = "%s%d" % (pnprefix, i)
+            self.tids.append(tid)
+        siggen.setscenetasks = set(self.tids)
+        return siggen
+
+    def test_local_cache(self):
+        expected = ["unihash0", "1", "unihash2", "3"]
+
+        siggen = self.create_siggen()
+        unihashes = siggen.get_unihashes(self.tids)
+        self.assertEqual([unihashes[tid] for tid in self.tids], expected)
+        self.assertEqual(len(self.queries[-1]), 4)
+        siggen.save_unitaskhashes()
+
+        # A new server with no unitaskhashes for these tasks only queries the
+        # tasks the server didn't know a unihash for
+        siggen = self.create_siggen(pnprefix="other")
+        unihashes = siggen.get_unihashes(self.tids)
+        self.assertEqual([unihashes[tid] for tid in self.tids], expected)
+        self.assertEqual(self.queries[-1], [("sstate_output_hash", "1"), ("sstate_output_hash", "3")])
+        self.assertEqual(siggen.get_unihash_stats(), {"local": 2, "server": 2})
+
+        # Once expired, the server is asked again
+        siggen = self.create_siggen(pnprefix="expired")
+        with unittest.mock.patch("time.time", return_value=time.time() + 7200):
+            siggen.get_unihashes(self.tids)
+        self.assertEqual(len(self.queries[-1]), 4)
+
+    def test_lru(self):
+        self.d.delVar("BB_HASHSERVE_LOCAL_CACHE_TTL")
+        siggen = self.create_siggen()
+        siggen.UNIHASH_LRU_SIZE = 1
+        siggen.get_unihashes(self.tids)
+        server = self.d.getVar("BB_HASHSERVE")
+        self.assertEqual(list(siggen.unihash_lru), [(server, "sstate_output_hash", "2")])
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, "bb_unihash_cache.sqlite3")))
+
+        # The in memory answers outlive a reset of the signature generator
+        siggen.reset(self.d)
+        siggen.unitaskhashes = {}
+        siggen.client = self.create_siggen().client
+        siggen.taskhash = {tid: "2" for tid in self.tids[:1]}
+        siggen.tidtopn = {tid: "r0" for tid in self.tids[:1]}
+        self.assertEqual(siggen.get_unihashes(self.tids[:1]), {self.tids[0]: "unihash2"})
+        self.assertEqual(siggen.get_unihash_stats(), {"memory": 1})
+
+        # but not a change of server
+        self.d.setVar("BB_HASHSERVE", "unix://%s/other.sock" % self.tempdir.name)
+        siggen.reset(self.d)
+        siggen.unitaskhashes = {}
+        siggen.client = self.create_siggen().client
+        siggen.taskhash = {tid: "2" for tid in self.tids[:1]}
+        siggen.tidtopn = {tid: "r0" for tid in self.tids[:1]}
+        self.assertEqual(siggen.get_unihashes(self.tids[:1]), {self.tids[0]: "unihash2"})
+        self.assertEqual(siggen.get_unihash_stats(), {"server": 1})
+
+    def test_stats(self):
+        siggen = self.create_siggen()
+        tids = self.tids[:3]
+        siggen.setscenetasks = set(tids[2:])
+        for i, tid in enumerate(tids):
+            siggen.basehash[tid] = "base%d" % i
+            siggen.runtaskdeps[tid] = [("r%d:do_install" % j, tids[j]) for j in range(i)]
+            siggen.file_checksum_values[tid] = []
+
+        # Level by level as the runqueue does, the tasks without setscene
+        # tasks aren't lookups
+        for tid in tids:
+            siggen.get_taskhash(tid, [], None)
+            siggen.get_unihashes([tid])
+        self.assertEqual(siggen.get_unihash_stats(), {"server": 1})
+
+        # Nor are the lookups of the dependencies
+        for _ in range(5):
+            for tid in tids:
+                siggen.get_taskhash(tid, [], None)
+        self.assertEqual(siggen.get_unihash_stats(), {"server": 1})
+
+        siggen.get_unihashes(tids)
+        self.assertEqual(siggen.get_unihash_stats(), {"server": 1, "task": 1})
+        self.assertEqual(len(self.queries), 1)
+
+class SigIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", os.path.join(self.tempdir.name, "cache"))
+        self.index = bb.siggen.SigIndex.from_data(self.d)
+
+    def sigfile(self, name):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, "w") as f:
+            f.write("{}")
+        return path
+
+    def test_find(self):
+        stamp = self.sigfile("do_compile.sigdata.aaa")
+        sstate = self.sigfile("sstate:foo::aaa_compile.tgz.siginfo")
+        other = self.sigfile("do_compile.sigdata.bbb")
+        self.index.add("", "foo", "do_compile", "aaa", "ttt", sstate, sstate=True)
+        self.index.add("", "foo", "do_compile", "aaa", "ttt", stamp)
+        self.index.add("", "foo", "do_compile", "bbb", None, other)
+
+        # Queries by hash can be answered by unihash or taskhash
+        found = self.index.find("", "foo", "do_compile", ["aaa", "ttt"])
+        self.assertEqual(found["aaa"]["path"], stamp)
+        self.assertEqual(found["ttt"]["path"], stamp)
+        self.assertFalse(found["aaa"]["sstate"])
+        self.assertIsNone(self.index.find("", "foo", "do_compile", ["aaa", "ccc"]))
+        self.assertIsNone(self.index.find("other", "foo", "do_compile", ["aaa"]))
+
+        # Listing all the files of a task needs a complete scan first
+        self.assertIsNone(self.index.find("", "foo", "do_compile"))
+        self.index.add_found("", "foo", "do_compile", {"aaa": {"path": stamp, "time": 0}}, complete=True)
+        self.assertEqual(set(self.index.find("", "foo", "do_compile")), {"aaa", "bbb"})
+
+        # The scan isn't trusted once the directories it found files in
+        # change, or after a while
+        os.unlink(other)
+        self.assertIsNone(self.index.find("", "foo", "do_compile"))
+        with unittest.mock.patch.object(self.index, "scan_ttl", -1):
+            self.index.add_found("", "foo", "do_compile", {"aaa": {"path": stamp, "time": 0}}, complete=True)
+            self.assertIsNone(self.index.find("", "foo", "do_compile"))
+
+        # Files which are gone are dropped
+        self.index.add_found("", "foo", "do_compile", {"aaa": {"path": stamp, "time": 0}}, complete=True)
+        self.assertEqual(set(self.index.find("", "foo", "do_compile")), {"aaa"})
+
+        # A scan which found nothing doesn't prove nothing arrived since
+        self.index.add_found("", "bar", "do_compile", {}, complete=True)
+        self.assertIsNone(self.index.find("", "bar", "do_compile"))
+
+        self.index.clear("")
+        self.assertIsNone(self.index.find("", "foo", "do_compile", ["aaa"]))
+
+    def test_find_siginfo_indexed(self):
+        path = self.sigfile("do_install.sigdata.aaa")
+        found = {"aaa": {"path": path, "sstate": False, "time": os.stat(path).st_mtime}}
+        with unittest.mock.patch("bb.siggen.find_siginfo", return_value=found, create=True) as find_siginfo:
+            self.assertEqual(bb.siggen.find_siginfo_indexed("foo", "do_install", ["aaa"], self.d), found)
+            self.assertEqual(bb.siggen.find_siginfo_indexed("foo", "do_install", ["aaa"], self.d), found)
+            self.assertEqual(find_siginfo.call_count, 1)
+
+            # A query for one hash doesn't prove the task has no other files
+            self.assertEqual(bb.siggen.find_siginfo_indexed("foo:do_install", None, None, self.d), found)
+            self.assertEqual(bb.siggen.find_siginfo_indexed("foo:do_install", None, None, self.d), found)
+            self.assertEqual(find_siginfo.call_count, 2)
+
+        # Multiconfig keys are split out
+        path = self.sigfile("mc1.do_install.sigdata.aaa")
+        found = {"aaa": {"path": path, "sstate": False, "time": os.stat(path).st_mtime}}
+        with unittest.mock.patch("bb.siggen.find_siginfo", return_value=found, create=True) as find_siginfo:
+            self.assertEqual(bb.siggen.find_siginfo_indexed("mc:mc1:foo:do_install", None, None, self.d, self.index), found)
+            self.assertEqual(self.index.find("mc1", "foo", "do_install"), found)
+            self.assertIsNone(self.index.find("", "foo", "do_compile"))
+
+        # An empty listing is always looked for again
+        with unittest.mock.patch("bb.siggen.find_siginfo", return_value={}, create=True) as find_siginfo:
+            self.assertEqual(bb.siggen.find_siginfo_indexed("bar:do_install", None, None, self.d, self.index), {})
+            self.assertEqual(bb.siggen.find_siginfo_indexed("bar:do_install", None, None, self.d, self.index), {})
+            self.assertEqual(find_siginfo.call_count, 2)
+
+class CompareSigdirsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def write_sigfile(self, build, pn, task, value, deps={}):
+        data = {
+            "task": task,
+            "basehash_ignore_vars": set(),
+            "taskhash_ignore_tasks": set(),
+            "taskdeps": ["VALUE"],
+            "gendeps": {"VALUE": set()},
+            "varvals": {task: "", "VALUE": value},
+            "runtaskdeps": sorted(deps),
+            "runtaskhashes": dict(deps),
+            "file_checksum_values": [],
+        }
+        data["basehash"] = bb.siggen.calc_basehash(data)
+        data["taskhash"] = data["unihash"] = bb.siggen.calc_taskhash(data)
+        path = os.path.join(self.tempdir.name, build, "%s.%s.sigdata.%s" % (pn, task, data["unihash"]))
+        bb.utils.mkdirhier(os.path.dirname(path))
+        with bb.compress.zstd.open(path, "wt", encoding="utf-8", num_threads=1) as f:
+            json.dump(data, f, cls=bb.siggen.SetEncoder)
+        return data["unihash"]
+
+    def write_build(self, build, avalue):
+        a = self.write_sigfile(build, "a", "do_compile", avalue)
+        d = self.write_sigfile(build, "d", "do_compile", "unchanged")
+        b = self.write_sigfile(build, "b", "do_compile", "b", {"a:do_compile": a, "d:do_compile": d})
+        self.write_sigfile(build, "c", "do_build", "c", {"b:do_compile": b})
+        return a
+
+    def test_compare_sigdirs(self):
+        old = self.write_build("old", "before")
+        new = self.write_build("new", "after")
+
+        output = bb.siggen.compare_sigdirs(os.path.join(self.tempdir.name, "old"), os.path.join(self.tempdir.name, "new"), jobs=2)
+        self.assertEqual(output[0], "3 of 4 tasks changed, 1 of them directly; 0 tasks added, 0 tasks removed")
+        self.assertEqual(output[2], "a:do_compile changed from %s to %s" % (old, new))
+        self.assertIn("Variable VALUE value changed from 'before' to 'after'", output[3])
+        self.assertEqual(output[4:], ["  causing:", "      b:do_compile", "        c.do_build.sigdata.*"])
+
+    def test_latest_sigfile(self):
+        self.write_build("old", "before")
+        # A build directory which was built with both values, the latest being
+        # the same as the old one
+        self.write_build("new", "after")
+        for path in bb.siggen.find_sigfiles(os.path.join(self.tempdir.name, "new")):
+            os.utime(path, (0, 0))
+        self.write_build("new", "before")
+
+        output = bb.siggen.compare_sigdirs(os.path.join(self.tempdir.name, "old"), os.path.join(self.tempdir.name, "new"), jobs=1)
+        self.assertEqual(output, ["0 of 4 tasks changed, 0 of them directly; 0 tasks added, 0 tasks removed"])
+
+    def test_unreadable_sigfile(self):
+        self.write_build("old", "before")
+        self.write_build("new", "after")
+        # A truncated file
+        path = bb.siggen.find_sigfiles(os.path.join(self.tempdir.name, "new"))[0]
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        for build in ("old", "new"):
+            with open(os.path.join(self.tempdir.name, build, "foo.do_compile.sigdata.abc"), "wb") as f:
+                f.write(b"not a signature file")
+
+        for jobs in (1, 2):
+            output = bb.siggen.compare_sigdirs(os.path.join(self.tempdir.name, "old"), os.path.join(self.tempdir.name, "new"), jobs=jobs)
+            self.assertEqual(output[1:3], [
+                "Skipped 1 unreadable signature files in %s" % os.path.join(self.tempdir.name, "old"),
+                "Skipped 2 unreadable signature files in %s" % os.path.join(self.tempdir.name, "new")])
@@ -0,0 +1,60 @@
+#
+# BitBake Tests for the trace timeline (trace.py)
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import json
+import os
+import tempfile
+import unittest
+
+import bb.trace
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, "trace.json")
+        self.addCleanup(bb.trace.enable, None, None)
+
+    def test_disabled(self):
+        bb.trace.enable(None, "test")
+        self.assertIsNone(bb.trace.tracer)
+        with bb.trace.span("nothing"):
+            pass
+        bb.trace.add_span("nothing", "test", 0)
+        self.assertEqual(bb.trace.collect(), [])
+
+    def test_processes(self):
+        bb.trace.enable(self.path, "parent")
+        with bb.trace.span("outer", "test", value=1):
+            pid = os.fork()
+            if pid == 0:
+                # The child only writes its own spans
+                bb.trace.rename("child")
+                with bb.trace.span("inner", "test"):
+                    pass
+                bb.trace.flush()
+                os._exit(0)
+            os.waitpid(pid, 0)
+
+        events = bb.trace.collect()
+        bb.trace.write(events)
+        self.assertFalse(os.path.exists(self.path + ".parts"))
+
+        with open(self.path) as f:
+            events = json.load(f)["traceEvents"]
+        names = {e["pid"]: e["args"]["name"] for e in events if e["name"] == "process_name"}
+        self.assertEqual(names, {os.getpid(): "parent", pid: "child"})
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        self.assertEqual(set(spans), {"outer", "inner"})
+        self.assertEqual(spans["outer"]["args"], {"value": 1})
+        self.assertEqual(spans["inner"]["pid"], pid)
+        self.assertGreaterEqual(spans["inner"]["ts"], spans["outer"]["ts"])
+        self.assertLessEqual(spans["inner"]["ts"] + spans["inner"]["dur"], spans["outer"]["ts"] + spans["outer"]["dur"])
+
+        # Spans are only collected once
+        self.assertEqual(bb.trace.collect(), [])
@@ -0,0 +1,173 @@
+"""
+BitBake build trace timeline
+
+Setting BB_TRACE to a file path records spans of the time the server, the
+parsers, the workers and the tasks spend in the main steps of a build. Each
+process buffers its own spans and appends them to a file in a directory next
+to BB_TRACE when it is done. The cooker merges these at the end of parsing
+and of each build into a Chrome trace-event JSON file, which can be opened in
+trace viewers such as Perfetto or chrome://tracing.
+
+Timestamps come from the monotonic clock, which is shared between the
+processes of a build. When BB_TRACE isn't set, span() returns a shared no-op
+context manager so the instrumentation costs a function call.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import bb.utils
+
+class Tracer(object):
+    def __init__(self, path, name):
+        self.path = path
+        self.partsdir = path + ".parts"
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.partfile = None
+
+    def rename(self, name):
+        self.name = name
+
+    def add(self, name, cat, start, end, args=None):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        event = {"name": name, "cat": cat, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000, "pid": self.pid, "tid": tid}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, args):
+        start = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.monotonic_ns(), args)
+
+    def flush(self):
+        events, self.events = self.events, []
+        if not events:
+            return
+        # collect() may have removed the directory since the last flush
+        bb.utils.mkdirhier(self.partsdir)
+        # The pids of task processes are reused during long builds, so
+        # each process writes its own file
+        if self.partfile is None:
+            self.partfile = os.path.join(self.partsdir, "%d-%d.json" % (self.pid, time.monotonic_ns()))
+        metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.name}}]
+        for tid, threadname in self.threads.items():
+            metadata.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": threadname}})
+        with open(self.partfile, "a") as f:
+            for event in metadata + events:
+                f.write(json.dumps(event) + "\n")
+
+# The Tracer() of this process when BB_TRACE is set
+tracer = None
+
+_nullspan = contextlib.nullcontext()
+
+def enable(path, name):
+    """
+    Record spans in this process to the trace written to path, or stop
+    recording if path is empty
+    """
+    global tracer
+    if not path:
+        tracer = None
+        return
+    path = os.path.abspath(path)
+    if tracer is None or tracer.path != path:
+        tracer = Tracer(path, name)
+    else:
+        tracer.rename(name)
+
+def span(name, cat="bitbake", **args):
+    """
+    Return a context manager recording the time spent in it as a span
+    """
+    if tracer is None:
+        return _nullspan
+    return tracer.span(name, cat, args)
+
+def add_span(name, cat, start, **args):
+    """
+    Record a span from start (a time.monotonic_ns() value) until now
+    """
+    if tracer is not None:
+        tracer.add(name, cat, start, time.monotonic_ns(), args)
+
+def rename(name):
+    """
+    Set the name this process is shown with in the trace
+    """
+    if tracer is not None:
+        tracer.rename(name)
+
+def flush():
+    if tracer is not None:
+        tracer.flush()
+
+def collect():
+    """
+    Return the spans the processes have written since the last call,
+    including this process's own
+    """
+    if tracer is None:
+        return []
+    tracer.flush()
+    events = []
+    try:
+        partfiles = sorted(os.listdir(tracer.partsdir))
+    except FileNotFoundError:
+        return events
+    for partfile in partfiles:
+        partfile = os.path.join(tracer.partsdir, partfile)
+        with open(partfile, "r") as f:
+            for line in f:
+                # Skip what a process which was killed half wrote
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+        os.unlink(partfile)
+    # Left in place if a process is still writing to it
+    try:
+        os.rmdir(tracer.partsdir)
+    except OSError:
+        pass
+    # New spans of this process go to a new file
+    tracer.partfile = None
+    return events
+
+def write(events):
+    """
+    Write events to the BB_TRACE file in the Chrome trace-event format
+    """
+    if tracer is None:
+        return
+    bb.utils.mkdirhier(os.path.dirname(tracer.path))
+    tmpfile = tracer.path + ".tmp"
+    with open(tmpfile, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmpfile, tracer.path)
+
+def _after_fork():
+    if tracer is not None:
+        tracer.reset()
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -610,8 +610,9 @@ def _hasher(method, filename):
     with open(filename, "rb") as f:
         try:
             with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                for chunk in iter(lambda: mm.read(8192), b''):
-                    method.update(chunk)
+                # Hash the mapping in one call, which avoids copying it and
+                # releases the GIL for the whole file
+                method.update(mm)
         except ValueError:
             # You can't mmap() an empty file so silence this exception
             pass